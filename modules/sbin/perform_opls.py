@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
 import argparse
+import glob
+import hashlib
+import json
+import shutil
+import time
+from contextlib import contextmanager
+
 import h5py
 import pandas as pd
 from pyopls import OPLSValidator
+from sequential_opls import Checkpoint, SequentialOPLSValidator
 import os
 import sys
 import numpy as np
+from scipy.stats import gaussian_kde
 
-from joblib import parallel_backend
+from joblib import Parallel, cpu_count, delayed, parallel_backend
 
 print(' '.join(sys.argv))
 
@@ -27,10 +36,139 @@ def load_data(filename, group_key):
             description_, pos_label_, neg_label_)
 
 
+@contextmanager
+def replace_on_close(filename):
+    """
+    Create an HDF5 file which replaces filename once it is closed, so a job killed while writing never leaves a partial
+    file
+    """
+    temp_filename = filename + '.tmp'
+    try:
+        with h5py.File(temp_filename, 'w') as file:
+            yield file
+    except Exception as e:
+        os.remove(temp_filename)
+        raise e
+    os.replace(temp_filename, filename)
+
+
+def get_group_filename(state_dir, group_key):
+    return os.path.join(state_dir, f'{group_key}.h5')
+
+
+class H5Checkpoint(Checkpoint):
+    """
+    Keeps the partial results of the permutation tests of one target group in state_dir, one file per test, writing
+    them at most once every interval seconds. fit_group removes the files once the group is written.
+    """
+    def __init__(self, state_dir, group_key, interval):
+        self.prefix = os.path.join(state_dir, f'{group_key}.checkpoint')
+        self.interval = interval
+        self.last_save = time.monotonic()
+
+    def get_filename(self, name):
+        return f'{self.prefix}.{name}.h5'
+
+    def load(self, name):
+        if not os.path.exists(self.get_filename(name)):
+            return None
+        with h5py.File(self.get_filename(name), 'r') as file:
+            return {key: np.array(value) for key, value in file.items()}
+
+    def save(self, name, force=False, **arrays):
+        if not force and time.monotonic() - self.last_save < self.interval:
+            return
+        with replace_on_close(self.get_filename(name)) as file:
+            for key, value in arrays.items():
+                file.create_dataset(key, data=value)
+        self.last_save = time.monotonic()
+
+    def remove(self):
+        for filename in glob.glob(glob.escape(self.prefix) + '.*.h5'):
+            os.remove(filename)
+
+
+def get_checkpoint_key(args_):
+    """
+    Identify a job by its input file and the arguments which change its results, so that a job only resumes from the
+    partial results of the same job.
+    """
+    digest = hashlib.sha1()
+    with open(args_.dataframe_filename, 'rb') as file:
+        for block in iter(lambda: file.read(1024 ** 2), b''):
+            digest.update(block)
+    ignored = {'dataframe_filename', 'processes', 'checkpoint_dir', 'checkpoint_interval'}
+    digest.update(json.dumps({key: value for key, value in vars(args_).items() if key not in ignored},
+                             sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def write_output(dataframe_filename, state_dir, group_keys, output_filename):
+    """
+    Copy the results of each group from state_dir to output_filename, then remove state_dir.
+    """
+    with replace_on_close(output_filename) as out_file:
+        with h5py.File(dataframe_filename, 'r') as in_file:
+            if 'collection_id' in in_file.attrs:
+                out_file.attrs['input_collection_id'] = in_file.attrs['collection_id']
+            out_file.attrs.update({key: value for key, value in in_file.attrs.items() if key != 'collection_id'})
+        out_file.attrs['analysis_type'] = 'opls'
+        for key in group_keys:
+            with h5py.File(get_group_filename(state_dir, key), 'r') as group_file:
+                group_file.copy(group_file[key], out_file, key)
+    shutil.rmtree(state_dir)
+
+
+def get_column_chunks(shape, itemsize=8, chunk_bytes=64 * 1024):
+    """
+    Get a chunk shape of whole columns for a 2D dataset read one column at a time (e.g. the permuted loadings of one
+    feature), so that reading a column reads one chunk instead of every row of the dataset.
+    """
+    n_rows, n_columns = shape
+    if not n_rows or not n_columns:
+        return None
+    return n_rows, max(1, min(n_columns, chunk_bytes // (itemsize * n_rows)))
+
+
+def get_kde(values, true_value):
+    """
+    Get the KDE of a metric's permuted values, evaluated on the grid plotted by the dashboard
+    :param values: The permuted values of the metric
+    :param true_value: The value of the metric for the unpermuted target
+    :return: The grid, the density on the grid and the density at true_value. The grid and density are empty and the
+    density at true_value is nan when the KDE is undefined (e.g. all values are equal)
+    """
+    values = np.ravel(values)
+    values = values[~np.isnan(values)]
+    try:
+        kernel = gaussian_kde(values)
+    except (np.linalg.LinAlgError, ValueError):
+        return np.empty(0), np.empty(0), np.nan
+    values_range = values.max() - values.min()
+    x = np.linspace(values.min() - 0.5 * values_range, values.max() + 0.5 * values_range, 2 * values.size)
+    # noinspection PyArgumentList
+    return x, kernel(x), kernel(true_value).item()
+
+
+def serialize_kdes(group):
+    """
+    Write the KDE of each permuted metric in group to group['kde'][metric], so the dashboard does not compute them on
+    every render
+    """
+    kde_group = group.require_group('kde')
+    for metric in ['q_squared', 'discriminant_q_squared', 'accuracy', 'roc_auc']:
+        if f'permutation_{metric}' in group and metric not in kde_group:
+            x, density, true_density = get_kde(group[f'permutation_{metric}'][()], group.attrs[metric])
+            metric_group = kde_group.create_group(metric)
+            metric_group.create_dataset('x', data=x)
+            metric_group.create_dataset('density', data=density)
+            metric_group.attrs['true_density'] = true_density
+
+
 def serialize_opls(filename, validator_: OPLSValidator, name, description_, pos_label_, neg_label_, target,
                    feature_labels_):
     significant_features = feature_labels_[validator_.feature_significance_]
-    with h5py.File(filename, 'a') as file:
+    with replace_on_close(filename) as file:
         group = file.create_group(name)
         group.attrs['description'] = description_
         group.attrs['pos_label'] = pos_label_ if pos_label_ is not None else ''
@@ -46,10 +184,14 @@ def serialize_opls(filename, validator_: OPLSValidator, name, description_, pos_
         group.attrs['q_squared_p_value'] = validator_.q_squared_p_value_
         group.attrs['r_squared_Y'] = validator_.r_squared_Y_
         group.attrs['r_squared_X'] = validator_.r_squared_X_
+        group.attrs['sequential_h'] = getattr(validator_, 'h', 0)
+        group.attrs['q_squared_n_permutations'] = len(validator_.permutation_q_squared_)
 
         group.create_dataset('permutation_q_squared', data=validator_.permutation_q_squared_)
-        group.create_dataset('permutation_loadings', data=validator_.permutation_loadings_)
+        group.create_dataset('permutation_loadings', data=validator_.permutation_loadings_,
+                             chunks=get_column_chunks(validator_.permutation_loadings_.shape))
         group.create_dataset('feature_p_values', data=validator_.feature_p_values_)
+        group.create_dataset('feature_n_permutations', data=validator_.feature_n_permutations_)
 
         target_dtype = h5py.special_dtype(vlen=bytes) if target.dtype.type is np.object_ else target.dtype
         group.create_dataset('target', data=target.to_numpy(), dtype=target_dtype)
@@ -71,7 +213,7 @@ def serialize_opls(filename, validator_: OPLSValidator, name, description_, pos_
         pls_group.create_dataset('x_rotations', data=validator_.pls_.x_rotations_)
         pls_group.create_dataset('y_rotations', data=validator_.pls_.y_rotations_)
         pls_group.create_dataset('coef', data=validator_.pls_.coef_)
-        pls_group.create_dataset('n_iter', data=validator.pls_.n_iter_)
+        pls_group.create_dataset('n_iter', data=validator_.pls_.n_iter_)
 
         if validator_.accuracy_ is not None:
             group['transformed_target'] = validator_.binarizer_.transform(target)
@@ -82,50 +224,99 @@ def serialize_opls(filename, validator_: OPLSValidator, name, description_, pos_
             group.attrs['discriminant_q_squared'] = validator_.discriminant_q_squared_
             group.attrs['discriminant_q_squared_p_value'] = validator_.discriminant_q_squared_p_value_
             group.attrs['discriminant_r_squared'] = validator_.discriminant_r_squared_
+            group.attrs['accuracy_n_permutations'] = len(validator_.permutation_accuracy_)
+            group.attrs['roc_auc_n_permutations'] = len(validator_.permutation_roc_auc_)
+            group.attrs['discriminant_q_squared_n_permutations'] = len(validator_.permutation_discriminant_q_squared_)
 
             group.create_dataset('permutation_accuracy', data=validator_.permutation_accuracy_)
             group.create_dataset('permutation_roc_auc', data=validator_.permutation_roc_auc_)
             group.create_dataset('permutation_discriminant_q_squared',
                                  data=validator_.permutation_discriminant_q_squared_)
 
+        serialize_kdes(group)
+
+
+def fit_group(filename, group_key, args_, processes, state_dir):
+    """
+    Fit and validate the model of one target group, running permutation refits in processes worker processes, and
+    write it to its own file in state_dir. Partial results are checkpointed to state_dir and the fit continues from any
+    that are already there. Permutations are seeded from args_.random_state, so the results do not depend on processes
+    or on how often the fit was interrupted.
+    """
+    X, y, description_, pos_label_, neg_label_ = load_data(filename, group_key)
+    feature_labels_ = np.array([float(c) for c in X.columns])
+    print(description_)
+    validator_ = SequentialOPLSValidator(args_.min_n_components, args_.k, False, args_.force_regression,
+                                         args_.metric_test_permutations, args_.inner_test_permutations,
+                                         args_.outer_test_permutations, args_.inner_test_alpha, args_.outer_test_alpha,
+                                         args_.sequential_h)
+    print(f'======  Fitting {group_key}  ======')
+    checkpoint = H5Checkpoint(state_dir, group_key, args_.checkpoint_interval)
+    with parallel_backend('loky' if processes > 1 else 'threading'):
+        validator_.fit(X, y, pos_label=pos_label_, random_state=args_.random_state, n_jobs=processes, verbose=1,
+                       checkpoint=checkpoint)
+    serialize_opls(get_group_filename(state_dir, group_key), validator_, group_key, description_, pos_label_,
+                   neg_label_, y, feature_labels_)
+    checkpoint.remove()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Perform Orthogonal Projection to Latent Structures')
+    parser.add_argument('dataframe_filename', type=str,
+                        help='HDF5 file containing two pandas DataFrames, "numeric_df" and "label_df".')
+    parser.add_argument('k', type=int, help='Number of cross-validation folds, -1 for leave-one-out.')
+    parser.add_argument('min_n_components', type=int, help='Minimum number of orthogonal components to remove.')
+    parser.add_argument('inner_test_alpha', type=float,
+                        help='First significance threshold, values outside of this will be '
+                             'tested for outer_test_permutations')
+    parser.add_argument('outer_test_alpha', type=float,
+                        help='Second significance threshold, applied to values tested with outer_test_permutations.')
+    parser.add_argument('metric_test_permutations', type=int,
+                        help='Number of permutations to perform to determine significance of metrics (like R-squared).')
+    parser.add_argument('inner_test_permutations', type=int,
+                        help='Number of permutations to perform for all features.')
+    parser.add_argument('outer_test_permutations', type=int,
+                        help='Number of permutations to perform for features deemed significant with inner_test_alpha.')
+    parser.add_argument('--force_regression', type=bool, default=False,
+                        help='If True, treat numeric multiclass or binary variables as continuous variables.')
+    parser.add_argument('--processes', type=int, default=int(os.environ.get('OPLS_PROCESSES', 1)),
+                        help='Number of processes for target groups and permutation tests, 0 for one per CPU. '
+                             'Defaults to the OPLS_PROCESSES environment variable, or 1.')
+    parser.add_argument('--random_state', type=int, default=0, help='Seed for the permutations.')
+    parser.add_argument('--sequential_h', type=int, default=0,
+                        help='If positive, stop each permutation test once this many permutations are at least as '
+                             'extreme as the unpermuted data (sequential Monte Carlo tests). The permutation counts '
+                             'become maxima and feature tests run at most max(inner_test_permutations, '
+                             'outer_test_permutations) permutations. 0 runs every permutation.')
+    parser.add_argument('--checkpoint_dir', type=str, default=os.environ.get('OPLS_CHECKPOINT_DIR', ''),
+                        help='Directory to keep partial results in, so that a retry of the job in another working '
+                             'directory resumes from them. Defaults to the OPLS_CHECKPOINT_DIR environment variable. '
+                             'If empty, partial results are kept in the working directory.')
+    parser.add_argument('--checkpoint_interval', type=float, default=300,
+                        help='Minimum number of seconds between checkpoints of partial results.')
+    args = parser.parse_args()
+
+    with h5py.File(args.dataframe_filename, 'r') as in_file:
+        all_group_keys = list(in_file.keys())
+    output_filename = os.path.splitext(os.path.basename(args.dataframe_filename))[0] + '_results.h5'
+    # each group and its partial results are kept in files of their own in state_dir until all groups are done
+    state_dir = os.path.join(args.checkpoint_dir or '.', f'opls_{get_checkpoint_key(args)}')
+    os.makedirs(state_dir, exist_ok=True)
+    completed_keys = [key for key in all_group_keys if os.path.exists(get_group_filename(state_dir, key))]
+    if completed_keys:
+        print(f'Resuming from {state_dir}, skipping completed groups {completed_keys}')
+    group_keys = [key for key in all_group_keys if key not in completed_keys]
 
-parser = argparse.ArgumentParser(description='Perform Orthogonal Projection to Latent Structures')
-parser.add_argument('dataframe_filename', type=str,
-                    help='HDF5 file containing two pandas DataFrames, "numeric_df" and "label_df".')
-parser.add_argument('k', type=int, help='Number of cross-validation folds, -1 for leave-one-out.')
-parser.add_argument('min_n_components', type=int, help='Minimum number of orthogonal components to remove.')
-parser.add_argument('inner_test_alpha', type=float,
-                    help='First significance threshold, values outside of this will be '
-                         'tested for outer_test_permutations')
-parser.add_argument('outer_test_alpha', type=float,
-                    help='Second significance threshold, applied to values tested with outer_test_permutations.')
-parser.add_argument('metric_test_permutations', type=int,
-                    help='Number of permutations to perform to determine significance of metrics (like R-squared).')
-parser.add_argument('inner_test_permutations', type=int,
-                    help='Number of permutations to perform for all features.')
-parser.add_argument('outer_test_permutations', type=int,
-                    help='Number of permutations to perform for features deemed significant with inner_test_alpha.')
-parser.add_argument('--force_regression', type=bool, default=False,
-                    help='If True, treat numeric multiclass or binary variables as continuous variables.')
-args = parser.parse_args()
-
-group_keys = [key for key in h5py.File(args.dataframe_filename).keys()]
-output_filename = os.path.splitext(os.path.basename(args.dataframe_filename))[0] + '_results.h5'
-
-with h5py.File(output_filename, 'w') as out_file, h5py.File(args.dataframe_filename, 'r') as in_file:
-    if 'collection_id' in in_file.attrs:
-        out_file.attrs['input_collection_id'] = in_file.attrs['collection_id']
-    out_file.attrs.update({key: value for key, value in in_file.attrs.items() if key != 'collection_id'})
-    out_file.attrs['analysis_type'] = 'opls'
-
-for key in group_keys:
-    X, y, description, pos_label, neg_label = load_data(args.dataframe_filename, key)
-    feature_labels = np.array([float(c) for c in X.columns])
-    print(description)
-    validator = OPLSValidator(args.min_n_components, args.k, False, args.force_regression,
-                              args.metric_test_permutations, args.inner_test_permutations, args.outer_test_permutations,
-                              args.inner_test_alpha, args.outer_test_alpha)
-    print(f'======  Fitting {key}  ======')
-    with parallel_backend('threading'):
-        validator.fit(X, y, pos_label=pos_label, verbose=1)
-    serialize_opls(output_filename, validator, key, description, pos_label, neg_label, y, feature_labels)
+    # target groups are independent, so the processes are split between groups first, then between permutations
+    processes = args.processes or cpu_count()
+    group_processes = max(1, min(processes, len(group_keys)))
+    permutation_processes = max(1, processes // group_processes)
+    if group_processes > 1:
+        Parallel(n_jobs=group_processes, backend='loky')(
+            delayed(fit_group)(args.dataframe_filename, key, args, permutation_processes, state_dir)
+            for key in group_keys
+        )
+    else:
+        for key in group_keys:
+            fit_group(args.dataframe_filename, key, args, permutation_processes, state_dir)
+    write_output(args.dataframe_filename, state_dir, all_group_keys, output_filename)
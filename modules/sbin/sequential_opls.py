@@ -0,0 +1,365 @@
+"""
+Permutation tests for OPLS which can stop early (sequential Monte Carlo tests, Besag and Clifford, 1991) and which can
+be checkpointed and resumed.
+
+Each test of a fixed-count OPLSValidator runs all of its permutations, even when a p-value is clearly far above alpha
+after a few of them. A sequential test instead stops as soon as h permutations have scored at least as extremely as the
+unpermuted data, or when it reaches its maximum number of permutations. A test stopped after n permutations has the
+p-value h / n. A test which runs to its maximum has the usual p-value (g + 1) / (n + 1), where g is the number of
+extreme permutations. Tests with large p-values stop after about h / p permutations, while the p-values of the small
+ones are estimated as precisely as before. With h = 0, every test runs its full number of permutations, as in
+OPLSValidator.
+
+Permutation i of a test is drawn from a generator seeded with (random_state, i) (and the feature index for feature
+tests), so results do not depend on the number of processes or on how permutations are batched, and a test resumed
+from a Checkpoint gives the same results as one which ran without interruption.
+
+Julian Besag and Peter Clifford. Sequential Monte Carlo p-values. Biometrika (1991) 78(2): 301-304.
+"""
+from sys import stderr
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from joblib import Parallel, delayed
+from pyopls import OPLS, OPLSValidator
+from pyopls.permutation_test import _permutation_test_score
+from pyopls.validation import discriminator_accuracy, discriminator_r2_score, discriminator_roc_auc
+from sklearn.base import clone
+from sklearn.cross_decomposition import PLSRegression
+from sklearn.metrics import r2_score
+from sklearn.utils import check_array
+
+# The number of permutations to run between checks of the stopping rule and checkpoints when tests do not stop early
+BATCH_SIZE = 100
+
+# The maximum number of feature permutations to run between checkpoints
+CHUNK_TASKS = 10000
+
+
+class Checkpoint:
+    """
+    Where permutation tests keep their partial results. This one keeps nothing, so tests always start from scratch.
+    """
+    def load(self, name: str) -> Optional[Dict[str, np.ndarray]]:
+        """
+        :param name:
+        :return: The arrays last saved under name, or None
+        """
+        return None
+
+    def save(self, name: str, force: bool = False, **arrays: np.ndarray) -> None:
+        """
+        Save the state of a test. The arrays saved under a name always have the same shapes.
+        :param name:
+        :param force: Whether to save now, even if the implementation saves at intervals
+        :param arrays:
+        :return:
+        """
+        pass
+
+
+def get_stopping_points(is_extreme: np.ndarray, h: int, n_extreme: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find where each test stops in a block of permutations
+    :param is_extreme: Whether each permutation (row) of each test (column) is at least as extreme as the unpermuted data
+    :param h: The number of extreme permutations after which a test stops (0 to never stop early)
+    :param n_extreme: The number of extreme permutations of each test before this block
+    :return: The number of permutations of the block used by each test and the number of extreme permutations of each
+    test at that point
+    """
+    counts = np.cumsum(is_extreme, axis=0) + (0 if n_extreme is None else n_extreme)
+    reached = counts >= h if h > 0 else np.zeros(counts.shape, dtype=bool)
+    n_used = np.where(reached.any(axis=0), reached.argmax(axis=0) + 1, is_extreme.shape[0])
+    if not is_extreme.shape[0]:
+        return n_used, np.zeros(is_extreme.shape[1], dtype=int) if n_extreme is None else n_extreme
+    return n_used, counts[n_used - 1, np.arange(is_extreme.shape[1])]
+
+
+def get_p_values(n_extreme: np.ndarray, n_permutations: np.ndarray, h: int) -> np.ndarray:
+    """
+    :param n_extreme: The number of extreme permutations of each test
+    :param n_permutations: The number of permutations used by each test
+    :param h:
+    :return: The Besag-Clifford p-value of each test
+    """
+    n_extreme = np.asarray(n_extreme, dtype=float)
+    n_permutations = np.asarray(n_permutations, dtype=float)
+    stopped = n_extreme >= h if h > 0 else np.zeros(n_extreme.shape, dtype=bool)
+    return np.where(stopped, n_extreme / np.maximum(n_permutations, 1), (n_extreme + 1) / (n_permutations + 1))
+
+
+def _permuted_test_score(estimator, X, y, cv, score_functions, seed, permutation_ind):
+    indices = np.random.default_rng([seed, permutation_ind]).permutation(len(y))
+    return _permutation_test_score(estimator, X, y[indices], cv=cv, score_functions=score_functions)
+
+
+def _permuted_loading(estimator, X, y, reference_loadings, seed, feature_ind, permutation_ind):
+    X = X.copy()
+    X[:, feature_ind] = X[np.random.default_rng([seed, feature_ind, permutation_ind]).permutation(len(X)), feature_ind]
+    loadings = np.ravel(estimator.fit(X, y).x_loadings_)
+    # the sign of a loading vector is arbitrary, so match it to the reference without the permuted feature
+    others = np.arange(len(loadings)) != feature_ind
+    err1 = np.sum(np.square(loadings[others] - reference_loadings[others]))
+    err2 = np.sum(np.square(loadings[others] + reference_loadings[others]))
+    return (-1 if err2 < err1 else 1) * loadings[feature_ind]
+
+
+def sequential_permutation_test_score(estimator, X, y, cv, score_functions, max_permutations, h, batch_size=None,
+                                      random_state=0, n_jobs=None, verbose=0, pre_dispatch='2*n_jobs',
+                                      checkpoint: Checkpoint = None) -> List[Tuple[float, np.ndarray, float, int]]:
+    """
+    Sequential test of cross-validated scores with permutations of y. All scores are computed from the same
+    permutations, which continue until every score has stopped.
+    :param estimator:
+    :param X:
+    :param y:
+    :param cv:
+    :param score_functions: Functions of form score(y_true, y_pred)
+    :param max_permutations:
+    :param h: See get_stopping_points
+    :param batch_size: The number of permutations to run between checks of the stopping rule (defaults to h, or
+    BATCH_SIZE if h is 0)
+    :param random_state: An int seed
+    :param n_jobs:
+    :param verbose:
+    :param pre_dispatch:
+    :param checkpoint: Where to keep the scores of the permutations which have run
+    :return: For each score function, the unpermuted score, the scores of the permutations used, the p-value and the
+    number of permutations used
+    """
+    batch_size = batch_size or h or BATCH_SIZE
+    checkpoint = checkpoint or Checkpoint()
+    score = _permutation_test_score(clone(estimator), X, y, cv=cv, score_functions=score_functions)
+    state = checkpoint.load('metric_permutations')
+    if state is None:
+        permutation_scores = np.full((max_permutations, len(score)), np.nan)
+        n_done = 0
+    else:
+        permutation_scores = state['permutation_scores']
+        n_done = int(state['n_permutations'])
+    with Parallel(n_jobs=n_jobs, verbose=verbose, pre_dispatch=pre_dispatch) as parallel:
+        while n_done < max_permutations:
+            if h > 0 and np.all(np.sum(permutation_scores[:n_done] >= score, axis=0) >= h):
+                break
+            stop = min(n_done + batch_size, max_permutations)
+            permutation_scores[n_done:stop] = parallel(
+                delayed(_permuted_test_score)(clone(estimator), X, y, cv, score_functions, random_state, i)
+                for i in range(n_done, stop)
+            )
+            n_done = stop
+            checkpoint.save('metric_permutations', permutation_scores=permutation_scores,
+                            n_permutations=np.array(n_done))
+    n_used, n_extreme = get_stopping_points(permutation_scores[:n_done] >= score, h)
+    p_values = get_p_values(n_extreme, n_used, h)
+    return [(score[i], permutation_scores[:n_used[i], i], p_values[i], n_used[i]) for i in range(len(score))]
+
+
+def sequential_feature_permutation_loading(estimator, X, y, max_permutations, h, n_stored_permutations,
+                                           feature_inds=None, first_permutation=0, batch_size=None, random_state=0,
+                                           n_jobs=None, verbose=0, pre_dispatch='2*n_jobs',
+                                           checkpoint: Checkpoint = None,
+                                           checkpoint_name='feature_permutations') -> Tuple[np.ndarray, np.ndarray,
+                                                                                             np.ndarray, np.ndarray]:
+    """
+    Sequential test of the significance of the loading of each feature, by permuting the feature. A permutation is
+    extreme if the magnitude of its loading is at least that of the unpermuted loading (a two-tailed test, as in
+    pyopls.permutation_test.feature_permutation_loading).
+    :param estimator: An estimator with x_loadings_ (e.g. a one-component PLSRegression)
+    :param X:
+    :param y:
+    :param max_permutations: The maximum number of permutations of each feature
+    :param h: See get_stopping_points
+    :param n_stored_permutations: The number of permuted loadings of each feature to return
+    :param feature_inds: The features to test (defaults to all)
+    :param first_permutation: The index of the first permutation, so that another round of tests of the same features
+    uses new permutations
+    :param batch_size: The number of permutations of each feature to run between checks of the stopping rule (defaults
+    to h, or BATCH_SIZE if h is 0)
+    :param random_state: An int seed
+    :param n_jobs:
+    :param verbose:
+    :param pre_dispatch:
+    :param checkpoint: Where to keep the state of the tests
+    :param checkpoint_name: The name of the state of this round of tests in checkpoint
+    :return: The unpermuted loadings of all features, then, for each feature in feature_inds, the first
+    n_stored_permutations permuted loadings (nan after the feature stopped), the p-value and the number of
+    permutations used
+    """
+    batch_size = batch_size or h or BATCH_SIZE
+    checkpoint = checkpoint or Checkpoint()
+    feature_inds = np.arange(X.shape[1]) if feature_inds is None else np.asarray(feature_inds, dtype=int)
+    x_loadings = np.ravel(estimator.fit(X, y).x_loadings_)
+    reference = np.abs(x_loadings[feature_inds])
+    state = checkpoint.load(checkpoint_name)
+    if state is None:
+        permutation_x_loadings = np.full((n_stored_permutations, len(feature_inds)), np.nan)
+        n_extreme = np.zeros(len(feature_inds), dtype=int)
+        n_used = np.zeros(len(feature_inds), dtype=int)
+    else:
+        permutation_x_loadings, n_extreme, n_used = (state['permutation_loadings'], state['n_extreme'],
+                                                     state['n_permutations'])
+
+    def is_active(n_extreme_, n_used_):
+        return (n_extreme_ < h if h > 0 else True) & (n_used_ < max_permutations)
+
+    active = np.flatnonzero(is_active(n_extreme, n_used))
+    with Parallel(n_jobs=n_jobs, verbose=verbose, pre_dispatch=pre_dispatch) as parallel:
+        while len(active):
+            # a round permutes the features which have used the fewest permutations, in chunks between checkpoints
+            start = n_used[active].min()
+            stop = min(start + batch_size, max_permutations)
+            todo = active[n_used[active] == start]
+            if verbose:
+                stderr.write(f'Permuting {len(todo)} features {stop - start} times.\n')
+            for chunk in np.array_split(todo, -(-len(todo) * (stop - start) // CHUNK_TASKS)):
+                loadings = np.array(parallel(
+                    delayed(_permuted_loading)(clone(estimator), X, y, x_loadings, random_state, feature_inds[i],
+                                               first_permutation + j)
+                    for i in chunk for j in range(start, stop)
+                )).reshape(len(chunk), stop - start).T
+                batch_used, n_extreme[chunk] = get_stopping_points(np.abs(loadings) >= reference[chunk], h,
+                                                                   n_extreme[chunk])
+                n_used[chunk] += batch_used
+                if start < n_stored_permutations:
+                    stored = loadings[:n_stored_permutations - start]
+                    stored[np.arange(len(stored))[:, np.newaxis] >= batch_used] = np.nan
+                    permutation_x_loadings[start:start + len(stored), chunk] = stored
+                checkpoint.save(checkpoint_name, permutation_loadings=permutation_x_loadings, n_extreme=n_extreme,
+                                n_permutations=n_used)
+            active = np.flatnonzero(is_active(n_extreme, n_used))
+    return x_loadings, permutation_x_loadings, get_p_values(n_extreme, n_used, h), n_used
+
+
+class SequentialOPLSValidator(OPLSValidator):
+    """
+    An OPLSValidator whose permutation tests stop early (see the module docstring) and can be checkpointed.
+
+    If h is positive, the metric tests use at most n_permutations permutations and each feature test uses at most the
+    larger of n_inner_permutations and n_outer_permutations. inner_alpha is not used, since there is no second round of
+    feature tests. If h is 0, the tests run like those of OPLSValidator: features whose p-value after
+    n_inner_permutations permutations is below inner_alpha / 2 are tested again with n_outer_permutations new
+    permutations. Either way, the first n_inner_permutations permuted loadings of each feature are kept in
+    permutation_loadings_.
+
+    Attributes, in addition to those of OPLSValidator
+    -------------------------------------------------
+    q_squared_n_permutations_, discriminant_q_squared_n_permutations_, accuracy_n_permutations_,
+    roc_auc_n_permutations_ : int, the number of permutations used by each metric test
+
+    feature_n_permutations_ : array [n_features], the number of permutations used by each feature test
+    """
+
+    def __init__(self,
+                 min_n_components=1,
+                 k=10,
+                 scale=True,
+                 force_regression=False,
+                 n_permutations=100,
+                 n_inner_permutations=100,
+                 n_outer_permutations=500,
+                 inner_alpha=0.2,
+                 outer_alpha=0.05,
+                 h=10):
+        super().__init__(min_n_components,
+                         k,
+                         scale,
+                         force_regression,
+                         n_permutations,
+                         n_inner_permutations,
+                         n_outer_permutations,
+                         inner_alpha,
+                         outer_alpha)
+        self.h = h
+        self.q_squared_n_permutations_ = None
+        self.discriminant_q_squared_n_permutations_ = None
+        self.accuracy_n_permutations_ = None
+        self.roc_auc_n_permutations_ = None
+        self.feature_n_permutations_ = None
+
+    def _test_features(self, X, y, n_components, random_state=0, n_jobs=None, verbose=0, pre_dispatch='2*n_jobs',
+                       checkpoint: Checkpoint = None):
+        Z = OPLS(n_components, self.scale).fit_transform(X, y)
+        if self.h > 0:
+            _, permutation_loadings, p_values, n_permutations = sequential_feature_permutation_loading(
+                PLSRegression(1, scale=self.scale), Z, y, max(self.n_inner_permutations, self.n_outer_permutations),
+                self.h, self.n_inner_permutations, random_state=random_state, n_jobs=n_jobs, verbose=verbose,
+                pre_dispatch=pre_dispatch, checkpoint=checkpoint
+            )
+            return p_values < self.outer_alpha, p_values, permutation_loadings, n_permutations
+
+        _, permutation_loadings, p_values, n_permutations = sequential_feature_permutation_loading(
+            PLSRegression(1, scale=self.scale), Z, y, self.n_inner_permutations, 0, self.n_inner_permutations,
+            random_state=random_state, n_jobs=n_jobs, verbose=verbose, pre_dispatch=pre_dispatch,
+            checkpoint=checkpoint, checkpoint_name='inner_feature_permutations'
+        )
+        retest_inds = np.flatnonzero(p_values < self.inner_alpha / 2.0)  # two-tailed
+        if verbose:
+            stderr.write(f'Re-testing {len(retest_inds)} features.\n')
+        _, _, p_values[retest_inds], n_permutations[retest_inds] = sequential_feature_permutation_loading(
+            PLSRegression(1, scale=self.scale), Z, y, self.n_outer_permutations, 0, 0, feature_inds=retest_inds,
+            first_permutation=self.n_inner_permutations, random_state=random_state, n_jobs=n_jobs, verbose=verbose,
+            pre_dispatch=pre_dispatch, checkpoint=checkpoint, checkpoint_name='outer_feature_permutations'
+        )
+        return p_values < self.outer_alpha, p_values, permutation_loadings, n_permutations
+
+    def fit(self, X, y, n_components=None, cv=None, pos_label=None,
+            random_state=0, n_jobs=None, verbose=0, pre_dispatch='2*n_jobs', checkpoint: Checkpoint = None):
+        """
+        Fit like OPLSValidator.fit, with sequential permutation tests
+        :param random_state: An int seed for the permutations
+        :param checkpoint: Where to keep partial results. If it holds the partial results of an earlier fit with the
+        same data and parameters, the fit continues from them.
+        """
+        checkpoint = checkpoint or Checkpoint()
+        X = check_array(X, dtype=float, copy=True)
+        y = self._check_target(y, pos_label)
+
+        state = checkpoint.load('model')
+        if state is not None:
+            n_components = int(state['n_components'])
+        elif not n_components:
+            if verbose:
+                stderr.write('Determining number of components to remove.\n')
+            n_components = self._determine_n_components(X, y, cv, n_jobs=n_jobs, verbose=verbose,
+                                                        pre_dispatch=pre_dispatch)
+            checkpoint.save('model', force=True, n_components=np.array(n_components))
+        self.n_components_ = n_components
+
+        self.opls_ = OPLS(self.n_components_, self.scale).fit(X, y)
+        Z = self.opls_.transform(X)
+        self.pls_ = PLSRegression(1, scale=self.scale).fit(Z, y)
+        self.r_squared_X_ = self.opls_.score(X)
+        y_pred = self.pls_.predict(Z)
+        self.r_squared_Y_ = r2_score(y, y_pred)
+        if self.is_discrimination(y):
+            self.discriminant_r_squared_ = r2_score(y, np.clip(y_pred, -1, 1))
+
+        cv = cv or self._get_validator(y, self.k)
+        score_functions = [r2_score]
+        if self.is_discrimination(y):
+            score_functions += [discriminator_r2_score, discriminator_accuracy, discriminator_roc_auc]
+
+        if verbose:
+            stderr.write('Performing cross-validated metric permutation tests.\n')
+        cv_results = sequential_permutation_test_score(PLSRegression(1, scale=self.scale), Z, y, cv, score_functions,
+                                                       self.n_permutations, self.h, random_state=random_state,
+                                                       n_jobs=n_jobs, verbose=verbose, pre_dispatch=pre_dispatch,
+                                                       checkpoint=checkpoint)
+        (self.q_squared_, self.permutation_q_squared_, self.q_squared_p_value_,
+         self.q_squared_n_permutations_) = cv_results[0]
+        if self.is_discrimination(y):
+            [
+                (self.discriminant_q_squared_, self.permutation_discriminant_q_squared_,
+                 self.discriminant_q_squared_p_value_, self.discriminant_q_squared_n_permutations_),
+                (self.accuracy_, self.permutation_accuracy_, self.accuracy_p_value_, self.accuracy_n_permutations_),
+                (self.roc_auc_, self.permutation_roc_auc_, self.roc_auc_p_value_, self.roc_auc_n_permutations_)
+            ] = cv_results[1:]
+
+        if verbose:
+            stderr.write('Estimating feature significance.\n')
+        (self.feature_significance_,
+         self.feature_p_values_,
+         self.permutation_loadings_,
+         self.feature_n_permutations_) = self._test_features(X, y, self.n_components_, random_state, n_jobs, verbose,
+                                                             pre_dispatch, checkpoint)
+        return self
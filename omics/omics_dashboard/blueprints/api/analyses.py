@@ -2,7 +2,7 @@ from flask import Blueprint, jsonify, request
 from flask_login import login_required
 
 import data_tools as dt
-from helpers import get_current_user, handle_exception
+from helpers import get_current_user, handle_exception, get_list_response
 
 analyses_api = Blueprint('analyses_api', __name__, url_prefix='/api/analyses')
 
@@ -21,7 +21,7 @@ def list_analyses():
                 collections = None
             analysis = dt.analyses.create_analysis(user, new_data, collections)
             return jsonify(analysis.to_dict())
-        return jsonify([analysis.to_dict() for analysis in dt.analyses.get_analyses(user)])
+        return get_list_response(user, dt.db.Analysis, dt.analyses.get_analyses, has_file_info=True)
     except Exception as e:
         return handle_exception(e)
 
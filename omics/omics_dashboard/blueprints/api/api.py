@@ -8,6 +8,7 @@ from flask_login import login_user, logout_user, login_required
 import data_tools as dt
 import helpers
 from config.config import TMPDIR
+from data_tools.file_tools.metadata_tools import file_cache
 from helpers import handle_exception
 from login_manager import authenticate_user
 
@@ -144,6 +145,20 @@ def register_user():
         return handle_exception(e)
 
 
+@api.route('/metadata_cache', methods=['GET', 'DELETE'])
+@login_required
+def metadata_cache():
+    try:
+        user = helpers.get_current_user()
+        if not user.admin:
+            raise dt.util.AuthException(f'User {user.email} is not an administrator.')
+        if request.method == 'DELETE':
+            file_cache.clear()
+        return jsonify(file_cache.get_stats())
+    except Exception as e:
+        return handle_exception(e)
+
+
 @api.route('/download_tmp')
 @login_required
 def download_temporary_file():
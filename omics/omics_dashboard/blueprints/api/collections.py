@@ -3,14 +3,15 @@ import json
 import os
 import uuid
 
-from flask import request, jsonify, make_response, send_from_directory, Blueprint
+from flask import request, jsonify, send_from_directory, Blueprint, Response
 from flask_login import login_required
 from werkzeug.utils import secure_filename
 
 import data_tools as dt
 from data_tools.file_tools.collection_tools import validate_update
 from config.config import DATADIR, UPLOADDIR
-from helpers import get_current_user, handle_exception, process_input_dict
+from helpers import get_current_user, handle_exception, process_input_dict, get_list_response, \
+    stream_temporary_file
 
 collections_api = Blueprint('collections_api', __name__, url_prefix='/api/collections')
 
@@ -21,7 +22,8 @@ def list_collections():
     try:
         current_user = get_current_user()
         if request.method == 'GET':
-            return jsonify([collection.to_dict() for collection in dt.collections.get_collections(current_user)])
+            return get_list_response(current_user, dt.db.Collection, dt.collections.get_collections,
+                                     has_file_info=True)
         if request.method == 'POST':
             data = request.get_json(force=True)
             if 'sample_ids' in data:
@@ -109,21 +111,23 @@ def download_collection(collection_id=None):
             out = dt.collections.download_collection_dataframe(user, collection, single_column, data_format, json_orient)
             as_attachment = request.args.get('as_attachment') if 'as_attachment' in request.args else 'true'
             if as_attachment == 'false':
-                response = jsonify({'data_frame': out[data_format]})
+                response = jsonify({'data_frame': out['json'] if data_format == 'json' else ''.join(out['csv'])})
             else:
                 if data_format == 'json':
                     out['json'] = json.dumps(out['json'])
-                response = make_response(out[data_format])
+                response = Response(out[data_format], mimetype=f'text/{data_format}')
                 response.headers['Content-Disposition'] = out['cd']
-                response.mimetype = f'text/{data_format}'
             return response
         if request.args.get('path', ''):
             path = request.args.get('path', '')
             out = dt.collections.download_collection_dataset(user, collection, path)
-            response = make_response(out['csv'])
+            response = Response(out['csv'], mimetype='text/csv')
             response.headers['Content-Disposition'] = out['cd']
-            response.mimetype = 'text/csv'
             return response
+        if request.args.get('rows', '') or request.args.get('cols', ''):
+            out = dt.collections.download_collection_slice(user, collection, request.args.get('rows'),
+                                                           request.args.get('cols'))
+            return stream_temporary_file(out['filename'], 'application/x-hdf5', out['cd'])
         out = dt.collections.download_collection(user, collection)
         return send_from_directory(f'{DATADIR}/collections', out['filename'], as_attachment=True)
     except Exception as e:
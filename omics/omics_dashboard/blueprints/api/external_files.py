@@ -9,7 +9,7 @@ from werkzeug.utils import secure_filename
 
 import data_tools as dt
 from config.config import UPLOADDIR
-from helpers import get_current_user, handle_exception, process_input_dict
+from helpers import get_current_user, handle_exception, process_input_dict, get_list_response
 
 external_files_api = Blueprint('external_files_api', __name__, url_prefix='/api/external_files')
 
@@ -20,8 +20,8 @@ def list_external_files():
     try:
         current_user = get_current_user()
         if request.method == 'GET':
-            return jsonify(
-                [external_file.to_dict() for external_file in dt.external_files.get_external_files(current_user)])
+            return get_list_response(current_user, dt.db.ExternalFile, dt.external_files.get_external_files,
+                                     has_file_info=True)
         if request.method == 'POST':
             # this will only create a record. the "upload" route should be used to both create the record and upload
             data = request.get_json(force=True)
@@ -3,7 +3,7 @@ from flask_login import login_required
 
 import data_tools as dt
 from data_tools.util import AuthException
-from helpers import get_current_user, handle_exception, process_input_dict
+from helpers import get_current_user, handle_exception, process_input_dict, get_list_response
 
 sample_groups_api = Blueprint('sample_groups_api', __name__, url_prefix='/api/sample_groups')
 
@@ -21,8 +21,8 @@ def list_sample_groups():
             return jsonify(
                 dt.sample_groups.create_sample_group(current_user, new_data).to_dict())
 
-        return jsonify([sample_group.to_dict()
-                        for sample_group in dt.sample_groups.get_sample_groups(get_current_user())])
+        return get_list_response(current_user, dt.db.SampleGroup, dt.sample_groups.get_sample_groups,
+                                 has_file_info=True)
     except Exception as e:
         return handle_exception(e)
 
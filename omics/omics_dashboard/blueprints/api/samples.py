@@ -2,13 +2,13 @@ import base64
 import os
 import uuid
 
-from flask import jsonify, request, make_response, send_from_directory, redirect, url_for, Blueprint
+from flask import jsonify, request, send_from_directory, redirect, url_for, Blueprint, Response
 from flask_login import login_required
 from werkzeug.utils import secure_filename
 
 import data_tools as dt
 from config.config import UPLOADDIR
-from helpers import get_current_user, handle_exception, process_input_dict
+from helpers import get_current_user, handle_exception, process_input_dict, get_list_response
 
 samples_api = Blueprint('samples_api', __name__, url_prefix='/api/samples')
 
@@ -32,7 +32,7 @@ def list_samples():
             workflow_data = dt.sample_creation.create_sample_creation_workflow(user, [filename], data)
             dt.jobserver_control.start_job(workflow_data['workflow_filename'], workflow_data['job'], user)
             return redirect(url_for('jobs_api.list_jobs'))
-        return jsonify([sample.to_dict() for sample in dt.samples.get_samples(user)])
+        return get_list_response(user, dt.db.Sample, dt.samples.get_samples, has_file_info=True)
     except Exception as e:
         return handle_exception(e)
 
@@ -97,9 +97,8 @@ def download_sample(sample_id=None):
         if request.args.get('path', ''):
             path = request.args.get('path', '')
             out = dt.samples.download_sample_dataset(user, sample, path)
-            response = make_response(out['csv'])
+            response = Response(out['csv'], mimetype='text/csv')
             response.headers['Content-Disposition'] = out['cd']
-            response.mimetype = 'text/csv'
             return response
         directory, filename = os.path.split(sample.filename)
         return send_from_directory(directory, filename, as_attachment=True)
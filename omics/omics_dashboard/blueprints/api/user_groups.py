@@ -2,7 +2,7 @@ from flask import request, jsonify, Blueprint
 from flask_login import login_required
 
 import data_tools as dt
-from helpers import get_current_user, handle_exception
+from helpers import get_current_user, handle_exception, get_list_response
 
 user_groups_api = Blueprint('user_groups_api', __name__, url_prefix='/api/user_groups')
 
@@ -13,7 +13,7 @@ def list_user_groups():
     try:
         user = get_current_user()
         if request.method == 'GET':
-            return jsonify([user_group.to_dict() for user_group in dt.user_groups.get_user_groups(user)])
+            return get_list_response(user, dt.db.UserGroup, dt.user_groups.get_user_groups)
         if request.method == 'POST':
             data = request.get_json(force=True)
             return jsonify(dt.user_groups.create_user_group(user, data).to_dict())
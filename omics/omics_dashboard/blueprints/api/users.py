@@ -2,7 +2,7 @@ from flask import request, jsonify, Blueprint
 from flask_login import login_required, fresh_login_required
 
 import data_tools as dt
-from helpers import get_current_user, handle_exception
+from helpers import get_current_user, handle_exception, get_list_response
 
 users_api = Blueprint('users_api', __name__, url_prefix='/api/users')
 
@@ -15,7 +15,7 @@ def list_users():
         if request.method == 'POST':
             data = request.get_json(force=True)
             return jsonify(dt.users.create_user(user, data).to_dict())
-        return jsonify([target_user.to_dict() for target_user in dt.users.get_users(user)])
+        return get_list_response(user, dt.db.User, dt.users.get_users)
     except Exception as e:
         return handle_exception(e)
 
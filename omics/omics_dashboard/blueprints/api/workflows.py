@@ -8,7 +8,7 @@ from werkzeug.utils import secure_filename
 
 import data_tools as dt
 from config.config import UPLOADDIR
-from helpers import get_current_user, handle_exception, process_input_dict
+from helpers import get_current_user, handle_exception, process_input_dict, get_list_response
 
 workflows_api = Blueprint('workflows_api', __name__, url_prefix='/api/workflows')
 
@@ -20,7 +20,7 @@ def list_workflows():
         user = get_current_user()
         if request.method == 'POST':
             return jsonify(dt.workflows.create_workflow(user, request.get_json()).to_dict())
-        return jsonify([workflow.to_dict() for workflow in dt.workflows.get_workflows(user)])
+        return get_list_response(user, dt.db.Workflow, dt.workflows.get_workflows)
     except Exception as e:
         return handle_exception(e)
 
@@ -7,4 +7,8 @@ COMPUTESERVER: str = os.environ.get('COMPUTESERVER', 'http://jobserver:8000')
 MODULEDIR: str = os.path.join(os.environ.get('MODULEDIR', os.path.join(DATADIR, 'modules')), 'cwl')
 UPLOADDIR: str = f'{TMPDIR}/uploads'
 OMICSSERVER: str = os.environ.get('OMICSSERVER', 'http://localhost/omics')
+MERGE_PROCESSES: int = int(os.environ.get('MERGE_PROCESSES', 1))
+COLLECTION_COMPRESSION: str = os.environ.get('COLLECTION_COMPRESSION', '')
+DASHBOARD_CACHE_BYTES: int = int(os.environ.get('DASHBOARD_CACHE_BYTES', 256 * 1024 ** 2))
+MAX_LIST_LIMIT: int = int(os.environ.get('MAX_LIST_LIMIT', 1000))
 REDIS_URL: str = f'redis://{os.environ.get("REDISSERVER", "redis")}:{os.environ.get("REDISPORT", 6379)}/{os.environ.get("REDISDB", 0)}'
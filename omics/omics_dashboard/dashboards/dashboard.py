@@ -1,6 +1,11 @@
 from pathlib import Path
 
+import dash
+import dash_bootstrap_components as dbc
+import dash_core_components as dcc
+import dash_html_components as html
 from dash import Dash
+from dash.dependencies import Output
 from dash.exceptions import PreventUpdate
 from dash_bootstrap_components.themes import FLATLY, DARKLY
 from flask import url_for
@@ -8,6 +13,15 @@ from flask_login import current_user
 import os
 from jinja2 import Template
 
+# outputs of the callback which loads collections, after the outputs updated once collections are loaded
+COLLECTION_LOAD_OUTPUTS = [
+    Output('collection-load-interval', 'interval'),
+    Output('collection-load-progress', 'value'),
+    Output('collection-load-progress', 'animated'),
+    Output('collection-load-progress-badge', 'children'),
+    Output('collection-load-progress-label', 'children')
+]
+
 
 class Dashboard:
     name = 'Dashboard'
@@ -62,6 +76,35 @@ class Dashboard:
         if not value or None in value:
             raise PreventUpdate('Callback triggered without action!')
 
+    @staticmethod
+    def load_collections(model, n_clicks, value):
+        """
+        Queue a job loading collections when the get-collection button is clicked and report the progress of the job
+        when collection-load-interval fires. The callback should take Input('get-collection', 'n_clicks') and
+        Input('collection-load-interval', 'n_intervals') and end its outputs with COLLECTION_LOAD_OUTPUTS.
+        :param model: The DashboardModel of the dashboard
+        :param n_clicks:
+        :param value: The collection ids
+        :return: Whether the collections were loaded in this call, and the values of COLLECTION_LOAD_OUTPUTS
+        """
+        triggered = [prop['prop_id'] for prop in dash.callback_context.triggered]
+        if 'get-collection.n_clicks' in triggered:
+            if not value or not n_clicks:
+                raise PreventUpdate('Callback triggered without value')
+            model.get_collections(value)
+            return False, (500, 0, True, '0/0', dbc.FormText('Starting job'))
+        progress = model.get_collection_load_progress()
+        if progress is None:
+            raise PreventUpdate('No collections loading.')
+        loaded = model.finish_collection_load()
+        if progress['status'] == 'finished':
+            return loaded, (3600000, 100, False, progress['progress_fraction'],
+                            dbc.FormText(progress['label'], color='success'))
+        if progress['status'] == 'failed':
+            return False, (3600000, progress['progress'], False, progress['progress_fraction'],
+                           dbc.FormText('Failed to load collections.', color='danger'))
+        return False, (500, progress['progress'], True, progress['progress_fraction'], dbc.FormText(progress['label']))
+
 
 class StyledDash(Dash):
     def interpolate_index(self, **kwargs):
@@ -117,6 +160,19 @@ class StyledDash(Dash):
         '''
 
 
+def get_collection_load_progress_div():
+    return html.Div(
+        [
+            dcc.Interval(id='collection-load-interval', n_intervals=0, interval=3600000),
+            html.Div(dbc.FormText(''), id='collection-load-progress-label'),
+            dbc.Progress(html.Div(dbc.Badge('0/0', color='light', pill=True, id='collection-load-progress-badge')),
+                         id='collection-load-progress', value=0, striped=True, animated=False,
+                         style={'height': '25px'}, color='info', className='w-100')
+        ],
+        id='collection-load-progress-div'
+    )
+
+
 def get_plot_theme():
     try:
         return 'plotly_dark' if current_user and current_user.theme == 'dark' else 'plotly_white'
@@ -1,10 +1,12 @@
 import pathlib
+import posixpath
 import shutil
 import tempfile
-import traceback
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Tuple, Optional, Any, Callable
 
 from flask_login import current_user
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
 from wand.image import Image
 import cairosvg
 import plotly.io as pio
@@ -12,20 +14,28 @@ import os
 import msgpack
 import dash_bootstrap_components as dbc
 import dash_html_components as html
-import pandas as pd
+import h5py
 import numpy as np
+import pandas as pd
 from sklearn.utils.multiclass import type_of_target
 
 import config.redis_config as rds
 from config.rq_config import rq
-from data_tools.file_tools.collection_tools import create_collection_file
-from data_tools.wrappers.collections import get_collection_copy
-from config.config import TMPDIR
+from dashboards.working_set import WorkingSet, WorkingSetCache
+from data_tools.file_tools.collection_tools import create_collection_file, get_dataframe_from_datasets
+from data_tools.file_tools.h5_merge import read_merged
+from data_tools.wrappers.collections import get_collection
+from config.config import TMPDIR, DASHBOARD_CACHE_BYTES
 
 
 class DashboardModel:
     _redis_prefix = ''
     _empty_plot_data = {}
+    # values kept in the working set, each in the attribute of the same name prefixed with an underscore
+    _dataframe_keys = ['label_df', 'numeric_df']
+    _label_keys = ['label_df']
+    # shared by the models of all dashboards in this process
+    _working_set_cache = WorkingSetCache(DASHBOARD_CACHE_BYTES)
 
     def __init__(self, load_data=False):
         # any of these can be None
@@ -77,7 +87,8 @@ class DashboardModel:
     def load_file_info(self):
         data_frame_filename = rds.get_value(f'{self._redis_prefix}_dataframe_filename')
         self._dataframe_filename = data_frame_filename.decode('utf-8') if data_frame_filename is not None else None
-        if not self._dataframe_filename or not os.path.isfile(self._dataframe_filename):
+        if not self._dataframe_filename or not os.path.isfile(self._dataframe_filename) \
+                or not self._dataframe_filename.endswith('.json'):  # sessions from before working sets
             rds.delete_value(f'{self._redis_prefix}_dataframe_filename')
             self._dataframe_filename = None
         try:
@@ -89,78 +100,134 @@ class DashboardModel:
         rds.set_value(f'{self._redis_prefix}_dataframe_filename', self._dataframe_filename.encode('utf-8'))
         rds.set_value(f'{self._redis_prefix}_loaded_collection_ids', msgpack.dumps(self._loaded_collection_ids))
 
+    @property
+    def working_set(self) -> WorkingSet:
+        return WorkingSet(self._dataframe_filename, self._working_set_cache, current_user.id)
+
+    def load_working_set(self, keys: List[str]):
+        if not os.path.isfile(self._dataframe_filename):
+            raise FileNotFoundError(f'No working set at {self._dataframe_filename}.')
+        for key, value in self.working_set.load(keys).items():
+            setattr(self, f'_{key}', value)
+
+    def save_working_set(self, keys: List[str]):
+        self.working_set.save({key: getattr(self, f'_{key}') for key in keys})
+
     def load_dataframes(self):
-        self._label_df = pd.read_hdf(self._dataframe_filename, 'label_df')
-        self._numeric_df = pd.read_hdf(self._dataframe_filename, 'numeric_df')
+        self.load_working_set(self._dataframe_keys)
 
     def save_dataframes(self):
-        self._label_df.to_hdf(self._dataframe_filename, 'label_df', mode='a')
-        self._numeric_df.to_hdf(self._dataframe_filename, 'numeric_df', mode='a')
+        self.save_working_set(self._dataframe_keys)
 
     def load_labels(self):
-        self._label_df = pd.read_hdf(self._dataframe_filename, 'label_df')
+        self.load_working_set(self._label_keys)
 
     def save_labels(self):
-        self._label_df.to_hdf(self._dataframe_filename, 'label_df', mode='a')
+        self.save_working_set(self._label_keys)
 
     def get_collections(self, collection_ids: Union[List[int], int]):
+        """
+        Queue a load_collections job which replaces the working set with the collections. The job reports its progress
+        in the same way as save_figures. Call finish_collection_load to find out when it is done.
+        :param collection_ids:
+        :return: The job, or None if there are no collections to load
+        """
         data_dir = os.path.dirname(self._dataframe_filename) if self._dataframe_filename is not None else None
         if data_dir is not None:
             shutil.rmtree(data_dir)
+        rds.delete_value(f'{self.redis_prefix}_dataframe_filename')
+        self._dataframe_filename = None
         if not isinstance(collection_ids, list):
             collection_ids = [collection_ids]
+        self._loaded_collection_ids = []
+        rds.set_value(f'{self.redis_prefix}_loaded_collection_ids', msgpack.dumps(self._loaded_collection_ids))
+        if not collection_ids:
+            return None
+        # check permissions here, because the job does not know the user
+        filenames = [get_collection(current_user, collection_id).filename for collection_id in collection_ids]
+        rds.set_value(f'{self.redis_prefix}_collection_load_progress', 0)
+        rds.set_value(f'{self.redis_prefix}_collection_load_progress_fraction', '0/0')
+        rds.set_value(f'{self.redis_prefix}_collection_load_label', 'Starting job')
+        job = load_collections.queue(filenames, collection_ids, tempfile.mkdtemp(), f'user{current_user.id}',
+                                     self.redis_prefix)
+        rds.set_value(f'{self.redis_prefix}_collection_load_job_id', job.id)
+        return job
+
+    def get_collection_load_progress(self) -> Optional[Dict[str, Any]]:
+        """
+        Get the progress of the last load_collections job
+        :return: The status of the job, its progress in percent, the fraction of steps done and a label, or None if
+        there is no job
+        """
+        job_id = rds.get_value(f'{self.redis_prefix}_collection_load_job_id')
+        if job_id is None:
+            return None
         try:
-            collections = [get_collection_copy(current_user, collection_id) for collection_id in collection_ids]
-            if len(collections) > 1:
-                for collection_id, collection in zip(collection_ids, collections):
-                    collection_size = collection.get_dataset('/Y').shape[0]
-                    # original_collection_id is now a label for the merged dataset
-                    collection.set_dataset('/original_collection_id',
-                                           np.repeat(collection_id, collection_size).reshape(-1, 1))
-                collections[0].merge(collections[1:])
-                collection = collections[0]
-            elif len(collections) == 1:
-                collection = collections[0]
-            else:
-                collection = None
-        except Exception as e:
-            traceback.print_exc()
-            self._loaded_collection_ids = []
-            collection = None
-        if collection is not None:
-            x = collection.get_dataset('x')
-            inds = np.argsort([float(val) for val in x.flatten()])
-            y = collection.get_dataset('Y')
-            collection.set_dataset('x', x[:, inds])
-            collection.set_dataset('Y', y[:, inds])
-            try:
-                x_min = collection.get_dataset('x_min')[:, inds]
-                collection.set_dataset('x_min', x_min)
-                self._x_min = x_min
-            except:
-                self._x_min = None
-            try:
-                x_max = collection.get_dataset('x_max')[:, inds]
-                collection.set_dataset('x_max', x_max)
-                self._x_max = x_max
-            except:
-                self._x_max = None
-            del y
-            data_dir = os.path.dirname(collection.filename)
-            self._results_filename = os.path.join(data_dir, 'results.h5')
-            self._dataframe_filename = os.path.join(data_dir, 'dataframes.h5')
-            self._loaded_collection_ids = collection_ids
-            self._label_df = collection.get_dataframe(include_only_labels=True)
-            self._numeric_df = collection.get_dataframe(numeric_columns=True, include_labels=False)
-            self._good_x_inds = np.where(self._numeric_df.isnull().sum() == 0)[0]
-            self._numeric_df = self._numeric_df[self._numeric_df.columns[self._good_x_inds]]
-            self._x = x[:, self._good_x_inds]
-            self._x_min = self._x_min[:, self._good_x_inds] if self._x_min is not None else None
-            self._x_max = self._x_max[:, self._good_x_inds] if self._x_max is not None else None
-            self._processed_label_df = self._label_df
-            os.remove(collection.filename)
-            self.set_file_info()
-            self.save_dataframes()
+            status = Job.fetch(job_id.decode('utf-8'), rds.get_redis()).get_status()
+        except NoSuchJobError:
+            return None
+        values = [rds.get_value(f'{self.redis_prefix}_collection_load_{key}')
+                  for key in ('progress', 'progress_fraction', 'label')]
+        progress, fraction, label = [value.decode('utf-8') if value is not None else '' for value in values]
+        return {
+            'status': status,
+            'progress': int(float(progress)) if progress else 0,
+            'progress_fraction': fraction,
+            'label': label
+        }
+
+    def finish_collection_load(self) -> bool:
+        """
+        Check whether the last load_collections job has finished. This returns True only once for each job, so that
+        callbacks can update the dashboard once the collections are loaded.
+        :return:
+        """
+        progress = self.get_collection_load_progress()
+        if progress is None or progress['status'] != 'finished':
+            return False
+        if not rds.delete_value(f'{self.redis_prefix}_collection_load_job_id'):
+            return False  # another callback got here first
+        self.load_file_info()
+        return True
+
+    @staticmethod
+    def read_collections(filenames: List[str], collection_ids: List[int], progress: Callable[[int], None] = None) \
+            -> Tuple[pd.DataFrame, pd.DataFrame, np.array, Optional[np.array], Optional[np.array]]:
+        """
+        Read collections into the values of a working set, without writing to or copying the collection files. The
+        collections are merged like Collection.merge would merge them, with an original_collection_id label if there
+        is more than one. Columns are sorted by x and those with missing values are left out.
+        :param filenames:
+        :param collection_ids:
+        :param progress: A function called with the number of collections read after each collection
+        :return: The label dataframe, the numeric dataframe, and x, x_min and x_max for its columns
+        """
+        merged = read_merged(filenames, orientation='vert', reserved_paths=['/x'], align_at='/x', progress=progress)
+        datasets = {path[1:]: merged[path] for path in sorted(merged) if posixpath.dirname(path) == '/'}
+        if len(filenames) > 1:
+            row_counts = []
+            for filename in filenames:
+                with h5py.File(filename, 'r') as file:
+                    row_counts.append(file['Y'].shape[0])
+            # original_collection_id is a label for the merged dataset
+            datasets['original_collection_id'] = np.repeat(collection_ids, row_counts).reshape(-1, 1)
+            datasets = {key: datasets[key] for key in sorted(datasets)}
+        inds = np.argsort([float(val) for val in datasets['x'].flatten()])
+        for key in ('x', 'x_min', 'x_max'):
+            if key in datasets and len(datasets[key].shape) > 1:
+                datasets[key] = datasets[key][:, inds]
+        y = datasets.pop('Y')
+        label_df = get_dataframe_from_datasets({'Y': y, **datasets}, include_only_labels=True)
+
+        # the columns of y without missing values, in the order of x
+        good_x_inds = np.where(~np.isnan(y).any(axis=0)[inds])[0]
+        numeric_datasets = {key: datasets[key] for key in ('base_sample_id',) if key in datasets}
+        numeric_datasets['x'] = datasets['x'][:, good_x_inds]
+        numeric_datasets['Y'] = y[:, inds[good_x_inds]]
+        numeric_df = get_dataframe_from_datasets(numeric_datasets, numeric_columns=True, include_labels=False)
+        x_min = datasets['x_min'][:, good_x_inds] if 'x_min' in datasets and len(datasets['x_min'].shape) > 1 else None
+        x_max = datasets['x_max'][:, good_x_inds] if 'x_max' in datasets and len(datasets['x_max'].shape) > 1 else None
+        return label_df, numeric_df, numeric_datasets['x'], x_min, x_max
 
     def get_collection_badges(self) -> List[html.Span]:
         return [
@@ -171,10 +238,6 @@ class DashboardModel:
     def get_collection_load_info(self) -> str:
         return f'Collections loaded in {os.path.dirname(self._dataframe_filename)}'
 
-    def load_dataframes(self):
-        self._label_df = pd.read_hdf(self._dataframe_filename, 'label_df')
-        self._numeric_df = pd.read_hdf(self._dataframe_filename, 'numeric_df')
-
     @staticmethod
     def reference_image_size(width, height, units, dpi):
         if units == 'in':
@@ -293,3 +356,43 @@ def save_figures(figure_data, file_formats, width, height, units, dpi, output_di
     rds.set_value(f'{redis_prefix}_image_save_progress_fraction', f'{n_steps}/{n_steps}', redis_hash_name)
     rds.set_value(f'{redis_prefix}_image_save_label', f'Created archive {archive_name}', redis_hash_name)
     return out_filename
+
+
+@rq.job
+def load_collections(filenames, collection_ids, data_dir, redis_hash_name, redis_prefix):
+    """
+    Load collections into a new working set in data_dir and make it the working set of the dashboard with redis_prefix.
+    :param filenames: The files of the collections. Permissions should be checked before the job is queued.
+    :param collection_ids:
+    :param data_dir: An empty directory for the working set
+    :param redis_hash_name: The redis hash of the user
+    :param redis_prefix: The redis prefix of the dashboard
+    :return: collection_ids
+    """
+    n_steps = len(filenames) + 2
+
+    def set_progress(step, label):
+        rds.set_value(f'{redis_prefix}_collection_load_progress', 100 * step / n_steps, redis_hash_name)
+        rds.set_value(f'{redis_prefix}_collection_load_progress_fraction', f'{step}/{n_steps}', redis_hash_name)
+        rds.set_value(f'{redis_prefix}_collection_load_label', label, redis_hash_name)
+
+    set_progress(0, 'Reading collections')
+    label_df, numeric_df, x, x_min, x_max = DashboardModel.read_collections(
+        filenames, collection_ids, lambda i: set_progress(i, f'Read {i} of {len(filenames)} collections'))
+    set_progress(len(filenames) + 1, 'Saving working set')
+    dataframe_filename = os.path.join(data_dir, 'working_set.json')
+    WorkingSet(dataframe_filename).save({
+        'label_df': label_df,
+        'processed_label_df': label_df,
+        'numeric_df': numeric_df,
+        'x': x,
+        'x_min': x_min,
+        'x_max': x_max
+    })
+    rds.set_value(f'{redis_prefix}_dataframe_filename', dataframe_filename.encode('utf-8'), redis_hash_name)
+    rds.set_value(f'{redis_prefix}_results_filename', os.path.join(data_dir, 'results.h5').encode('utf-8'),
+                  redis_hash_name)
+    rds.set_value(f'{redis_prefix}_loaded_collection_ids', msgpack.dumps(collection_ids), redis_hash_name)
+    set_progress(n_steps, f'Loaded collections {", ".join(str(collection_id) for collection_id in collection_ids)}')
+    return collection_ids
+
@@ -4,13 +4,14 @@ from flask import url_for
 
 from dashboards import Dashboard
 import itertools
+import dash
 import dash_bootstrap_components as dbc
 import dash_html_components as html
 
 from dash.dependencies import Output, Input, State
 from dash.exceptions import PreventUpdate
 
-from dashboards.dashboard import StyledDash
+from dashboards.dashboard import StyledDash, COLLECTION_LOAD_OUTPUTS
 from dashboards.nmr_metabolomics.collection_editor.layouts import get_layout
 from dashboards.nmr_metabolomics.collection_editor.model import CollectionEditorModel
 
@@ -61,15 +62,16 @@ class CollectionEditorDashboard(Dashboard):
              Output('name-input', 'value'),
              Output('analysis-select', 'value'),
              Output('loaded-collections', 'children'),
-             Output('collections-label', 'children')],
-            [Input('get-collection', 'n_clicks')],
+             Output('collections-label', 'children')] + COLLECTION_LOAD_OUTPUTS,
+            [Input('get-collection', 'n_clicks'),
+             Input('collection-load-interval', 'n_intervals')],
             [State('collection-id', 'value')],
         )
-        def get_collections(n_clicks, collection_id):
-            if not collection_id or not n_clicks:
-                raise PreventUpdate('Callback triggered without value')
+        def get_collections(n_clicks, n_intervals, collection_id):
             editor_data = CollectionEditorModel()
-            editor_data.get_collections(collection_id)
+            loaded, load_outputs = CollectionEditorDashboard.load_collections(editor_data, n_clicks, collection_id)
+            if not loaded:
+                return (dash.no_update,) * 10 + load_outputs
             join_disabled = editor_data.collection_count != 2
             label_data = editor_data.get_label_data()
             name = editor_data.proposed_name(None, None)
@@ -89,7 +91,7 @@ class CollectionEditorDashboard(Dashboard):
                 editor_data.analysis_ids,
                 editor_data.get_collection_badges(),
                 editor_data.get_collection_load_info()
-            )
+            ) + load_outputs
 
         @app.callback([Output('name-input-wrapper', 'children')],
                       [Input('filter-by-value', 'value')],
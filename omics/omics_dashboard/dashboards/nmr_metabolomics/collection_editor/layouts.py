@@ -3,6 +3,7 @@ import dash_core_components as dcc
 import dash_html_components as html
 from flask_login import current_user
 
+from dashboards.dashboard import get_collection_load_progress_div
 from dashboards.nmr_metabolomics.collection_editor.model import CollectionEditorModel
 from data_tools.wrappers.analyses import get_analyses
 from data_tools.wrappers.collections import get_collections
@@ -68,7 +69,8 @@ def get_options_form():
                                                 ], id='loaded-display'
                                             )
                                         ]
-                                    )
+                                    ),
+                                    get_collection_load_progress_div()
                                 ]
                             )
                         ]
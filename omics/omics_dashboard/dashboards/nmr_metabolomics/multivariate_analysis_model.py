@@ -1,7 +1,8 @@
 import itertools
+import json
 import os
 import time as tm
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Union, Tuple
 
 import dash_bootstrap_components as dbc
 import dash_html_components as html
@@ -18,6 +19,11 @@ from dashboards.dashboard_model import DashboardModel
 class MultivariateAnalysisModel(DashboardModel):
     redis_prefix = ''
     _empty_plot_data = {}
+    _dataframe_keys = ['label_df', 'processed_label_df', 'numeric_df', 'x', 'x_min', 'x_max']
+    _label_keys = ['label_df', 'processed_label_df']
+    # the last result of preprocess, kept in the working set
+    _preprocessing_keys = ['preprocessing_key', 'preprocessed_label_df', 'preprocessed_numeric_df',
+                           'preprocessed_model_label_df', 'preprocessed_good_x_inds', 'preprocessed_warnings']
 
     def __init__(self, load_data=False):
         super().__init__(load_data)
@@ -69,7 +75,8 @@ class MultivariateAnalysisModel(DashboardModel):
         self._dataframe_filename = data_frame_filename.decode('utf-8') if data_frame_filename is not None else None
         results_filename = rds.get_value(f'{self.redis_prefix}_results_filename')
         self._results_filename = results_filename.decode('utf-8') if results_filename is not None else None
-        if not self._dataframe_filename or not os.path.isfile(self._dataframe_filename):
+        if not self._dataframe_filename or not os.path.isfile(self._dataframe_filename) \
+                or not self._dataframe_filename.endswith('.json'):  # sessions from before working sets
             rds.delete_value(f'{self.redis_prefix}_dataframe_filename')
             rds.delete_value(f'{self.redis_prefix}_results_filename')
             self._dataframe_filename = None
@@ -84,41 +91,6 @@ class MultivariateAnalysisModel(DashboardModel):
         rds.set_value(f'{self.redis_prefix}_results_filename', self._results_filename.encode('utf-8'))
         rds.set_value(f'{self.redis_prefix}_loaded_collection_ids', msgpack.dumps(self._loaded_collection_ids))
 
-    def load_dataframes(self):
-        self._label_df = pd.read_hdf(self._dataframe_filename, 'label_df')
-        self._processed_label_df = pd.read_hdf(self._dataframe_filename, 'processed_label_df')
-        self._numeric_df = pd.read_hdf(self._dataframe_filename, 'numeric_df')
-        with h5py.File(self._dataframe_filename, 'r') as file:
-            self._x = np.array(file['x']) if 'x' in file else None
-            self._x_min = np.array(file['x_min']) if 'x_min' in file else None
-            self._x_max = np.array(file['x_max']) if 'x_max' in file else None
-
-    def save_dataframes(self):
-        self._label_df.to_hdf(self._dataframe_filename, 'label_df', mode='a')
-        self._processed_label_df.to_hdf(self._dataframe_filename, 'processed_label_df', mode='a')
-        self._numeric_df.to_hdf(self._dataframe_filename, 'numeric_df', mode='a')
-        with h5py.File(self._dataframe_filename, 'r+') as file:
-            if self._x is not None:
-                if 'x' in file:
-                    del file['x']
-                file['x'] = self._x
-            if self._x_min is not None:
-                if 'x_min' in file:
-                    del file['x_min']
-                file['x_min'] = self._x_min
-            if self._x_max is not None:
-                if 'x_max' in file:
-                    del file['x_max']
-                file['x_max'] = self._x_max
-
-    def load_labels(self):
-        self._label_df = pd.read_hdf(self._dataframe_filename, 'label_df')
-        self._processed_label_df = pd.read_hdf(self._dataframe_filename, 'processed_label_df')
-
-    def save_labels(self):
-        self._label_df.to_hdf(self._dataframe_filename, 'label_df', mode='a')
-        self._processed_label_df.to_hdf(self._dataframe_filename, 'processed_label_df', mode='a')
-
     def load_results(self):
         with h5py.File(self._results_filename, 'r') as file:
             self._x = np.array(file['x'])
@@ -163,26 +135,39 @@ class MultivariateAnalysisModel(DashboardModel):
         raise NotImplementedError()
 
     def get_collections(self, collection_ids: Union[List[int], int]):
-        super().get_collections(collection_ids)
+        job = super().get_collections(collection_ids)
         self.clear_plot_data()
+        return job
 
     def fit(self, numeric_df, model_numeric_df, model_label_df, **kwargs):
         raise NotImplementedError()
 
-    def perform_analysis(self,
-                         model_by: str = None,
-                         ignore_by: str = None,
-                         scale_by: str = None,
-                         pair_on: List[str] = None,
-                         pair_with: str = None,
-                         project_by: str = None,
-                         **kwargs) -> (str, str, str):
-        data_load_start = tm.time()
-        self.load_dataframes()
-        label_df = self._label_df
-        numeric_df = self._numeric_df
-        data_load_end = tm.time()
+    def fits_in_batches(self, **kwargs) -> bool:
+        """
+        Whether fit reads the records to fit from numeric_df in batches. If it does, model_numeric_df is not copied out
+        of numeric_df and fit is passed None instead.
+        :param kwargs: The keyword arguments of fit
+        :return:
+        """
+        return False
 
+    @staticmethod
+    def preprocess_dataframes(label_df: pd.DataFrame,
+                              numeric_df: pd.DataFrame,
+                              model_by: str = None,
+                              ignore_by: str = None,
+                              scale_by: str = None,
+                              pair_on: List[str] = None,
+                              pair_with: str = None,
+                              project_by: str = None) \
+            -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame, np.array, List[str]]:
+        """
+        Scale, pair and filter records before fitting a model. See perform_analysis for the parameters.
+        :param label_df:
+        :param numeric_df:
+        :return: The labels and values of the records to transform, the labels and values of the records to fit, the
+        indices of the columns kept and warnings about records left out
+        """
         if model_by == 'index':
             model_by = None
 
@@ -196,9 +181,9 @@ class MultivariateAnalysisModel(DashboardModel):
             numeric_df = numeric_df.loc[label_df.index]
 
         warnings = []
-        message_color = 'success'
 
         if pair_on and pair_with:
+            numeric_df = numeric_df.copy()  # numeric_df may be shared with other models through the working set cache
             good_queries = []
             for vals, idx, in label_df.groupby(pair_on).groups.items():
                 # find the pair conditions in the sub dataframe
@@ -215,7 +200,6 @@ class MultivariateAnalysisModel(DashboardModel):
                                                for pair_on_i, vals_i in zip(pair_on, vals)]))
                     good_queries.append(
                         ' & '.join([f'{pair_on_i}!="{vals_i}"' for pair_on_i, vals_i in zip(pair_on, vals)]))
-                    message_color = 'warning'
             if len(good_queries):
                 query = ' & '.join(good_queries)
                 label_df = label_df.query(query)
@@ -238,10 +222,73 @@ class MultivariateAnalysisModel(DashboardModel):
             model_label_df = label_df
             model_numeric_df = numeric_df
 
-        self._good_x_inds = np.where(model_numeric_df.isnull().sum() == 0)[0]
-        good_columns = model_numeric_df.columns[self._good_x_inds]
+        good_x_inds = np.where(model_numeric_df.isnull().sum() == 0)[0]
+        good_columns = model_numeric_df.columns[good_x_inds]
         model_numeric_df = model_numeric_df[good_columns]
         numeric_df = numeric_df[good_columns]
+        return label_df, numeric_df, model_label_df, model_numeric_df, good_x_inds, warnings
+
+    def preprocess(self,
+                   model_by: str = None,
+                   ignore_by: str = None,
+                   scale_by: str = None,
+                   pair_on: List[str] = None,
+                   pair_with: str = None,
+                   project_by: str = None,
+                   include_model_numeric_df: bool = True) \
+            -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame, np.array, List[str]]:
+        """
+        Run preprocess_dataframes on the loaded dataframes. The result is kept in the working set, keyed on the loaded
+        collections and the parameters, so fitting again with the same parameters does not preprocess again. Only the
+        last result is kept. load_dataframes must be called first.
+        :param include_model_numeric_df: Whether to copy the records to fit out of numeric_df. If False, None is
+        returned in place of model_numeric_df.
+        :return: See preprocess_dataframes. numeric_df is read from the working set, so numeric values are memory-mapped.
+        """
+        key = json.dumps([self._loaded_collection_ids, model_by, ignore_by, scale_by, pair_on, pair_with, project_by])
+        cached = self.working_set.load(self._preprocessing_keys)
+        if cached['preprocessing_key'] is None or cached['preprocessing_key'][0] != key:
+            label_df, numeric_df, model_label_df, _, good_x_inds, warnings = self.preprocess_dataframes(
+                self._label_df, self._numeric_df, model_by, ignore_by, scale_by, pair_on, pair_with, project_by
+            )
+            # model_numeric_df is left out because it is the model_label_df rows of numeric_df
+            self.working_set.save({
+                'preprocessing_key': np.array([key]),
+                'preprocessed_label_df': label_df,
+                'preprocessed_numeric_df': numeric_df,
+                'preprocessed_model_label_df': model_label_df,
+                'preprocessed_good_x_inds': good_x_inds,
+                'preprocessed_warnings': np.array(warnings, dtype=str)
+            })
+            # read back from the working set so that the preprocessed values are not held in memory
+            cached = self.working_set.load(self._preprocessing_keys)
+        label_df = cached['preprocessed_label_df']
+        numeric_df = cached['preprocessed_numeric_df']
+        model_label_df = cached['preprocessed_model_label_df']
+        model_numeric_df = numeric_df.loc[model_label_df.index] if include_model_numeric_df else None
+        return (label_df, numeric_df, model_label_df, model_numeric_df,
+                cached['preprocessed_good_x_inds'], [str(warning) for warning in cached['preprocessed_warnings']])
+
+    def perform_analysis(self,
+                         model_by: str = None,
+                         ignore_by: str = None,
+                         scale_by: str = None,
+                         pair_on: List[str] = None,
+                         pair_with: str = None,
+                         project_by: str = None,
+                         **kwargs) -> (str, str, str):
+        data_load_start = tm.time()
+        self.load_dataframes()
+        data_load_end = tm.time()
+
+        if model_by == 'index':
+            model_by = None
+
+        label_df, numeric_df, model_label_df, model_numeric_df, self._good_x_inds, warnings = self.preprocess(
+            model_by, ignore_by, scale_by, pair_on, pair_with, project_by,
+            include_model_numeric_df=not self.fits_in_batches(**kwargs)
+        )
+        message_color = 'warning' if len(warnings) else 'success'
         self._x = self._x[:, self._good_x_inds]
         self._x_min = self._x_min[:, self._good_x_inds] if self._x_min is not None else None
         self._x_max = self._x_max[:, self._good_x_inds] if self._x_max is not None else None
@@ -273,7 +320,7 @@ class MultivariateAnalysisModel(DashboardModel):
         start_time = tm.time()
         self.fit(numeric_df, model_numeric_df, model_label_df, **kwargs)
         end_time = tm.time()
-        self.save_dataframes()
+        self.save_working_set(['processed_label_df', 'x', 'x_min', 'x_max'])
         self.save_results()
         self.set_file_metadata(metadata)
         save_end_time = tm.time()
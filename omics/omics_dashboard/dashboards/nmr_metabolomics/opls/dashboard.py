@@ -1,6 +1,7 @@
 import itertools
 import traceback
 
+import dash
 import dash_bootstrap_components as dbc
 import dash_html_components as html
 from dash.dependencies import Output, Input, State
@@ -8,7 +9,7 @@ from dash.exceptions import PreventUpdate
 from flask import url_for
 from rq.job import Job
 
-from dashboards.dashboard import Dashboard, StyledDash, get_plot_theme
+from dashboards.dashboard import Dashboard, StyledDash, get_plot_theme, COLLECTION_LOAD_OUTPUTS
 from helpers import log_internal_exception
 from .layouts import get_layout
 from .model import OPLSModel
@@ -75,14 +76,16 @@ class OPLSDashboard(Dashboard):
              Output('pair-with', 'options'),
              Output('target-variable', 'options'),
              Output('loaded-collections', 'children'),
-             Output('collections-label', 'children')],
-            [Input('get-collection', 'n_clicks')],
+             Output('collections-label', 'children')] + COLLECTION_LOAD_OUTPUTS,
+            [Input('get-collection', 'n_clicks'),
+             Input('collection-load-interval', 'n_intervals')],
             [State('collection-id', 'value')],
         )
-        def get_collections(n_clicks, value):
-            OPLSDashboard.check_clicks(n_clicks)
+        def get_collections(n_clicks, n_intervals, value):
             opls_data = OPLSModel()
-            opls_data.get_collections(value)
+            loaded, load_outputs = OPLSDashboard.load_collections(opls_data, n_clicks, value)
+            if not loaded:
+                return (dash.no_update,) * 8 + load_outputs
             label_data = opls_data.get_label_data()
             label_data_with_type = opls_data.get_label_data(with_type=True)
             return (
@@ -94,7 +97,7 @@ class OPLSDashboard(Dashboard):
                 label_data_with_type,
                 opls_data.get_collection_badges(),
                 opls_data.get_collection_load_info()
-            )
+            ) + load_outputs
 
         @app.callback(
             [Output('loaded-results-collection', 'children')],
@@ -125,7 +128,8 @@ class OPLSDashboard(Dashboard):
              State('outer-test-alpha', 'value'),
              State('permutations', 'value'),
              State('inner-permutations', 'value'),
-             State('outer-permutations', 'value')]
+             State('outer-permutations', 'value'),
+             State('sequential-h', 'value')]
         )
         def perform_opls(n_clicks,
                          scale_by_queries,
@@ -141,7 +145,8 @@ class OPLSDashboard(Dashboard):
                          outer_test_alpha,
                          permutations,
                          inner_permutations,
-                         outer_permutations):
+                         outer_permutations,
+                         sequential_h):
             OPLSDashboard.check_clicks(n_clicks)
             scale_by = ' | '.join(scale_by_queries) if scale_by_queries and len(scale_by_queries) else None
             model_by = ' | '.join(model_by_queries) if model_by_queries and len(model_by_queries) else None
@@ -167,7 +172,8 @@ class OPLSDashboard(Dashboard):
                                                                     outer_test_alpha,
                                                                     permutations,
                                                                     inner_permutations,
-                                                                    outer_permutations)
+                                                                    outer_permutations,
+                                                                    sequential_h)
                 badges = opls_data.get_results_collection_badges()
             except Exception as e:
                 log_internal_exception(e)
@@ -201,6 +207,33 @@ class OPLSDashboard(Dashboard):
                 log_internal_exception(e)
                 return [dbc.Card(dbc.CardBody([html.H6('Error occurred.'), html.Code(traceback.format_exc())]))]
 
+        @app.callback([Output('loading-significance-form', 'style'),
+                       Output('loading-group', 'options')],
+                      [Input('results-tabs', 'active_tab')])
+        def show_loading_significance_form(at):
+            if at != 'feature-significance-tab':
+                return [{'display': 'none'}, dash.no_update]
+            return [{}, OPLSModel().get_group_options()]
+
+        @app.callback([Output('loading-bin', 'options')],
+                      [Input('loading-group', 'value')])
+        def update_bin_options(group_key):
+            if group_key is None:
+                raise PreventUpdate('Callback triggered without action!')
+            return [OPLSModel().get_bin_options(group_key)]
+
+        @app.callback([Output('loading-significance-plot', 'children')],
+                      [Input('loading-bin', 'value')],
+                      [State('loading-group', 'value')])
+        def update_loading_significance_plot(feature_ind, group_key):
+            if feature_ind is None or group_key is None:
+                raise PreventUpdate('Callback triggered without action!')
+            try:
+                return [OPLSModel().get_loading_significance_plot(group_key, feature_ind, get_plot_theme())]
+            except Exception as e:
+                log_internal_exception(e)
+                return [html.Div([html.H6('Error occurred.'), html.Code(traceback.format_exc())])]
+
         @app.callback(
             [Output('width-input', 'value'),
              Output('height-input', 'value'),
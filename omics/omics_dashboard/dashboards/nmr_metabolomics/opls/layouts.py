@@ -3,6 +3,7 @@ import dash_core_components as dcc
 import dash_html_components as html
 from flask_login import current_user
 
+from dashboards.dashboard import get_collection_load_progress_div
 from data_tools.wrappers.analyses import get_analyses
 from data_tools.wrappers.collections import get_collections
 from .model import OPLSModel
@@ -352,7 +353,8 @@ def get_opls_options_form():
                                                 ], id='loaded-display'
                                             )
                                         ]
-                                    )
+                                    ),
+                                    get_collection_load_progress_div()
                                 ]
                             )
                         ]
@@ -557,6 +559,25 @@ def get_opls_options_form():
                                 ]
                             )
                         ]
+                    ),
+                    dbc.Col(
+                        [
+                            dbc.FormGroup(
+                                [
+                                    dbc.Label(
+                                        [
+                                            'Early stopping h',
+                                            html.Abbr('\uFE56',
+                                                      title='If set, each permutation test stops once this many '
+                                                            'permutations are at least as extreme as the real data, so '
+                                                            'clearly insignificant metrics and features use fewer '
+                                                            'permutations. The permutation counts become maxima. Leave '
+                                                            'blank to run every permutation.')
+                                        ], html_for='sequential-h'),
+                                    dbc.Input(id='sequential-h', type='number', min=1, step=1)
+                                ]
+                            )
+                        ]
                     )
                 ]
             ),
@@ -722,6 +743,41 @@ def get_opls_options_form():
     )
 
 
+def get_loading_significance_form():
+    return dbc.CardBody(
+        [
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            dbc.FormGroup(
+                                [
+                                    dbc.Label('Model', html_for='loading-group'),
+                                    dcc.Dropdown(id='loading-group', multi=False)
+                                ]
+                            )
+                        ]
+                    ),
+                    dbc.Col(
+                        [
+                            dbc.FormGroup(
+                                [
+                                    dbc.Label(['Bin', html.Abbr('\uFE56',
+                                                                title='Plot the loadings of the permutations of this '
+                                                                      'bin. Significant bins are listed first.')],
+                                              html_for='loading-bin'),
+                                    dcc.Dropdown(id='loading-bin', multi=False)
+                                ]
+                            )
+                        ]
+                    )
+                ]
+            ),
+            dcc.Loading(html.Div(id='loading-significance-plot'))
+        ]
+    )
+
+
 def get_results_form():
     # check if results are loaded
     return [
@@ -737,7 +793,8 @@ def get_results_form():
                 ),
             ]
         ),
-        dcc.Loading(dbc.CardBody(id='results-content'))
+        dcc.Loading(dbc.CardBody(id='results-content')),
+        html.Div(get_loading_significance_form(), id='loading-significance-form', style={'display': 'none'})
     ]
 
 
@@ -23,6 +23,7 @@ from sklearn.utils.multiclass import type_of_target
 
 import config.redis_config as rds
 from dashboards.dashboard_model import save_figures
+from data_tools.file_tools.metadata_tools import FileCache
 from data_tools.wrappers.collections import get_collection, create_collection
 from data_tools.wrappers.jobserver_control import start_job
 from config.config import TMPDIR
@@ -36,6 +37,8 @@ class OPLSModel(MultivariateAnalysisModel):
         'score_plots': [],
     }
     redis_prefix = 'opls'
+    # permuted loadings and their KDEs for the features viewed, shared by the models of this process
+    _loading_significance_cache = FileCache(256)
 
     def __init__(self, load_data=False):
         # any of these can be None
@@ -84,14 +87,16 @@ class OPLSModel(MultivariateAnalysisModel):
     def results_file_ready(self):
         if self.results_collection_id is not None:
             try:
-                return len(h5py.File(self.results_filename).keys()) > 0
+                with h5py.File(self.results_filename, 'r') as file:
+                    return len(file.keys()) > 0
             except:
                 return False
 
     def get_collections(self, collection_ids: Union[List[int], int]):
-        super().get_collections(collection_ids)
+        job = super().get_collections(collection_ids)
         self.job_id = None
         self.results_collection_id = None
+        return job
 
     def get_results_collection(self, collection_id):
         self.results_collection_id = collection_id
@@ -338,7 +343,8 @@ class OPLSModel(MultivariateAnalysisModel):
                    outer_alpha=0.01,
                    permutations=None,
                    inner_permutations=None,
-                   outer_permutations=None):
+                   outer_permutations=None,
+                   sequential_h=None):
         multiclass_behavior = multiclass_behavior or []
         force_regression = regression_type and regression_type.startswith('regression')
         name = self.redis_prefix.upper()
@@ -356,6 +362,12 @@ class OPLSModel(MultivariateAnalysisModel):
         if pair_on and pair_with:
             description += f' paired on {pair_on} against {pair_with}'
 
+        # check the queries before submitting the job. The workflow preprocesses its own copy of the collection.
+        self.load_dataframes()
+        _, _, model_label_df, _, _, warnings = self.preprocess(model_by, ignore_by, scale_by, pair_on, pair_with)
+        if not len(model_label_df):
+            raise ValueError('No records satisfy the model conditions.')
+
         collection_metadata = {
             'name': name,
             'description': description,
@@ -389,11 +401,17 @@ class OPLSModel(MultivariateAnalysisModel):
             'one_v_one': 'one_v_one' in multiclass_behavior,
             'one_v_all': 'one_v_all' in multiclass_behavior,
             'results_collection_id': self.results_collection_id,
-            'force_regression': force_regression
+            'force_regression': force_regression,
+            'sequential_h': sequential_h or None
         }
         job = start_job(workflow, job_params, current_user, 'analysis')
         self.job_id = job.id
-        message_children = [
+        message_children = []
+        if len(warnings):
+            message_children += [html.Strong('Warning:'), html.Br()]
+            for warning in warnings:
+                message_children += [warning, html.Br()]
+        message_children += [
             html.Strong('Job submitted.'),
             html.Br(),
             html.Strong('Job: '), html.A(f'{job.id}', href=get_item_link(job), target='_blank'),
@@ -402,15 +420,16 @@ class OPLSModel(MultivariateAnalysisModel):
                                                         href=get_item_link(results_collection),
                                                         target='_blank')
         ]
-        return html.P(message_children), name, 'success'
+        return html.P(message_children), name, 'warning' if len(warnings) else 'success'
 
     def type_of_target_(self, target):
         self.load_dataframes()
         return type_of_target(self._label_df[target])
 
-    def get_summary_table(self, group_key, theme=None):
-        is_discrimination = 'accuracy' in h5py.File(self.results_filename)[group_key].attrs
-        description = h5py.File(self.results_filename)[group_key].attrs['description']
+    def get_summary_table(self, group: h5py.Group, theme=None):
+        group_key = os.path.basename(group.name)
+        is_discrimination = 'accuracy' in group.attrs
+        description = group.attrs['description']
         theme, style_header, style_cell = self._get_table_styles(theme)
 
         index = [
@@ -429,36 +448,35 @@ class OPLSModel(MultivariateAnalysisModel):
                 'Negative Value'
             ]
 
-        with h5py.File(self.results_filename, 'r') as file:
-            metric_values = [
-                file[group_key].attrs['n_components'],
-                f"{file[group_key].attrs['r_squared_Y']:.7f}",
-                f"{file[group_key].attrs['r_squared_X']:.7f}",
-                f"{file[group_key].attrs['q_squared']:.7f}"
+        metric_values = [
+            group.attrs['n_components'],
+            f"{group.attrs['r_squared_Y']:.7f}",
+            f"{group.attrs['r_squared_X']:.7f}",
+            f"{group.attrs['q_squared']:.7f}"
+        ]
+        metric_p_values = [
+            None,
+            None,
+            None,
+            f"{group.attrs['q_squared_p_value']:.7f}"
+        ]
+        if is_discrimination:
+            metric_values += [
+                f"{group.attrs['discriminant_r_squared']:.7f}",
+                f"{group.attrs['discriminant_q_squared']:.7f}",
+                f"{group.attrs['accuracy']:.7f}",
+                f"{group.attrs['roc_auc']:.7f}",
+                group.attrs['pos_label'],
+                group.attrs['neg_label']
             ]
-            metric_p_values = [
-                None,
+            metric_p_values += [
                 None,
+                f"{group.attrs['discriminant_q_squared_p_value']:.7f}",
+                f"{group.attrs['accuracy_p_value']:.7f}",
+                f"{group.attrs['roc_auc_p_value']:.7f}",
                 None,
-                f"{file[group_key].attrs['q_squared_p_value']:.7f}"
+                None
             ]
-            if is_discrimination:
-                metric_values += [
-                    f"{file[group_key].attrs['discriminant_r_squared']:.7f}",
-                    f"{file[group_key].attrs['discriminant_q_squared']:.7f}",
-                    f"{file[group_key].attrs['accuracy']:.7f}",
-                    f"{file[group_key].attrs['roc_auc']:.7f}",
-                    file[group_key].attrs['pos_label'],
-                    file[group_key].attrs['neg_label']
-                ]
-                metric_p_values += [
-                    None,
-                    f"{file[group_key].attrs['discriminant_q_squared_p_value']:.7f}",
-                    f"{file[group_key].attrs['accuracy_p_value']:.7f}",
-                    f"{file[group_key].attrs['roc_auc_p_value']:.7f}",
-                    None,
-                    None
-                ]
 
         df = pd.DataFrame(index=index)
         df['Metric'] = index
@@ -488,14 +506,15 @@ class OPLSModel(MultivariateAnalysisModel):
 
     def get_summary_tables(self, theme=None):
         if self.results_file_ready:
-            return [self.get_summary_table(key, theme) for key in h5py.File(self.results_filename).keys()]
+            with h5py.File(self.results_filename, 'r') as file:
+                return [self.get_summary_table(group, theme) for group in file.values()]
         else:
             return html.H6('Analysis results not ready.')
 
-    def get_quality_plot(self, group_key, theme=None, wrap=True):
+    def get_quality_plot(self, group: h5py.Group, theme=None, wrap=True):
         """ This gets the bar plot and the scores plot"""
-        is_discrimination = 'accuracy' in h5py.File(self.results_filename)[group_key].attrs
-        description = h5py.File(self.results_filename)[group_key].attrs['description']
+        is_discrimination = 'accuracy' in group.attrs
+        description = group.attrs['description']
         theme = theme or 'plotly_white'
 
         labels = [
@@ -521,19 +540,18 @@ class OPLSModel(MultivariateAnalysisModel):
                 DEFAULT_PLOTLY_COLORS[1],
                 DEFAULT_PLOTLY_COLORS[1]
             ]
-        with h5py.File(self.results_filename, 'r') as file:
-            values = [
-                file[group_key].attrs['r_squared_Y'],
-                file[group_key].attrs['r_squared_X'],
-                file[group_key].attrs['q_squared']
+        values = [
+            group.attrs['r_squared_Y'],
+            group.attrs['r_squared_X'],
+            group.attrs['q_squared']
+        ]
+        if is_discrimination:
+            values += [
+                group.attrs['discriminant_r_squared'],
+                group.attrs['discriminant_q_squared'],
+                group.attrs['accuracy'],
+                group.attrs['roc_auc']
             ]
-            if is_discrimination:
-                values += [
-                    file[group_key].attrs['discriminant_r_squared'],
-                    file[group_key].attrs['discriminant_q_squared'],
-                    file[group_key].attrs['accuracy'],
-                    file[group_key].attrs['roc_auc']
-                ]
 
         axis_line_style = {
             'zerolinecolor': '#375A7F',  # darkly primary
@@ -564,14 +582,13 @@ class OPLSModel(MultivariateAnalysisModel):
             )
         )
 
-        with h5py.File(self.results_filename, 'r') as file:
-            t = np.array(file[group_key]['pls']['x_scores'])
-            t_ortho = np.array(file[group_key]['opls']['T_ortho'][:, 0])
-            target = np.ravel(np.array(file[group_key]['target']))
-            if np.issubdtype(target.dtype, np.object_):
-                target = target.astype(str)
-            if type_of_target(np.ravel(target)).startswith('binary'):
-                target = target.astype(str)
+        t = np.array(group['pls']['x_scores'])
+        t_ortho = np.array(group['opls']['T_ortho'][:, 0])
+        target = np.ravel(np.array(group['target']))
+        if np.issubdtype(target.dtype, np.object_):
+            target = target.astype(str)
+        if type_of_target(np.ravel(target)).startswith('binary'):
+            target = target.astype(str)
 
         if type_of_target(target).startswith('binary'):
             score_plot_data = [
@@ -630,52 +647,59 @@ class OPLSModel(MultivariateAnalysisModel):
 
     def get_quality_plots(self, theme=None, wrap=True):
         if self.results_file_ready:
-            return [self.get_quality_plot(key, theme, wrap) for key in h5py.File(self.results_filename).keys()]
+            with h5py.File(self.results_filename, 'r') as file:
+                return [self.get_quality_plot(group, theme, wrap) for group in file.values()]
         else:
             return html.H6('Analysis results not ready.')
 
-    def get_metric_kde_plot(self, group_key, theme=None, wrap=True):
-        is_discrimination = 'accuracy' in h5py.File(self.results_filename)[group_key].attrs
-        description = h5py.File(self.results_filename)[group_key].attrs['description']
+    def get_metric_kde_plot(self, group: h5py.Group, theme=None, wrap=True):
+        is_discrimination = 'accuracy' in group.attrs
+        description = group.attrs['description']
 
+        metrics = [
+            'q_squared'
+        ]
         labels = [
             'Q\u00B2Y',
         ]
 
         if is_discrimination:
+            metrics += [
+                'discriminant_q_squared',
+                'accuracy',
+                'roc_auc'
+            ]
             labels += [
-                'DR\u00B2Y',
                 'DQ\u00B2Y',
                 'Accuracy',
                 'ROC AUC'
             ]
 
-        with h5py.File(self.results_filename, 'r') as file:
-            true_values = [
-                file[group_key].attrs['q_squared']
+        true_values = [
+            group.attrs['q_squared']
+        ]
+        p_values = [
+            group.attrs['q_squared_p_value']
+        ]
+        permutation_values = [
+            np.array(group['permutation_q_squared'])
+        ]
+        if is_discrimination:
+            true_values += [
+                group.attrs['discriminant_q_squared'],
+                group.attrs['accuracy'],
+                group.attrs['roc_auc']
             ]
-            p_values = [
-                file[group_key].attrs['q_squared_p_value']
+            p_values += [
+                group.attrs['discriminant_q_squared_p_value'],
+                group.attrs['accuracy_p_value'],
+                group.attrs['roc_auc_p_value']
             ]
-            permutation_values = [
-                np.array(file[group_key]['permutation_q_squared'])
+            permutation_values += [
+                np.array(group['permutation_discriminant_q_squared']),
+                np.array(group['permutation_accuracy']),
+                np.array(group['permutation_roc_auc'])
             ]
-            if is_discrimination:
-                true_values += [
-                    file[group_key].attrs['discriminant_q_squared'],
-                    file[group_key].attrs['accuracy'],
-                    file[group_key].attrs['roc_auc']
-                ]
-                p_values += [
-                    file[group_key].attrs['discriminant_q_squared_p_value'],
-                    file[group_key].attrs['accuracy_p_value'],
-                    file[group_key].attrs['roc_auc_p_value']
-                ]
-                permutation_values += [
-                    np.array(file[group_key]['permutation_discriminant_q_squared']),
-                    np.array(file[group_key]['permutation_accuracy']),
-                    np.array(file[group_key]['permutation_roc_auc'])
-                ]
         graphs = []
         theme = theme or 'plotly_white'
         axis_line_style = {
@@ -685,11 +709,9 @@ class OPLSModel(MultivariateAnalysisModel):
             'zerolinecolor': '#2C3E50',  # flatly primary
             'gridcolor': '#95A5A6'  # flatly secondary
         }
-        for label, true_value, permutation_value, p_value in zip(labels, true_values, permutation_values, p_values):
-            try:    
-                x, y, true_kde = self._get_kde(permutation_value, true_value)
-            except np.linalg.LinAlgError:
-                x = y = true_kde = None
+        for metric, label, true_value, permutation_value, p_value in zip(metrics, labels, true_values,
+                                                                         permutation_values, p_values):
+            x, y, true_kde = self._read_metric_kde(group, metric, permutation_value, true_value)
             point_plot = go.Scatter(
                 x=np.ravel(permutation_value),
                 y=[0 for _ in range(permutation_value.size)],
@@ -757,7 +779,8 @@ class OPLSModel(MultivariateAnalysisModel):
 
     def get_metric_kde_plots(self, theme, wrap=True):
         if self.results_file_ready:
-            return [self.get_metric_kde_plot(key, theme, wrap) for key in h5py.File(self.results_filename).keys()]
+            with h5py.File(self.results_filename, 'r') as file:
+                return [self.get_metric_kde_plot(group, theme, wrap) for group in file.values()]
         else:
             return html.H6('Analysis results not ready.')
 
@@ -784,6 +807,27 @@ class OPLSModel(MultivariateAnalysisModel):
         except:
             return []
 
+    @staticmethod
+    def _read_metric_kde(group: h5py.Group, metric, permutation_value, true_value):
+        """
+        Read the KDE of the permuted values of a metric written by perform_opls.py, or compute it for results files
+        written before KDEs were stored
+        :param group:
+        :param metric:
+        :param permutation_value:
+        :param true_value:
+        :return: The grid, the density on the grid and the density at true_value, all None if the KDE is undefined
+        """
+        if 'kde' in group and metric in group['kde']:
+            x = np.array(group['kde'][metric]['x'])
+            y = np.array(group['kde'][metric]['density'])
+            true_kde = group['kde'][metric].attrs['true_density']
+            return (x, y, true_kde) if x.size else (None, None, None)
+        try:
+            return OPLSModel._get_kde(permutation_value, true_value)
+        except np.linalg.LinAlgError:
+            return None, None, None
+
     @staticmethod
     def _get_kde(arr, true_value):
         arr_range = arr.max() - arr.min()
@@ -792,26 +836,38 @@ class OPLSModel(MultivariateAnalysisModel):
         # noinspection PyArgumentList
         return x, kernel(x), kernel(true_value).item()
 
-    def _get_loading_kde(self, group_key, feature_ind):
-        with h5py.File(self.results_filename, 'r') as file:
-            loadings = np.array(file[group_key]['permutation_loadings'][:, feature_ind])
-            true_loading = np.ravel(file[group_key]['opls']['x_loadings'])[feature_ind]
-        return self._get_kde(loadings, true_loading)
-
-    def get_loading_significance_plot(self, group_key, feature_ind, theme=None):
+    @staticmethod
+    def _read_loading_significance(filename, group_key, feature_ind):
+        """
+        Read the values for the loading significance plot of one feature. Only the column of permutation_loadings for
+        the feature is read.
+        :param filename:
+        :param group_key:
+        :param feature_ind:
+        :return: The label, loading and p-value of the feature, its permuted loadings and their KDE
+        """
+        with h5py.File(filename, 'r') as file:
+            group = file[group_key]
+            loadings = group['permutation_loadings'][:, feature_ind]
+            true_value = np.ravel(group['pls']['x_loadings'][feature_ind])[0]
+            p_value = group['feature_p_values'][feature_ind]
+            feature_label = group['feature_labels'][feature_ind]
+        # sequential tests leave nan after the last permutation of a feature
+        loadings = loadings[~np.isnan(loadings)]
         try:
-            x, y, true_kde = self._get_loading_kde(group_key, feature_ind)
-        except np.linalg.LinAlgError:
+            x, y, true_kde = OPLSModel._get_kde(loadings, true_value)
+        except (np.linalg.LinAlgError, ValueError):
             x = y = true_kde = None
-        with h5py.File(self.results_filename, 'r') as file:
-            true_value = np.ravel(file[group_key]['opls']['x_loadings'])[feature_ind]
-            p_value = np.ravel(file[group_key]['feature_p_values'])[feature_ind]
-            permutation_loadings = np.array(file[group_key]['permutation_loadings'])
-            feature_labels = np.array(file[group_key]['feature_labels'])
-        title = f'{feature_labels[feature_ind]} Loading={true_value} (p={p_value})'
+        return feature_label, true_value, p_value, loadings, x, y, true_kde
+
+    def get_loading_significance_plot(self, group_key, feature_ind, theme=None):
+        feature_label, true_value, p_value, loadings, x, y, true_kde = self._loading_significance_cache.get(
+            self._read_loading_significance, self.results_filename, group_key, feature_ind
+        )
+        title = f'{feature_label} Loading={true_value} (p={p_value})'
         point_graph = go.Scatter(
-            x=np.ravel(permutation_loadings),
-            y=[0 for _ in range(permutation_loadings.shape[0])],
+            x=loadings,
+            y=np.zeros_like(loadings),
             text='Values',
             name='Values',
             mode='markers',
@@ -871,16 +927,16 @@ class OPLSModel(MultivariateAnalysisModel):
         )
         return dcc.Graph(figure={'data': [point_graph, kde_graph], 'layout': layout})
 
-    def get_loading_significance_table(self, group_key, theme=None, wrap=True):
-        description = h5py.File(self.results_filename)[group_key].attrs['description']
+    def get_loading_significance_table(self, group: h5py.Group, theme=None, wrap=True):
+        description = group.attrs['description']
         if self.results_file_ready:
             theme, style_header, style_cell = self._get_table_styles(theme)
-            with h5py.File(self.results_filename, 'r') as file:
-                feature_labels = np.array(file[group_key]['feature_labels'])
-                loadings = np.array(file[group_key]['pls']['x_loadings']).ravel()
-                p_values = np.array(file[group_key]['feature_p_values'])
-                alpha = file[group_key].attrs['outer_alpha']
-                base_collection_id = file.attrs['input_collection_id'] if 'input_collection_id' in file.attrs else None
+            feature_labels = np.array(group['feature_labels'])
+            loadings = np.array(group['pls']['x_loadings']).ravel()
+            p_values = np.array(group['feature_p_values'])
+            n_permutations = np.array(group['feature_n_permutations']) if 'feature_n_permutations' in group else None
+            alpha = group.attrs['outer_alpha']
+            base_collection_id = group.file.attrs.get('input_collection_id')
             x_min = x_max = None
             if base_collection_id is not None:
                 try:
@@ -903,6 +959,8 @@ class OPLSModel(MultivariateAnalysisModel):
                 df['Bin Max'] = x_max
                 df['Bin Min'] = x_min
             df['p Value'] = p_values
+            if n_permutations is not None:
+                df['Permutations'] = n_permutations
             df['Significant'] = ['*' if s else '' for s in is_significant]
             df = df.sort_values(['Significant', 'Bin'], ascending=[False, True])
 
@@ -916,9 +974,10 @@ class OPLSModel(MultivariateAnalysisModel):
             del df['Significant']
             df['Index'] = [str(i) for i in df.index]
             if valid_bin_boundaries:
-                df = df[['Index', 'Bin Max', 'Bin', 'Bin Min', 'Loading', 'p Value']]
+                df = df[['Index', 'Bin Max', 'Bin', 'Bin Min', 'Loading', 'p Value']
+                        + (['Permutations'] if n_permutations is not None else [])]
             else:
-                df = df[['Index', 'Bin', 'Loading', 'p Value']]
+                df = df[['Index', 'Bin', 'Loading', 'p Value'] + (['Permutations'] if n_permutations is not None else [])]
             style_data_conditional = [
                 {
                     'if': {'filter_query': f'{{p Value}} < {alpha}'},
@@ -969,8 +1028,8 @@ class OPLSModel(MultivariateAnalysisModel):
 
     def get_loading_significance_tables(self, theme, wrap=True):
         if self.results_file_ready:
-            return [self.get_loading_significance_table(key, theme, wrap)
-                    for key in h5py.File(self.results_filename).keys()]
+            with h5py.File(self.results_filename, 'r') as file:
+                return [self.get_loading_significance_table(group, theme, wrap) for group in file.values()]
         else:
             return html.H6('Analysis results not ready.')
 
@@ -985,18 +1044,20 @@ class OPLSModel(MultivariateAnalysisModel):
             os.mkdir(plot_dir)
             file_formats = file_formats or []
             if self.results_file_ready:
-                groups = h5py.File(self.results_filename).keys()
                 figure_data = {}
-                for group in groups:
-                    is_discrimination = 'accuracy' in h5py.File(self.results_filename)[group].attrs
-                    quality_graph, score_graph = self.get_quality_plot(group, 'plotly_white', False)
+                with h5py.File(self.results_filename, 'r') as file:
+                    group_keys = list(file.keys())
+                    quality_graphs = [self.get_quality_plot(file[key], 'plotly_white', False) for key in group_keys]
+                    kde_graphs = [self.get_metric_kde_plot(file[key], 'plotly_white', False) for key in group_keys]
+                for group, (quality_graph, score_graph), metric_graphs in zip(group_keys, quality_graphs, kde_graphs):
+                    is_discrimination = len(metric_graphs) > 1
                     if is_discrimination:
                         (
                             q_squared_graph,
                             discriminant_q_squared_graph,
-                            accuracy_graph, roc_auc_graph) = self.get_metric_kde_plot(group, 'plotly_white', False)
+                            accuracy_graph, roc_auc_graph) = metric_graphs
                     else:
-                        q_squared_graph = self.get_metric_kde_plot(group, 'plotly_white', False)
+                        q_squared_graph, = metric_graphs
                         discriminant_q_squared_graph = accuracy_graph = roc_auc_graph = None
                     figure_data.update({
                         f'{group}_quality_metrics': quality_graph.to_plotly_json()['props']['figure'],
@@ -1009,8 +1070,8 @@ class OPLSModel(MultivariateAnalysisModel):
                             f'{group}_accuracy_kde': accuracy_graph.to_plotly_json()['props']['figure'],
                             f'{group}_roc_auc_kde': roc_auc_graph.to_plotly_json()['props']['figure']
                         })
-                    return save_figures.queue(figure_data, file_formats, width, height, units, dpi, plot_dir,
-                                              f'user{current_user.id}', self.redis_prefix)
+                return save_figures.queue(figure_data, file_formats, width, height, units, dpi, plot_dir,
+                                          f'user{current_user.id}', self.redis_prefix)
         raise RuntimeError('Plots not ready!')
 
     def get_results_collection_badges(self) -> List[html.Span]:
@@ -84,6 +84,10 @@ workflow = {
             'id': 'force_regression',
             'type': ['boolean', 'null']
         },
+        {
+            'id': 'sequential_h',
+            'type': ['long', 'null']
+        },
         {
             'id': 'results_collection_id',
             'type': 'long'
@@ -233,6 +237,10 @@ workflow = {
                 {
                     'id': 'force_regression',
                     'source': 'force_regression'
+                },
+                {
+                    'id': 'sequential_h',
+                    'source': 'sequential_h'
                 }
             ],
             'label': 'Perform OPLS',
@@ -0,0 +1,111 @@
+"""
+Davies-Bouldin indices and silhouette coefficients of score plot clusters: over all labels, for each label against the
+rest and for each pair of labels. The distances between records are computed once, in chunks, and reduced to the sum
+of the distances from each record to the records of each label, from which every silhouette coefficient follows. The
+Davies-Bouldin indices follow from the centroids of the labels. The results are the same as those of
+sklearn.metrics.davies_bouldin_score and silhouette_score for each combination of labels.
+"""
+import itertools
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import pairwise_distances, pairwise_distances_chunked
+
+
+def check_label_count(n_labels: int, n_samples: int) -> None:
+    if not 1 < n_labels < n_samples:
+        raise ValueError(f'Number of labels is {n_labels}. Valid values are 2 to n_samples - 1 (inclusive)')
+
+
+def get_distance_sums(scores: np.ndarray, codes: np.ndarray, n_labels: int) -> np.ndarray:
+    """
+    Get the sum of the distances from each record to the records with each label
+    :param scores:
+    :param codes: The index of the label of each record
+    :param n_labels:
+    :return: An array with one row per record and one column per label
+    """
+    indicators = np.zeros((len(codes), n_labels))
+    indicators[np.arange(len(codes)), codes] = 1
+    return np.vstack(list(pairwise_distances_chunked(scores, reduce_func=lambda chunk, start: chunk @ indicators)))
+
+
+def get_silhouette(intra_dists: np.ndarray, inter_dists: np.ndarray) -> float:
+    """
+    :param intra_dists: The mean distance from each record to the other records with its label (nan if there are none)
+    :param inter_dists: The mean distance from each record to the records of the nearest other label
+    :return:
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return float(np.mean(np.nan_to_num((inter_dists - intra_dists) / np.maximum(intra_dists, inter_dists))))
+
+
+def get_davies_bouldin(centroids: np.ndarray, intra_dists: np.ndarray) -> float:
+    """
+    :param centroids: The centroid of each label
+    :param intra_dists: The mean distance from the records with each label to its centroid
+    :return:
+    """
+    centroid_distances = pairwise_distances(centroids)
+    if np.allclose(intra_dists, 0) or np.allclose(centroid_distances, 0):
+        return 0.0
+    centroid_distances[centroid_distances == 0] = np.inf
+    return float(np.mean(np.max((intra_dists[:, None] + intra_dists) / centroid_distances, axis=1)))
+
+
+def get_cluster_metrics(scores: np.ndarray, label_values) -> List[Tuple[str, float, float]]:
+    """
+    Get the Davies-Bouldin index and silhouette coefficient of the clusters formed by label_values, then, if there are
+    more than two labels, of each label against all other records and of each pair of labels.
+    :param scores: The scores of each record
+    :param label_values: The label of each record
+    :return: The name, Davies-Bouldin index and silhouette coefficient of each combination of labels
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    codes, uniques = pd.factorize(np.asarray(label_values))
+    n_samples, n_labels = len(codes), len(uniques)
+    check_label_count(n_labels, n_samples)
+    counts = np.bincount(codes, minlength=n_labels)
+    own = codes == np.arange(n_labels)[:, None]  # own[k] selects the records with label k
+    sums = get_distance_sums(scores, codes, n_labels)
+    centroids = np.array([scores[own[k]].mean(axis=0) for k in range(n_labels)])
+    intra_centroid_dists = np.array([np.linalg.norm(scores[own[k]] - centroids[k], axis=1).mean()
+                                     for k in range(n_labels)])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intra_dists = sums[np.arange(n_samples), codes] / (counts[codes] - 1)
+        mean_dists = sums / counts
+    mean_dists[np.arange(n_samples), codes] = np.inf
+    data = [('Overall',
+             get_davies_bouldin(centroids, intra_centroid_dists),
+             get_silhouette(intra_dists, mean_dists.min(axis=1)))]
+    if n_labels <= 2:
+        return data
+
+    totals = sums.sum(axis=1)
+    for k, unique_val in enumerate(uniques):
+        rest_sums = totals - sums[:, k]
+        n_rest = n_samples - counts[k]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intra_dists = np.where(own[k], sums[:, k] / (counts[k] - 1), rest_sums / (n_rest - 1))
+            inter_dists = np.where(own[k], rest_sums / n_rest, sums[:, k] / counts[k])
+        rest_centroid = scores[~own[k]].mean(axis=0)
+        rest_intra_dist = np.linalg.norm(scores[~own[k]] - rest_centroid, axis=1).mean()
+        data.append((f'{unique_val} vs. all',
+                     get_davies_bouldin(np.array([centroids[k], rest_centroid]),
+                                        np.array([intra_centroid_dists[k], rest_intra_dist])),
+                     get_silhouette(intra_dists, inter_dists)))
+
+    for first, second in itertools.combinations(range(n_labels), 2):
+        check_label_count(2, counts[first] + counts[second])
+        pair = own[first] | own[second]
+        is_first = own[first][pair]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intra_dists = np.where(is_first, sums[pair, first] / (counts[first] - 1),
+                                   sums[pair, second] / (counts[second] - 1))
+            inter_dists = np.where(is_first, sums[pair, second] / counts[second], sums[pair, first] / counts[first])
+        data.append((f'{uniques[first]} vs. {uniques[second]}',
+                     get_davies_bouldin(centroids[[first, second]], intra_centroid_dists[[first, second]]),
+                     get_silhouette(intra_dists, inter_dists)))
+    return data
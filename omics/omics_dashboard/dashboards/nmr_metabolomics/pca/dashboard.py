@@ -1,13 +1,14 @@
 import itertools
 import traceback
 
+import dash
 import dash_bootstrap_components as dbc
 import dash_html_components as html
 from dash.dependencies import Output, Input, State
 from dash.exceptions import PreventUpdate
 from flask import url_for
 
-from dashboards.dashboard import Dashboard, StyledDash, get_plot_theme
+from dashboards.dashboard import Dashboard, StyledDash, get_plot_theme, COLLECTION_LOAD_OUTPUTS
 from .layouts import get_layout
 from .model import PCAModel
 
@@ -83,15 +84,16 @@ class PCADashboard(Dashboard):
              Output('color-by-select', 'options'),
              Output('label-by-select', 'options'),
              Output('loaded-collections', 'children'),
-             Output('collections-label', 'children')],
-            [Input('get-collection', 'n_clicks')],
+             Output('collections-label', 'children')] + COLLECTION_LOAD_OUTPUTS,
+            [Input('get-collection', 'n_clicks'),
+             Input('collection-load-interval', 'n_intervals')],
             [State('collection-id', 'value')],
         )
-        def get_collections(n_clicks, value):
-            if not value or not n_clicks:
-                raise PreventUpdate('Callback triggered without value')
+        def get_collections(n_clicks, n_intervals, value):
             pca_data = PCAModel()
-            pca_data.get_collections(value)
+            loaded, load_outputs = PCADashboard.load_collections(pca_data, n_clicks, value)
+            if not loaded:
+                return (dash.no_update,) * 10 + load_outputs
             label_data = pca_data.get_label_data()
             return (
                 label_data,
@@ -104,7 +106,7 @@ class PCADashboard(Dashboard):
                 label_data,
                 pca_data.get_collection_badges(),
                 pca_data.get_collection_load_info()
-            )
+            ) + load_outputs
 
         @app.callback(
             [Output('message', 'children'),
@@ -124,14 +126,18 @@ class PCADashboard(Dashboard):
              State('ignore-by-value', 'value'),
              State('pair-on', 'value'),
              State('pair-with-value', 'value'),
-             State('project-by-value', 'value')]
+             State('project-by-value', 'value'),
+             State('pca-engine', 'value'),
+             State('n-components', 'value')]
         )
         def perform_pca(n_clicks,
                         scale_by_queries,
                         model_by_queries,
                         ignore_by_queries,
                         pair_on, pair_with_queries,
-                        project_by_queries):
+                        project_by_queries,
+                        engine,
+                        n_components):
             if not n_clicks:
                 raise PreventUpdate('Callback triggered without click.')
             scale_by = ' | '.join(scale_by_queries) if scale_by_queries and len(scale_by_queries) else None
@@ -148,7 +154,9 @@ class PCADashboard(Dashboard):
                                                                          scale_by,
                                                                          pair_on,
                                                                          pair_with,
-                                                                         project_by)
+                                                                         project_by,
+                                                                         engine=engine,
+                                                                         n_components=n_components)
                 pc_options = pca_data.get_pc_options()
                 all_pc_options = [option['value'] for option in pc_options]
                 ten_pc_options = [option['value'] for option in pc_options[:10]]
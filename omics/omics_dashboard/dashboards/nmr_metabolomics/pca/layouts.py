@@ -3,6 +3,7 @@ import dash_core_components as dcc
 import dash_html_components as html
 from flask_login import current_user
 
+from dashboards.dashboard import get_collection_load_progress_div
 from data_tools.wrappers.analyses import get_analyses
 from data_tools.wrappers.collections import get_collections
 from .model import PCAModel
@@ -638,7 +639,8 @@ def get_pca_options_form():
                                                         ], id='loaded-display'
                                                     )
                                                 ]
-                                            )
+                                            ),
+                                            get_collection_load_progress_div()
                                         ]
                                     )
                                 ]
@@ -824,6 +826,46 @@ def get_pca_options_form():
                             )
                         ]
                     ),
+                    dbc.Row(
+                        [
+                            dbc.Col(
+                                [
+                                    dbc.FormGroup(
+                                        [
+                                            dbc.Label(['PCA engine',
+                                                       html.Abbr('\uFE56',
+                                                                 title='Full SVD finds every component. Randomized SVD '
+                                                                       'finds only the first components, which is much '
+                                                                       'faster for large collections. Incremental PCA '
+                                                                       'reads the records in batches to limit memory '
+                                                                       'use.')],
+                                                      html_for='pca-engine'),
+                                            dcc.Dropdown(id='pca-engine',
+                                                         options=[
+                                                             {'label': 'Full SVD', 'value': 'full'},
+                                                             {'label': 'Randomized SVD', 'value': 'randomized'},
+                                                             {'label': 'Incremental PCA', 'value': 'incremental'}
+                                                         ], value='full', clearable=False)
+                                        ]
+                                    )
+                                ]
+                            ),
+                            dbc.Col(
+                                [
+                                    dbc.FormGroup(
+                                        [
+                                            dbc.Label(['Components',
+                                                       html.Abbr('\uFE56',
+                                                                 title='The number of components found by the '
+                                                                       'randomized and incremental engines.')],
+                                                      html_for='n-components'),
+                                            dbc.Input(id='n-components', type='number', value=10, min=1)
+                                        ]
+                                    )
+                                ]
+                            )
+                        ]
+                    ),
                     dbc.FormGroup(
                         [
                             dcc.Loading(
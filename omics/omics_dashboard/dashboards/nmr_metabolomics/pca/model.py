@@ -1,4 +1,3 @@
-import itertools
 import os
 import shutil
 from typing import List, Dict, Union, Tuple
@@ -15,10 +14,12 @@ import scipy.stats as stats
 from flask import url_for
 from flask_login import current_user
 from plotly.colors import DEFAULT_PLOTLY_COLORS
-from sklearn.decomposition import PCA
-from sklearn.metrics import davies_bouldin_score, silhouette_score
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.utils import gen_batches
 
+from data_tools.file_tools.metadata_tools import FileCache
 from data_tools.wrappers.collections import upload_collection
+from .cluster_metrics import get_cluster_metrics
 from ..multivariate_analysis_model import MultivariateAnalysisModel
 
 
@@ -30,6 +31,8 @@ class PCAModel(MultivariateAnalysisModel):
         'cumulative_variance_plots': []
     }
     redis_prefix = 'pca'
+    # cluster metrics of score plots, shared by the models of this process
+    _cluster_metrics_cache = FileCache(64)
 
     def __init__(self, load_data=False):
         # any of these can be None
@@ -118,43 +121,12 @@ class PCAModel(MultivariateAnalysisModel):
         # this is calculated as part of plotting scores.
         self.load_labels()
         self.load_results()
-        scores_df = pd.DataFrame(data=self._scores,
-                                 index=self._processed_label_df.index,
-                                 columns=[f'PC {i+1}' for i in range(self._scores.shape[1])])
-        label_df = pd.DataFrame(data=label_values, columns=[category_label], index=self._processed_label_df.index)
 
-        scores_df.reset_index()
-        label_df.reset_index()
-
-        data = [
-            [
-                'Overall',
-                davies_bouldin_score(scores_df, label_df[category_label]),
-                silhouette_score(scores_df, label_df[category_label])
-            ]
-        ]
-        if len(pd.unique(label_df[category_label])) > 2:
-            for unique_val in pd.unique(label_df[category_label]):
-                labels = label_df.copy()
-                labels[labels[category_label] != unique_val] = f'not {unique_val}'
-                data.append(
-                    [
-                        f'{unique_val} vs. all',
-                        davies_bouldin_score(scores_df, labels[category_label]),
-                        silhouette_score(scores_df, labels[category_label])
-
-                    ])
-
-            for first, second in itertools.combinations(pd.unique(label_df[category_label]), 2):
-                labels = label_df[(label_df[category_label] == first)
-                                  | (label_df[category_label] == second)][category_label]
-                scores = scores_df[(label_df[category_label] == first) | (label_df[category_label] == second)]
-                data.append([
-                    f'{first} vs. {second}',
-                    davies_bouldin_score(scores, labels),
-                    silhouette_score(scores, labels)
-                ])
+        # label_values follows from category_label and the results, so results are cached on both
+        def get_cluster_metrics_table(results_filename, category_label):
+            return get_cluster_metrics(self._scores, label_values)
 
+        data = self._cluster_metrics_cache.get(get_cluster_metrics_table, self._results_filename, category_label)
         results = pd.DataFrame(data=data, columns=[category_label, 'Davies-Bouldin', 'Silhouette'])
         if for_display:
             results['Davies-Bouldin'] = results['Davies-Bouldin'].apply(lambda row: f'{row:.5f}')
@@ -341,14 +313,54 @@ class PCAModel(MultivariateAnalysisModel):
                     return csv_filenames[0]
         return shutil.make_archive(results_dir, 'zip', root_dir, filename)
 
+    def fits_in_batches(self, engine='full', **kwargs):
+        return engine == 'incremental'
+
     def fit(self,
             numeric_df,
             model_numeric_df,
             model_label_df=None,
+            engine='full',
+            n_components=None,
+            batch_bytes=64 * 1024 ** 2,
             **kwargs):
-        pca = PCA()
-        pca.fit(model_numeric_df)
-        self._scores = pca.transform(numeric_df)
+        """
+        :param numeric_df: The records to transform
+        :param model_numeric_df: The records to fit. None with the incremental engine, which reads the model_label_df
+        rows of numeric_df instead.
+        :param model_label_df:
+        :param engine: 'full' to fit every component with a full SVD, 'randomized' to fit n_components with a randomized
+        SVD, or 'incremental' to fit n_components with IncrementalPCA, reading the records in batches of about
+        batch_bytes. Only one batch at a time is copied out of a memory-mapped numeric_df.
+        :param n_components: The number of components to fit with the randomized and incremental engines
+        :param batch_bytes:
+        :param kwargs:
+        :return:
+        """
+        if engine == 'full':
+            pca = PCA()
+            pca.fit(model_numeric_df)
+            self._scores = pca.transform(numeric_df)
+        elif engine == 'randomized':
+            n_components = min(int(n_components or 10), *model_numeric_df.shape)
+            pca = PCA(n_components=n_components, svd_solver='randomized')
+            pca.fit(model_numeric_df)
+            self._scores = pca.transform(numeric_df)
+        elif engine == 'incremental':
+            values = numeric_df.values
+            # rows are taken in ascending order, so each batch is read from disk front to back
+            model_rows = np.sort(numeric_df.index.get_indexer_for(model_label_df.index))
+            n_components = min(int(n_components or 10), len(model_rows), values.shape[1])
+            batch_size = max(n_components, batch_bytes // max(1, values[:1].nbytes))
+            pca = IncrementalPCA(n_components=n_components)
+            # partial_fit needs at least n_components records, so a short last batch joins the one before it
+            for batch in gen_batches(len(model_rows), batch_size, min_batch_size=n_components):
+                pca.partial_fit(values[model_rows[batch]])
+            self._scores = np.vstack([pca.transform(values[batch])
+                                      for batch in gen_batches(len(values), batch_size)]) \
+                if len(values) else np.empty((0, n_components))
+        else:
+            raise ValueError(f'Improper PCA engine {engine}.')
         self._loadings = pca.components_
         self._explained_variance_ratio = pca.explained_variance_ratio_
 
@@ -740,8 +752,9 @@ class PCAModel(MultivariateAnalysisModel):
             'gridcolor': '#95A5A6'  # flatly secondary
         }
         cumulative = 100 * np.cumsum(self._explained_variance_ratio)
-        first_index = np.argwhere(cumulative > threshold).flatten()[0]
-        line_x = first_index + 1
+        above_threshold = np.argwhere(cumulative > threshold).flatten()
+        # when fewer components were fit than the threshold needs, mark the last one
+        line_x = above_threshold[0] + 1 if len(above_threshold) else len(cumulative)
         y_ticks = sorted([i for i in range(0, 110, 10)] + [threshold])
         x_ticks = sorted([i for i in range(0, len(self._explained_variance_ratio), 5)] + [line_x])
         return dcc.Graph(figure={
@@ -4,6 +4,7 @@ from flask import url_for
 
 from dashboards import Dashboard
 import itertools
+import dash
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
@@ -11,7 +12,7 @@ import dash_html_components as html
 from dash.dependencies import Output, Input, State
 from dash.exceptions import PreventUpdate
 
-from dashboards.dashboard import StyledDash, get_plot_theme
+from dashboards.dashboard import StyledDash, get_plot_theme, COLLECTION_LOAD_OUTPUTS
 from dashboards.nmr_metabolomics.processing.layouts import get_layout
 from dashboards.nmr_metabolomics.processing.model import CollectionProcessingModel
 
@@ -51,24 +52,24 @@ class CollectionProcessingDashboard(Dashboard):
              Output('region-max', 'min'),
              Output('region-max', 'max'),
              Output('pqn-ref-label', 'options'),
-             Output('hist-ref-label', 'options')],
-            [Input('get-collection', 'n_clicks')],
+             Output('hist-ref-label', 'options')] + COLLECTION_LOAD_OUTPUTS,
+            [Input('get-collection', 'n_clicks'),
+             Input('collection-load-interval', 'n_intervals')],
             [State('collection-id', 'value'),
              State('normalization-apply-button', 'n_clicks'),
              State('baseline-apply-button', 'n_clicks'),
              State('region-apply-button', 'n_clicks'),
              State('finalize-button', 'n_clicks')],
         )
-        def get_collections(n_clicks, value,
+        def get_collections(n_clicks, n_intervals, value,
                             normalize_n_clicks,
                             baseline_n_clicks,
                             region_n_clicks,
                             finalize_n_clicks):
-            CollectionProcessingDashboard.check_clicks(n_clicks)
-            if not value:
-                raise PreventUpdate('Nothing to load.')
             model = CollectionProcessingModel()
-            model.get_collections(value)
+            loaded, load_outputs = CollectionProcessingDashboard.load_collections(model, n_clicks, value)
+            if not loaded:
+                return (dash.no_update,) * 10 + load_outputs
             x_min, x_max = model.x_range
             model.normalize_n_clicks = normalize_n_clicks
             model.finalize_n_clicks = finalize_n_clicks
@@ -88,7 +89,7 @@ class CollectionProcessingDashboard(Dashboard):
                 x_max,
                 label_data,
                 label_data
-            )
+            ) + load_outputs
 
         @app.callback(
             [Output('sum-normalization-form', 'style'),
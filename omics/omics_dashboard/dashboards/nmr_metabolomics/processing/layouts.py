@@ -4,6 +4,7 @@ import dash_html_components as html
 import dash_daq as daq
 from flask_login import current_user
 
+from dashboards.dashboard import get_collection_load_progress_div
 from dashboards.nmr_metabolomics.processing.model import CollectionProcessingModel
 from data_tools.wrappers.analyses import get_analyses
 from data_tools.wrappers.collections import get_collections
@@ -63,7 +64,8 @@ def get_post_form():
                                                         ], id='loaded-display'
                                                     )
                                                 ]
-                                            )
+                                            ),
+                                            get_collection_load_progress_div()
                                         ]
                                     )
                                 ]
@@ -1,7 +1,6 @@
 import os
 
 from flask_login import current_user
-import h5py
 import pandas as pd
 import numpy as np
 import plotly.graph_objs as go
@@ -19,6 +18,7 @@ import birg_chemometrics_tools.baseline as bl
 class CollectionProcessingModel(DashboardModel):
     _redis_prefix = 'collection_editor'
     _empty_plot_data = {}
+    _dataframe_keys = ['label_df', 'numeric_df', 'processed_label_df', 'processed_numeric_df', 'special_numeric_df']
 
     def __init__(self, load_data=False):
         self._processed_numeric_df = None
@@ -26,58 +26,23 @@ class CollectionProcessingModel(DashboardModel):
         super().__init__(load_data)
 
     def get_collections(self, collection_ids):
-        super().get_collections(collection_ids)
+        job = super().get_collections(collection_ids)
         try:
             self.processing_log = get_collection(current_user, collection_ids[0]).get_attr('processing_log')
         except Exception as e:
             print(e)
             self.processing_log = ''
+        return job
+
+    def finish_collection_load(self):
+        if not super().finish_collection_load():
+            return False
+        self.load_dataframes()
         x = [float(i) for i in self._numeric_df.columns]
         self.x_axis_range = [max(x), min(x)]
         y_max = np.max(self._numeric_df.values)
         self.y_axis_range = [-0.05*y_max, 1.05 * y_max]
-
-    def load_dataframes(self):
-        super().load_dataframes()
-        with h5py.File(self._dataframe_filename, 'r') as file:
-            has_processed_label_df = 'processed_label_df' in file
-            has_processed_numeric_df = 'processed_numeric_df' in file
-            has_special_numeric_df = 'special_numeric_df' in file
-
-        if has_processed_label_df:
-            self._processed_label_df = pd.read_hdf(self._dataframe_filename, 'processed_label_df')
-        else:
-            self._processed_label_df = None
-        if has_processed_numeric_df:
-            self._processed_numeric_df = pd.read_hdf(self._dataframe_filename, 'processed_numeric_df')
-        else:
-            self._processed_numeric_df = None
-        if has_special_numeric_df:
-            self._special_numeric_df = pd.read_hdf(self._dataframe_filename, 'special_numeric_df')
-        else:
-            self._special_numeric_df = None
-
-    def save_dataframes(self):
-        super().save_dataframes()
-        try:
-            self._processed_label_df.to_hdf(self._dataframe_filename, 'processed_label_df', mode='a')
-        except AttributeError:
-            with h5py.File(self._dataframe_filename, 'r+') as file:
-                if 'processed_label_df' in file:
-                    del file['processed_label_df']
-            pass
-        try:
-            self._processed_numeric_df.to_hdf(self._dataframe_filename, 'processed_numeric_df', mode='a')
-        except AttributeError:
-            with h5py.File(self._dataframe_filename, 'r+') as file:
-                if 'processed_numeric_df' in file:
-                    del file['processed_numeric_df']
-        try:
-            self._special_numeric_df.to_hdf(self._dataframe_filename, 'special_numeric_df', mode='a')
-        except AttributeError:
-            with h5py.File(self._dataframe_filename, 'r+') as file:
-                if 'special_numeric_df' in file:
-                    del file['special_numeric_df']
+        return True
 
     @property
     def special_numeric_df_label(self):
@@ -442,7 +407,7 @@ class CollectionProcessingModel(DashboardModel):
         parent_collections = [
             get_collection(current_user, collection_id) for collection_id in self.loaded_collection_ids
         ]
-        label_df = self._label_df
+        label_df = self._label_df.copy()
         # merge collection attributes
         if len(self.loaded_collection_ids) > 1:
             collection_lengths = [
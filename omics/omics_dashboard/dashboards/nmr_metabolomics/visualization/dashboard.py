@@ -1,6 +1,7 @@
 import itertools
 import traceback
 
+import dash
 import dash_bootstrap_components as dbc
 import dash_html_components as html
 from dash.dependencies import Output, Input, State
@@ -8,7 +9,7 @@ from dash.exceptions import PreventUpdate
 from flask import url_for
 
 from dashboards import Dashboard
-from dashboards.dashboard import get_plot_theme, StyledDash
+from dashboards.dashboard import get_plot_theme, StyledDash, COLLECTION_LOAD_OUTPUTS
 from .layouts import get_layout
 from .model import VisualizationModel
 
@@ -39,23 +40,23 @@ class VisualizationDashboard(Dashboard):
             [Output('group-by', 'options'),
              Output('label-by', 'options'),
              Output('loaded-collections', 'children'),
-             Output('collections-label', 'children')],
-            [Input('get-collection', 'n_clicks')],
+             Output('collections-label', 'children')] + COLLECTION_LOAD_OUTPUTS,
+            [Input('get-collection', 'n_clicks'),
+             Input('collection-load-interval', 'n_intervals')],
             [State('collection-id', 'value')],
         )
-        def get_collections(n_clicks, value):
-            VisualizationDashboard.check_clicks(n_clicks)
-            if not value:
-                raise PreventUpdate('Nothing to load.')
+        def get_collections(n_clicks, n_intervals, value):
             viz_data = VisualizationModel()
-            viz_data.get_collections(value)
+            loaded, load_outputs = VisualizationDashboard.load_collections(viz_data, n_clicks, value)
+            if not loaded:
+                return (dash.no_update,) * 4 + load_outputs
             label_data = viz_data.get_label_data()
             return (
                 label_data,
                 label_data,
                 viz_data.get_collection_badges(),
                 viz_data.get_collection_load_info()
-            )
+            ) + load_outputs
 
         @app.callback([Output('group-by-value', 'options')], [Input('group-by', 'value')])
         def update_group_by_options(label_keys):
@@ -3,6 +3,7 @@ import dash_core_components as dcc
 import dash_html_components as html
 from flask_login import current_user
 
+from dashboards.dashboard import get_collection_load_progress_div
 from dashboards.nmr_metabolomics.visualization.model import VisualizationModel
 from data_tools.wrappers.collections import get_collections
 
@@ -56,7 +57,8 @@ def get_plot_options_form():
                                                 ], id='loaded-display'
                                             )
                                         ]
-                                    )
+                                    ),
+                                    get_collection_load_progress_div()
                                 ]
                             )
                         ]
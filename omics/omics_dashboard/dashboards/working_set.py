@@ -0,0 +1,189 @@
+"""
+The working set of a dashboard: the dataframes and arrays shared by the callbacks of a dashboard session.
+
+A working set is a JSON manifest naming one file per value. Every save writes new files tagged with the next version,
+then atomically replaces the manifest, so readers always see a complete set of values and a rewrite never grows an
+existing file. Numeric arrays and single-dtype numeric dataframes are saved as .npy files and loaded as copy-on-write
+memory maps, so loading them copies nothing until a page is written. Other dataframes (e.g. labels) are pickled.
+Loaded values can be kept in a WorkingSetCache, which is shared by all the models of a worker process.
+"""
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List
+
+import numpy as np
+import pandas as pd
+
+
+def get_size(value: Any) -> int:
+    if isinstance(value, pd.DataFrame):
+        if len(set(value.dtypes)) == 1 and np.issubdtype(value.dtypes.iloc[0], np.number):
+            return int(value.values.nbytes)  # memory_usage takes a long time for wide frames
+        return int(value.memory_usage(deep=True).sum())
+    return int(getattr(value, 'nbytes', 0))
+
+
+class WorkingSetCache:
+    """
+    An LRU cache of values loaded from working sets, bounded by the total size of the values. Values are keyed on the
+    files they were loaded from, which are never rewritten, so a cached value is never stale. Cached values are shared
+    by every caller and must not be modified in place.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        """
+        Get the value for key, calling load to get it if it is not cached
+        :param key:
+        :param load:
+        :return:
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+        value = load()
+        size = get_size(value)
+        if size <= self.max_bytes:
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = (value, size)
+                    self.size += size
+                while self.size > self.max_bytes:
+                    _, (_, evicted_size) = self.entries.popitem(last=False)
+                    self.size -= evicted_size
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class WorkingSet:
+    def __init__(self, filename: str, cache: WorkingSetCache = None, owner: Hashable = None):
+        """
+        :param filename: The path of the manifest. The files holding the values are kept in the same directory.
+        :param cache: A cache for loaded values
+        :param owner: The owner of the working set (e.g. a user id). Values are only shared through cache by working
+        sets with the same owner.
+        """
+        self.filename = filename
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        self.cache = cache
+        self.owner = owner
+
+    def get_manifest(self) -> Dict[str, Any]:
+        if not os.path.isfile(self.filename):
+            return {'version': 0, 'values': {}}
+        with open(self.filename, 'r') as file:
+            return json.load(file)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.get_manifest()['values']
+
+    def load(self, names: List[str], attempts: int = 3) -> Dict[str, Any]:
+        """
+        Load values from the working set. Names not in the working set are loaded as None.
+        :param names:
+        :param attempts: How many times to read the manifest again if a concurrent save removes a file while loading
+        :return:
+        """
+        for attempt in range(attempts):
+            entries = self.get_manifest()['values']
+            try:
+                return {name: self.get_value(entries[name]) if name in entries else None for name in names}
+            except FileNotFoundError as e:
+                if attempt == attempts - 1:
+                    raise e
+
+    def save(self, values: Dict[str, Any]) -> None:
+        """
+        Save values to the working set, replacing values with the same names. Values which are None are removed.
+        :param values: DataFrames or numpy arrays
+        :return:
+        """
+        manifest = self.get_manifest()
+        version = manifest['version'] + 1
+        old_entries = manifest['values']
+        entries = dict(old_entries)
+        for name, value in values.items():
+            if value is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = self.write_value(f'{name}.{version}', value)
+        self.write_file(self.filename, lambda file: file.write(json.dumps({'version': version, 'values': entries})),
+                        'w')
+        # readers which already opened the old files keep them until they are done
+        for name, entry in old_entries.items():
+            if entries.get(name) != entry:
+                for filename in entry['files']:
+                    try:
+                        os.remove(os.path.join(self.directory, filename))
+                    except FileNotFoundError:
+                        pass
+
+    def write_file(self, filename: str, write, mode: str = 'wb') -> None:
+        """
+        Write a file atomically, by writing a temporary file and replacing filename with it
+        :param filename:
+        :param write: A function which takes the open file
+        :param mode:
+        :return:
+        """
+        fd, temp_filename = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, mode) as file:
+                write(file)
+            os.replace(temp_filename, filename)
+        except Exception as e:
+            os.remove(temp_filename)
+            raise e
+
+    def write_value(self, stem: str, value: Any) -> Dict[str, Any]:
+        if isinstance(value, np.ndarray):
+            filenames = [f'{stem}.npy']
+            self.write_file(os.path.join(self.directory, filenames[0]), lambda file: np.save(file, value))
+            return {'type': 'array', 'files': filenames}
+        if isinstance(value, pd.DataFrame):
+            if len(value.columns) and len(set(value.dtypes)) == 1 and np.issubdtype(value.dtypes.iloc[0], np.number):
+                filenames = [f'{stem}.npy', f'{stem}.axes.pkl']
+                self.write_file(os.path.join(self.directory, filenames[0]), lambda file: np.save(file, value.values))
+                self.write_file(os.path.join(self.directory, filenames[1]),
+                                lambda file: pd.to_pickle((value.index, value.columns), file))
+                return {'type': 'numeric_dataframe', 'files': filenames}
+            filenames = [f'{stem}.pkl']
+            self.write_file(os.path.join(self.directory, filenames[0]), lambda file: pd.to_pickle(value, file))
+            return {'type': 'dataframe', 'files': filenames}
+        raise TypeError(f'Cannot save {type(value)} to a working set.')
+
+    def get_value(self, entry: Dict[str, Any]) -> Any:
+        if self.cache is None:
+            return self.read_value(entry)
+        key = (self.owner, self.directory, entry['type'], tuple(entry['files']))
+        return self.cache.get(key, lambda: self.read_value(entry))
+
+    def read_value(self, entry: Dict[str, Any]) -> Any:
+        filenames = [os.path.join(self.directory, filename) for filename in entry['files']]
+        if entry['type'] == 'array':
+            return np.load(filenames[0], mmap_mode='c')
+        if entry['type'] == 'numeric_dataframe':
+            index, columns = pd.read_pickle(filenames[1])
+            return pd.DataFrame(np.load(filenames[0], mmap_mode='c'), index=index, columns=columns, copy=False)
+        return pd.read_pickle(filenames[0])
@@ -19,12 +19,14 @@ import sqlalchemy as sa
 from flask_login import UserMixin
 from flask_sqlalchemy import Model, SQLAlchemy, event
 from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import selectinload
 
 import data_tools.file_tools.collection_tools as ct
 import data_tools.file_tools.metadata_tools as mdt
 from data_tools.file_tools.h5_merge import h5_merge
+from data_tools.file_tools.layout_tools import get_dataset_options, read_dataset, replace_file
 from config.redis_config import clear_user_hash
-from config.config import DATADIR
+from config.config import DATADIR, MERGE_PROCESSES
 
 
 class Base(Model):
@@ -63,6 +65,40 @@ class Base(Model):
     def write_permitted(self, user):
         raise NotImplementedError('write_permitted not implemented in base model.')
 
+    @classmethod
+    def read_permitted_clause(cls, user):
+        raise NotImplementedError('read_permitted_clause not implemented in base model.')
+
+    @classmethod
+    def get_to_dict_load_options(cls) -> List[Any]:
+        """
+        Loader options which eagerly load the relationships used by to_dict
+        :return:
+        """
+        return []
+
+    @classmethod
+    def prepare_to_dict(cls, records: List[Any]):
+        """
+        Fetch anything else to_dict needs for many records at once
+        :param records:
+        :return:
+        """
+        pass
+
+    @classmethod
+    def to_dicts(cls, query, **kwargs) -> List[Dict[str, Any]]:
+        """
+        Serialize all the records of a query of this model with a constant number of queries, instead of loading the
+        relationships of each record as to_dict touches them.
+        :param query:
+        :param kwargs: Passed to to_dict
+        :return:
+        """
+        records = query.options(*cls.get_to_dict_load_options()).all()
+        cls.prepare_to_dict(records)
+        return [record.to_dict(**kwargs) for record in records]
+
 
 db = SQLAlchemy(model_class=Base, session_options={'autoflush': False})
 
@@ -140,6 +176,32 @@ external_file_analysis_membership = db.Table('external_file_analysis_membership'
                                                        primary_key=True))
 
 
+def user_group_member_clause(user, user_group_id, membership_table: sa.Table = user_group_membership):
+    """
+    An EXISTS clause which is true when user is in the membership table (user_group_membership or user_group_admin) of
+    the user group with the id user_group_id. Uses the primary key index of the membership table.
+    :param user:
+    :param user_group_id: A user group id or a column containing user group ids
+    :param membership_table:
+    :return:
+    """
+    return sa.exists().where(sa.and_(membership_table.c.user_id == user.id,
+                                     membership_table.c.user_group_id == user_group_id))
+
+
+def is_user_group_member(user, user_group_id, membership_table: sa.Table = user_group_membership) -> bool:
+    """
+    Check if user is in the membership table of the user group with the id user_group_id without loading the group
+    :param user:
+    :param user_group_id:
+    :param membership_table:
+    :return:
+    """
+    if user_group_id is None:
+        return False
+    return db.session.query(user_group_member_clause(user, user_group_id, membership_table)).scalar()
+
+
 class User(db.Model, UserMixin):
     __tablename__ = 'user'
     email = db.Column(db.String, nullable=False, unique=True)
@@ -147,7 +209,7 @@ class User(db.Model, UserMixin):
     password = db.Column(db.String, nullable=False)
     admin = db.Column(db.Boolean, nullable=False, default=False)
     active = db.Column(db.Boolean, nullable=False, default=True)
-    primary_user_group_id = db.Column(db.Integer, db.ForeignKey('user_group.id'))
+    primary_user_group_id = db.Column(db.Integer, db.ForeignKey('user_group.id'), index=True)
     primary_user_group = db.relationship('UserGroup', foreign_keys=primary_user_group_id)
     user_groups = db.relationship('UserGroup', secondary=user_group_membership, back_populates='members')
     admin_user_groups = db.relationship('UserGroup', secondary=user_group_admin, back_populates='admins')
@@ -194,6 +256,10 @@ class User(db.Model, UserMixin):
             dict_rep['password'] = self.password
         return dict_rep
 
+    @classmethod
+    def get_to_dict_load_options(cls) -> List[Any]:
+        return [selectinload(cls.user_groups), selectinload(cls.admin_user_groups)]
+
     # Flask-Login things
 
     @property
@@ -211,7 +277,12 @@ class User(db.Model, UserMixin):
 
     def read_permitted(self, user):
         return user.admin or user is self or self.all_can_read or (
-                self.group_can_read and user in self.primary_user_group.members)
+                self.group_can_read and is_user_group_member(user, self.primary_user_group_id))
+
+    @classmethod
+    def read_permitted_clause(cls, user):
+        return sa.or_(cls.id == user.id, cls.all_can_read,
+                      user_group_member_clause(user, cls.primary_user_group_id))
 
     def write_permitted(self, user):
         return user.admin or user is self
@@ -231,7 +302,7 @@ class User(db.Model, UserMixin):
 
 class UserGroup(db.Model):
     __tablename__ = 'user_group'
-    creator_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    creator_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     name = db.Column(db.String, nullable=False)
     description = db.Column(db.String)
 
@@ -266,11 +337,27 @@ class UserGroup(db.Model):
             'updated_on': self.updated_on.isoformat()
         }
 
+    @classmethod
+    def get_to_dict_load_options(cls) -> List[Any]:
+        return [
+            selectinload(relationship).selectinload(user_relationship)
+            for relationship in (cls.members, cls.admins)
+            for user_relationship in (User.user_groups, User.admin_user_groups)
+        ]
+
     def read_permitted(self, user: User):
-        return user.admin or user is self.owner or self.all_can_read or user in self.admins or user in self.members
+        return user.admin or self.creator_id == user.id or self.all_can_read \
+               or is_user_group_member(user, self.id, user_group_admin) or is_user_group_member(user, self.id)
 
     def write_permitted(self, user: User):
-        return user.admin or user is self.owner or self.all_can_write or user in self.admins
+        return user.admin or self.creator_id == user.id or self.all_can_write \
+               or is_user_group_member(user, self.id, user_group_admin)
+
+    @classmethod
+    def read_permitted_clause(cls, user):
+        return sa.or_(cls.creator_id == user.id, cls.all_can_read,
+                      user_group_member_clause(user, cls.id, user_group_admin),
+                      user_group_member_clause(user, cls.id))
 
 
 class OmicsRecordMixin(object):
@@ -279,13 +366,13 @@ class OmicsRecordMixin(object):
     description = db.Column(db.String)
 
     @declared_attr
-    def creator_id(cls): return db.Column(db.Integer, db.ForeignKey('user.id'))
+    def creator_id(cls): return db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
 
     @declared_attr
-    def owner_id(cls): return db.Column(db.Integer, db.ForeignKey('user.id'))
+    def owner_id(cls): return db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
 
     @declared_attr
-    def last_editor_id(cls): return db.Column(db.Integer, db.ForeignKey('user.id'))
+    def last_editor_id(cls): return db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
 
     @declared_attr
     def creator(cls): return db.relationship(User, foreign_keys=[cls.creator_id])
@@ -302,7 +389,7 @@ class OmicsRecordMixin(object):
     all_can_write = db.Column(db.Boolean, default=False)
 
     @declared_attr
-    def user_group_id(cls): return db.Column(db.Integer, db.ForeignKey('user_group.id'), default=None)
+    def user_group_id(cls): return db.Column(db.Integer, db.ForeignKey('user_group.id'), default=None, index=True)
 
     @declared_attr
     def user_group(cls): return db.relationship(UserGroup, foreign_keys=[cls.user_group_id])
@@ -315,12 +402,17 @@ class OmicsRecordMixin(object):
     }
 
     def read_permitted(self, user: User):
-        return user.admin or user is self.owner or self.all_can_read or (
-                self.group_can_read and user in self.user_group.members)
+        return user.admin or self.owner_id == user.id or self.all_can_read or (
+                self.group_can_read and is_user_group_member(user, self.user_group_id))
 
     def write_permitted(self, user: User):
-        return user.admin or user is self.owner or self.all_can_write or (
-                self.group_can_write and user in self.user_group.members)
+        return user.admin or self.owner_id == user.id or self.all_can_write or (
+                self.group_can_write and is_user_group_member(user, self.user_group_id))
+
+    @classmethod
+    def read_permitted_clause(cls, user):
+        return sa.or_(cls.owner_id == user.id, cls.all_can_read,
+                      sa.and_(cls.group_can_read, user_group_member_clause(user, cls.user_group_id)))
 
 
 class FileRecordMixin(OmicsRecordMixin):
@@ -349,6 +441,8 @@ class FileRecordMixin(OmicsRecordMixin):
     def delete_file(mapper, connection, target):
         try:
             if target.filename is not None:
+                index_table = FileMetadataIndex.__table__
+                connection.execute(index_table.delete().where(index_table.c.filename == target.filename))
                 os.remove(target.filename)
         except FileNotFoundError:
             pass
@@ -368,6 +462,73 @@ class FileRecordMixin(OmicsRecordMixin):
         event.listen(cls, 'after_delete', cls.delete_file)
         event.listen(cls.id, 'set', cls.synchronize_filename)
 
+    def get_metadata_index(self):
+        """
+        Get the metadata index entry of the (hdf5) file, re-indexing the file if it changed since it was indexed.
+        :return:
+        """
+        stat = os.stat(self.filename)
+        entry = getattr(self, 'metadata_index_entry', None)
+        if entry is None and not self.is_temp:
+            entry = FileMetadataIndex.query.filter_by(filename=self.filename).first()
+        if entry is None or not entry.matches(stat):
+            entry = self.refresh_metadata_index()
+        return entry
+
+    def refresh_metadata_index(self):
+        """
+        Read the metadata of the (hdf5) file and store it in the metadata index. Should be called whenever the file is
+        written to. Temporary files are indexed only in memory.
+        :return:
+        """
+        self.metadata_index_entry = None
+        if self.filename is not None:
+            mdt.file_cache.invalidate(self.filename)
+        if self.filename is None or self.file_type != 'hdf5' or not os.path.isfile(self.filename):
+            return None
+        # stat before reading, so that a write during the read causes the next lookup to re-index the file
+        stat = os.stat(self.filename)
+        info = mdt.get_collection_info(self.filename)
+        values = {
+            'filename': self.filename,
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'row_count': info['max_row_count'],
+            'column_count': info['max_col_count'],
+            'info': json.dumps(info, default=FileMetadataIndex.json_default),
+            'attrs': json.dumps(mdt.get_file_attributes(self.filename), default=FileMetadataIndex.json_default)
+        }
+        if not self.is_temp:
+            # use a separate connection so the index can be updated without committing (and expiring) the session
+            try:
+                index_table = FileMetadataIndex.__table__
+                with db.engine.begin() as connection:
+                    connection.execute(index_table.delete().where(index_table.c.filename == self.filename))
+                    connection.execute(index_table.insert().values(**values))
+            except sa.exc.SQLAlchemyError as e:
+                print(f'Could not update metadata index for {self.filename}:\n{e}')
+        self.metadata_index_entry = FileMetadataIndex(**values)
+        return self.metadata_index_entry
+
+    @staticmethod
+    def load_metadata_indices(records):
+        """
+        Fetch the metadata index entries for many records at once, so that listing them takes one query per 500
+        records instead of opening every file.
+        :param records:
+        :return:
+        """
+        filenames = [record.filename for record in records if record.filename is not None]
+        entries = {}
+        for i in range(0, len(filenames), 500):
+            entries.update({
+                entry.filename: entry
+                for entry in FileMetadataIndex.query.filter(FileMetadataIndex.filename.in_(filenames[i:i + 500]))
+            })
+        for record in records:
+            if record.filename in entries:
+                record.metadata_index_entry = entries[record.filename]
+
     def get_file_metadata(self):
         """
         provides highest-level attributes of file
@@ -376,7 +537,14 @@ class FileRecordMixin(OmicsRecordMixin):
         # to extend to different file types, insert checks here
         if self.filename is not None:
             if self.file_type == 'hdf5':
-                return mdt.get_collection_metadata(self.filename)
+                entry = self.get_metadata_index()
+                info = json.loads(entry.info)
+                return {
+                    **json.loads(entry.attrs),
+                    'date_modified': info['date_modified'],
+                    'max_row_count': info['max_row_count'],
+                    'max_col_count': info['max_col_count']
+                }
             elif self.file_type == 'yaml':
                 return yaml.safe_load(open(self.filename, 'r'))
             elif self.file_type == 'json':
@@ -407,7 +575,7 @@ class FileRecordMixin(OmicsRecordMixin):
         # to extend to different file types, insert checks here (or overload in child class)
         if self.filename is not None:
             if self.file_type == 'hdf5':
-                return mdt.get_collection_info(self.filename)
+                return json.loads(self.get_metadata_index().info)
             else:
                 return self.get_file_metadata()
         return {}
@@ -415,7 +583,7 @@ class FileRecordMixin(OmicsRecordMixin):
     def get_file_attributes(self):
         if self.filename is not None:
             if self.file_type == 'hdf5':
-                return mdt.get_file_attributes(self.filename)
+                return json.loads(self.get_metadata_index().attrs)
             elif self.file_type == 'yaml':
                 return yaml.safe_load(open(self.filename, 'r'))
             elif self.file_type == 'json':
@@ -449,8 +617,15 @@ class NumericFileRecordMixin(FileRecordMixin):
     file_type = 'hdf5'
     file_ext = 'h5'
 
+    @classmethod
+    def prepare_to_dict(cls, records: List[Any]):
+        cls.load_metadata_indices(records)
+
     def get_dimensions(self):
-        return mdt.approximate_dims(self.filename) if self.file_exists else (None, None)
+        if self.file_exists:
+            entry = self.get_metadata_index()
+            return entry.row_count, entry.column_count
+        return None, None
 
     def get_dataset_info(self):
         return mdt.get_all_dataset_info(self.filename) if self.file_exists else {}
@@ -503,6 +678,7 @@ class NumericFileRecordMixin(FileRecordMixin):
                     del fp[path].attrs[key]
                 else:
                     del fp.attrs[key]
+            self.refresh_metadata_index()
         else:
             raise RuntimeError('File has not been downloaded! Use Session.download_file to download the file for this '
                                'record')
@@ -521,18 +697,19 @@ class NumericFileRecordMixin(FileRecordMixin):
                     fp[path].attrs[key] = value
                 else:
                     fp.attrs[key] = value
+            self.refresh_metadata_index()
         else:
             raise RuntimeError('File does not exist!')
 
     def get_dataset(self, path: str) -> np.array:
         """
-        Get a numpy array from the file.
+        Get a numpy array from the file. Contiguous numeric datasets are returned as read-only memory maps.
         :param path:
         :return:
         """
         if self.filename is not None and os.path.isfile(self.filename):
             with h5py.File(self.filename, 'r') as fp:
-                return np.asarray(fp[path])
+                return read_dataset(fp[path])
         else:
             raise RuntimeError('File does not exist!')
 
@@ -544,8 +721,9 @@ class NumericFileRecordMixin(FileRecordMixin):
         :return:
         """
         if self.filename is not None and os.path.isfile(self.filename):
-            with h5py.File(self.filename, 'r+') as fp:
+            with replace_file(self.filename) as fp:
                 del fp[path]
+            self.refresh_metadata_index()
         else:
             raise RuntimeError('File has not been downloaded! Use Session.download_file to download the file for this '
                                'record')
@@ -559,10 +737,12 @@ class NumericFileRecordMixin(FileRecordMixin):
         :return:
         """
         if self.filename is not None and os.path.isfile(self.filename):
-            with h5py.File(self.filename, 'r+') as fp:
+            with replace_file(self.filename) as fp:
                 if path in fp:
                     del fp[path]
-                fp.create_dataset(path, data=arr)
+                arr = np.asarray(arr)
+                fp.create_dataset(path, data=arr, **get_dataset_options(arr.shape, arr.dtype))
+            self.refresh_metadata_index()
         else:
             raise RuntimeError('File has not been downloaded! Use Session.download_file to download the file for this '
                                'record')
@@ -618,6 +798,7 @@ class NumericFileRecordMixin(FileRecordMixin):
 
         if self.filename is not None and os.path.isfile(self.filename):
             ct.update_array(self.filename, path, i, j, val)
+            self.refresh_metadata_index()
         else:
             raise RuntimeError('File has not been downloaded! Use Session.download_file to download the file for this '
                                'record')
@@ -631,10 +812,12 @@ class NumericFileRecordMixin(FileRecordMixin):
         """
         filenames = [self.filename] + [other.filename for other in others]
         h5_merge(filenames, self.filename, orientation='vert', reserved_paths=['/x'], align_at='/x')
+        self.refresh_metadata_index()
 
     def create_empty_file(self):
         if not self.file_exists:
-            h5py.File(self.filename, 'w')
+            h5py.File(self.filename, 'w').close()
+            self.refresh_metadata_index()
 
 
 class Analysis(OmicsRecordMixin, db.Model):
@@ -646,7 +829,7 @@ class Analysis(OmicsRecordMixin, db.Model):
     workflows = db.relationship('Workflow', secondary=workflow_analysis_membership, back_populates='analyses')
     user_group = db.relationship('UserGroup', back_populates='analyses')
 
-    def to_dict(self):
+    def to_dict(self, include_file_info: bool = True):
         return {
             'id': self.id,
             'name': self.name,
@@ -659,13 +842,25 @@ class Analysis(OmicsRecordMixin, db.Model):
             'all_can_read': self.all_can_read,
             'all_can_write': self.all_can_write,
             'user_group_id': self.user_group_id,
-            'collections': [collection.to_dict() for collection in self.collections],
+            'collections': [collection.to_dict(include_file_info) for collection in self.collections],
             'workflows': [workflow.to_dict() for workflow in self.workflows],
-            'external_files': [external_file.to_dict() for external_file in self.external_files],
+            'external_files': [external_file.to_dict(include_file_info) for external_file in self.external_files],
             'created_on': self.created_on.isoformat(),
             'updated_on': self.updated_on.isoformat()
         }
 
+    @classmethod
+    def get_to_dict_load_options(cls) -> List[Any]:
+        return [
+            selectinload(cls.collections).selectinload(Collection.analyses),
+            selectinload(cls.workflows).selectinload(Workflow.analyses),
+            selectinload(cls.external_files).selectinload(ExternalFile.analyses)
+        ]
+
+    @classmethod
+    def prepare_to_dict(cls, records: List[Any]):
+        Collection.prepare_to_dict([collection for record in records for collection in record.collections])
+
 
 class Sample(NumericFileRecordMixin, db.Model):
     __tablename__ = 'sample'
@@ -673,7 +868,7 @@ class Sample(NumericFileRecordMixin, db.Model):
     sample_groups = db.relationship('SampleGroup', secondary=sample_group_membership, back_populates='samples')
     data_path = f'{DATADIR}/samples'
 
-    def to_dict(self):
+    def to_dict(self, include_file_info: bool = True):
         return {
             'id': self.id,
             'name': self.name,
@@ -689,11 +884,15 @@ class Sample(NumericFileRecordMixin, db.Model):
             'filename': self.filename,
             'file_type': self.file_type,
             'sample_group_ids': [group.id for group in self.sample_groups],
-            'file_info': self.get_file_info() if self.file_exists else {},
+            'file_info': self.get_file_info() if include_file_info and self.file_exists else {},
             'created_on': self.created_on.isoformat(),
             'updated_on': self.updated_on.isoformat()
         }
 
+    @classmethod
+    def get_to_dict_load_options(cls) -> List[Any]:
+        return [selectinload(cls.sample_groups)]
+
 
 class SampleGroup(OmicsRecordMixin, db.Model):
     __tablename__ = 'sample_group'
@@ -701,7 +900,7 @@ class SampleGroup(OmicsRecordMixin, db.Model):
     samples = db.relationship('Sample', secondary=sample_group_membership, back_populates='sample_groups')
     upload_job_id = db.Column(db.String)
 
-    def to_dict(self):
+    def to_dict(self, include_file_info: bool = True):
         return {
             'id': self.id,
             'name': self.name,
@@ -715,30 +914,41 @@ class SampleGroup(OmicsRecordMixin, db.Model):
             'all_can_write': self.all_can_write,
             'user_group_id': self.user_group_id,
             'upload_job_id': self.upload_job_id,
-            'samples': [sample.to_dict() for sample in self.samples],
+            'samples': [sample.to_dict(include_file_info) for sample in self.samples],
             'created_on': self.created_on.isoformat(),
             'updated_on': self.updated_on.isoformat()
         }
 
+    @classmethod
+    def get_to_dict_load_options(cls) -> List[Any]:
+        return [selectinload(cls.samples).selectinload(Sample.sample_groups)]
+
+    @classmethod
+    def prepare_to_dict(cls, records: List[Any]):
+        Sample.prepare_to_dict([sample for record in records for sample in record.samples])
+
 
 class Collection(NumericFileRecordMixin, db.Model):
     __tablename__ = 'collection'
     id = db.Column(db.Integer, primary_key=True)  # needed to make backref on children work properly
     user_group = db.relationship('UserGroup', back_populates='collections')
     analyses = db.relationship('Analysis', secondary=collection_analysis_membership, back_populates='collections')
-    parent_id = db.Column(db.Integer, db.ForeignKey('collection.id'))
+    parent_id = db.Column(db.Integer, db.ForeignKey('collection.id'), index=True)
     children = db.relationship('Collection', backref=db.backref('parent', remote_side=[id]))
     data_path = f'{DATADIR}/collections'
     kind = db.Column(db.String, default='data')  # should be 'data' or 'results'
 
     def merge_samples(self, samples: List[Sample], sort_by: str = 'base_sample_id'):
         h5_merge([sample.filename for sample in samples], self.filename, orientation='vert',
-                 reserved_paths=['/x'], align_at='/x', sort_by=sort_by, merge_attributes=True)
+                 reserved_paths=['/x'], align_at='/x', sort_by=sort_by, merge_attributes=True, streaming=True,
+                 processes=MERGE_PROCESSES)
+        self.refresh_metadata_index()
 
     def create_label_column(self, name: str, data_type: str = 'string'):
         mdt.add_column(self.filename, name, data_type)
+        self.refresh_metadata_index()
 
-    def to_dict(self):
+    def to_dict(self, include_file_info: bool = True):
         return {
             'id': self.id,
             'name': self.name,
@@ -755,11 +965,15 @@ class Collection(NumericFileRecordMixin, db.Model):
             'filename': self.filename,
             'file_type': self.file_type,
             'analysis_ids': [analysis.id for analysis in self.analyses],
-            'file_info': self.get_file_info() if self.file_exists else {},
+            'file_info': self.get_file_info() if include_file_info and self.file_exists else {},
             'created_on': self.created_on.isoformat(),
             'updated_on': self.updated_on.isoformat()
         }
 
+    @classmethod
+    def get_to_dict_load_options(cls) -> List[Any]:
+        return [selectinload(cls.analyses)]
+
 
 class ExternalFile(FileRecordMixin, db.Model):
     __tablename__ = 'external_file'
@@ -830,7 +1044,7 @@ class ExternalFile(FileRecordMixin, db.Model):
     def file_exists(self):
         return super().file_exists or self.is_directory
 
-    def to_dict(self):
+    def to_dict(self, include_file_info: bool = True):
         return {
             'id': self.id,
             'name': self.name,
@@ -846,12 +1060,16 @@ class ExternalFile(FileRecordMixin, db.Model):
             'filename': self.filename,
             'file_type': self.file_type,
             'analysis_ids': [analysis.id for analysis in self.analyses],
-            'file_info': self.get_file_info() if self.file_exists else {},
+            'file_info': self.get_file_info() if include_file_info and self.file_exists else {},
             'created_on': self.created_on.isoformat(),
             'updated_on': self.updated_on.isoformat(),
             'children': self.children if self.children is not None else []
         }
 
+    @classmethod
+    def get_to_dict_load_options(cls) -> List[Any]:
+        return [selectinload(cls.analyses)]
+
 
 class Workflow(FileRecordMixin, db.Model):
     __tablename__ = 'workflow'
@@ -899,6 +1117,37 @@ class Workflow(FileRecordMixin, db.Model):
             'updated_on': self.updated_on.isoformat()
         }
 
+    @classmethod
+    def get_to_dict_load_options(cls) -> List[Any]:
+        return [selectinload(cls.analyses)]
+
+
+class FileMetadataIndex(db.Model):
+    """
+    The metadata of an hdf5 file (as given by mdt.get_collection_info and mdt.get_file_attributes), so that records can
+    be listed without opening their files. An entry is out of date when the size or modification time of the file no
+    longer match. Entries are written by FileRecordMixin.refresh_metadata_index.
+    """
+    __tablename__ = 'file_metadata_index'
+    filename = db.Column(db.String, nullable=False, unique=True, index=True)
+    mtime_ns = db.Column(db.BigInteger)
+    size = db.Column(db.BigInteger)
+    row_count = db.Column(db.Integer)
+    column_count = db.Column(db.Integer)
+    info = db.Column(db.Text)  # JSON of mdt.get_collection_info
+    attrs = db.Column(db.Text)  # JSON of mdt.get_file_attributes
+
+    def matches(self, stat: os.stat_result) -> bool:
+        return self.mtime_ns == stat.st_mtime_ns and self.size == stat.st_size
+
+    @staticmethod
+    def json_default(value):
+        if isinstance(value, bytes):
+            return value.decode('utf-8', errors='ignore')
+        if hasattr(value, 'tolist'):
+            return value.tolist()
+        return str(value)
+
 
 class UserInvitation(db.Model):
     __tablename__ = 'user_invitation'
@@ -1,11 +1,15 @@
 import json
 from io import StringIO
-from typing import Dict, Union, Any, List
+from typing import Dict, Union, Any, List, Iterator, Mapping
 
 import h5py
 import numpy as np
 import pandas as pd
 
+import data_tools.file_tools.metadata_tools as mdt
+from data_tools.file_tools.h5_merge import DEFAULT_CHUNK_BYTES
+from data_tools.file_tools.layout_tools import get_dataset_options, read_dataset, replace_file
+
 
 def convert_strings(arr):
     # type: (np.array) -> np.array
@@ -28,9 +32,11 @@ def create_collection_file(datasets: Dict[str, Any], attrs: Dict[str, Any], file
             if value.dtype != np.number:
                 if isinstance(value, np.ndarray):
                     value = np.array([','.join([str(v) for v in val]) for val in value]).reshape(-1, 1)
-                file.create_dataset(str(name), data=value.astype(np.string_), dtype=h5py.special_dtype(vlen=bytes))
+                dtype = h5py.special_dtype(vlen=bytes)
+                file.create_dataset(str(name), data=value.astype(np.string_), dtype=dtype,
+                                    **get_dataset_options(value.shape, dtype))
             else:
-                file.create_dataset(str(name), data=value)
+                file.create_dataset(str(name), data=value, **get_dataset_options(value.shape, value.dtype))
         file.attrs.update(attrs)
 
 
@@ -49,35 +55,81 @@ def get_dataframe(filename: str,
     :param include_labels: Whether or not to include those datasets with the same number of rows as Y (row labels).
     :param numeric_columns: Whether the column names for Y should take the form x_i as opposed to Y_{x_i}.
     :param include_only_labels: Whether to exclude 'Y' entirely and only include those datasets with the same number of rows as Y, but not Y.
-    :return:
+    :return: The columns of contiguous numeric datasets are read-only views of memory maps (see read_dataset), so copy
+    the dataframe before changing its values.
     """
-    include_labels = include_only_labels or include_labels
     with h5py.File(filename, 'r') as fp:
-        if 'Y' not in fp and not keys:
-            raise ValueError('No \'Y\' dataset in file and no other keys specified.')
-        if keys:
-            row_count = fp[keys[0]].shape[0]
+        return get_dataframe_from_datasets(fp, row_index_key, keys, include_labels, numeric_columns,
+                                           include_only_labels)
+
+
+def get_dataframe_from_datasets(fp: Mapping[str, Any],
+                                row_index_key: str = 'base_sample_id',
+                                keys: List[str] = None,
+                                include_labels: bool = True,
+                                numeric_columns: bool = False,
+                                include_only_labels: bool = False) -> pd.DataFrame:
+    """
+    Get a Pandas DataFrame from an open hdf5 file or a dictionary of arrays keyed like the datasets of a file. See
+    get_dataframe for the parameters.
+    """
+    include_labels = include_only_labels or include_labels
+    if 'Y' not in fp and not keys:
+        raise ValueError('No \'Y\' dataset in file and no other keys specified.')
+    if keys:
+        row_count = fp[keys[0]].shape[0]
+    else:
+        row_count = fp['Y'].shape[0]
+        keys = [key for key in fp.keys() if (fp[key].shape[0] == row_count)] if include_labels else ['Y']
+    index = np.asarray(fp[row_index_key]).flatten() if row_index_key in fp else [i for i in range(0, row_count)]
+    if include_only_labels and 'Y' in keys:
+        keys.remove('Y')
+    frames = []
+    for key in keys:
+        if key in {'Y', '/Y'}:
+            columns = [str(x_i) if numeric_columns else 'Y_{}'.format(x_i)
+                       for x_i in np.asarray(fp['x']).flatten().tolist()] \
+                if 'x' in fp else [str(i + 1) if numeric_columns else 'Y_{}'.format(i + 1)
+                                   for i in range(0, fp['Y'].shape[1])]
         else:
-            row_count = fp['Y'].shape[0]
-            keys = [key for key in fp.keys() if (fp[key].shape[0] == row_count)] if include_labels else ['Y']
-        index = np.asarray(fp[row_index_key]).flatten() if row_index_key in fp else [i for i in range(0, row_count)]
-        df = pd.DataFrame(index=index)
-        if include_only_labels and 'Y' in keys:
-            keys.remove('Y')
-        for key in keys:
-            if key in {'Y', '/Y'}:
-                columns = [str(x_i) if numeric_columns else 'Y_{}'.format(x_i)
-                           for x_i in np.asarray(fp['x']).flatten().tolist()] \
-                    if 'x' in fp else [str(i + 1) if numeric_columns else 'Y_{}'.format(i + 1)
-                                       for i in range(0, fp['Y'].shape[1])]
-            else:
-                column_count = fp[key].shape[1] if len(fp[key].shape) > 1 else 1
-                columns = ['{}_{}'.format(key, i + 1) for i in range(0, column_count)] if column_count > 1 else [key]
-            data = convert_strings(np.asarray(fp[key]))
-            new_df = pd.DataFrame(columns=columns, data=data, index=index)
-            df = pd.concat((df, new_df), axis=1)
-        df.index.name = row_index_key if row_index_key is not None else 'id'
-        return df
+            column_count = fp[key].shape[1] if len(fp[key].shape) > 1 else 1
+            columns = ['{}_{}'.format(key, i + 1) for i in range(0, column_count)] if column_count > 1 else [key]
+        data = fp[key]
+        data = convert_strings(read_dataset(data) if isinstance(data, h5py.Dataset) else np.asarray(data))
+        frames.append(pd.DataFrame(data, index=index, columns=columns, copy=False))
+    # the other columns are inserted into the frame of Y, because concatenating frames would copy a memory-mapped Y
+    y_position = next((i for i, key in enumerate(keys) if key in {'Y', '/Y'}), 0)
+    widths = [len(frame.columns) for frame in frames]
+    df = frames[y_position] if frames else pd.DataFrame(index=index)
+    for i, frame in enumerate(frames):
+        if i != y_position:
+            for j, column in enumerate(frame.columns):
+                df.insert(sum(widths[:i]) + j, column, frame.iloc[:, j], allow_duplicates=True)
+    df.index.name = row_index_key if row_index_key is not None else 'id'
+    return df
+
+
+def get_dataframe_block(file: h5py.File, rows: slice = slice(None), single_column: bool = False) -> pd.DataFrame:
+    """Get a pandas dataframe of some rows of a collection, as serialized by get_serialized_dataframe"""
+    index = np.asarray(file['base_sample_id'][rows]).flatten() if 'base_sample_id' in file \
+        else [i for i in range(0, file['Y'].shape[0])][rows]
+    additional_columns = [key for key in file.keys() if key != 'base_sample_id'
+                          and (file[key].shape[0] == file['Y'].shape[0] if 'Y' in file else False)
+                          and (len(file[key].shape) == 1 or len(file[key].shape) == 2 and file[key].shape[1] == 1)]
+    df = pd.DataFrame(index=index) if single_column else pd.DataFrame(data=np.asarray(file['/Y'][rows]),
+                                                                      columns=np.asarray(file['/x']).flatten().tolist(),
+                                                                      index=index)
+    df.index.name = 'base_sample_id' if 'base_sample_id' in file else 'id'
+    # collect additional columns
+    for key in additional_columns:
+        if file[key].dtype.type is np.string_ or file[key].dtype.type is np.object_:
+            try:
+                df[key] = [row.decode('utf-8') for row in np.asarray(file[key][rows]).flatten()]
+            except Exception:
+                pass
+        else:
+            df[key] = np.asarray(file[key][rows])
+    return df
 
 
 def get_serialized_dataframe(filename: str, single_column: bool = False, data_format='csv', json_orient='records') \
@@ -85,30 +137,101 @@ def get_serialized_dataframe(filename: str, single_column: bool = False, data_fo
     """Get a string containing a CSV of a pandas dataframe of a collection"""
     """Note: this requires that there be datasets /Y and /x corresponding to an x-axis and y-values for that axis"""
     # TODO: make this not require datasets called /x and /Y
+    if data_format != 'json':
+        return ''.join(iterate_serialized_dataframe(filename, single_column))
     buf = StringIO()
     with h5py.File(filename, 'r') as file:
-        index = np.asarray(file['base_sample_id']).flatten() if 'base_sample_id' in file else [i for i in range(0, file['Y'].shape[0])]
-        additional_columns = [key for key in file.keys() if key != 'base_sample_id'
-            and (file[key].shape[0] == file['Y'].shape[0] if 'Y' in file else False)
-                              and (len(file[key].shape) == 1 or len(file[key].shape) == 2 and file[key].shape[1] == 1)]
-        df = pd.DataFrame(index=index) if single_column else pd.DataFrame(data=np.asarray(file['/Y']),
-                                                                          columns=np.asarray(file['/x']).flatten().tolist(),
-                                                                          index=index)
-        df.index.name = 'base_sample_id' if 'base_sample_id' in file else 'id'
-        # collect additional columns
-        for key in additional_columns:
-            if file[key].dtype.type is np.string_ or file[key].dtype.type is np.object_:
-                try:
-                    df[key] = [row.decode('utf-8') for row in np.asarray(file[key]).flatten()]
-                except Exception:
-                    pass
-            else:
-                df[key] = np.asarray(file[key])
-    if data_format == 'json':
-        df.to_json(buf, orient=json_orient)
-    else:
-        df.to_csv(buf)
-    return json.loads(buf.getvalue()) if data_format == 'json' else buf.getvalue()
+        df = get_dataframe_block(file, single_column=single_column)
+    df.to_json(buf, orient=json_orient)
+    return json.loads(buf.getvalue())
+
+
+def iterate_serialized_dataframe(filename: str, single_column: bool = False, block_size: int = 1024 ** 2) \
+        -> Iterator[str]:
+    """
+    Get the CSV of a pandas dataframe of a collection (as in get_serialized_dataframe) in blocks of rows, reading only
+    one block of the collection at a time. Errors opening the file are raised by this function, not by the iterator.
+    :param filename:
+    :param single_column: whether to only include single-column attributes in dataframe
+    :param block_size: Approximate number of values in each block
+    :return:
+    """
+    file = h5py.File(filename, 'r')
+
+    def generate():
+        with file:
+            row_count = file['base_sample_id'].shape[0] if 'base_sample_id' in file else file['Y'].shape[0]
+            block_rows = max(1, block_size // (1 if single_column else max(1, file['Y'].shape[1])))
+            for i in range(0, max(row_count, 1), block_rows):
+                buf = StringIO()
+                get_dataframe_block(file, slice(i, i + block_rows), single_column).to_csv(buf, header=i == 0)
+                yield buf.getvalue()
+
+    return generate()
+
+
+def parse_range(range_str: str, length: int) -> slice:
+    """
+    Parse a half-open range of the form 'start:stop', where either bound may be omitted, or a single index
+    :param range_str:
+    :param length: The size of the dimension the range applies to
+    :return:
+    """
+    try:
+        if ':' in range_str:
+            start, stop = range_str.split(':')
+            start = int(start) if start else 0
+            stop = int(stop) if stop else length
+        else:
+            start = int(range_str)
+            stop = start + 1
+    except ValueError:
+        raise ValueError(f'Improper range {range_str}. Ranges take the form start:stop.')
+    if not 0 <= start <= stop <= length:
+        raise ValueError(f'Range {range_str} is out of bounds for a dimension of size {length}.')
+    return slice(start, stop)
+
+
+def write_collection_slice(filename: str, out_filename: str, rows: str = None, cols: str = None,
+                           chunk_bytes: int = DEFAULT_CHUNK_BYTES):
+    """
+    Write a copy of a collection containing only some rows and columns of /Y. Labels (datasets with as many rows as /Y)
+    are sliced by rows, /x and other datasets with as many columns as /Y are sliced by columns and anything else is
+    copied whole. Data is copied in blocks of at most chunk_bytes, so the whole collection is never held in memory.
+    :param filename:
+    :param out_filename:
+    :param rows: A range of rows of /Y for parse_range. All rows if None.
+    :param cols: A range of columns of /Y for parse_range. All columns if None.
+    :param chunk_bytes:
+    :return:
+    """
+    with h5py.File(filename, 'r') as infile, h5py.File(out_filename, 'w') as outfile:
+        if 'Y' not in infile:
+            raise ValueError('No \'Y\' dataset in file.')
+        row_count, col_count = infile['Y'].shape[0], infile['Y'].shape[1]
+        rows = parse_range(rows, row_count) if rows else slice(0, row_count)
+        cols = parse_range(cols, col_count) if cols else slice(0, col_count)
+        outfile.attrs.update(infile.attrs)
+        _, dataset_paths = mdt.scan_tree(infile)
+        for path in dataset_paths:
+            dataset = infile[path]
+            shape = dataset.shape
+            row_slice = rows if len(shape) and shape[0] == row_count and path != '/x' else slice(None)
+            col_slice = cols if len(shape) > 1 and shape[1] == col_count else slice(None)
+            selection = (row_slice, col_slice)[:len(shape)]
+            new_shape = tuple(len(range(*sel.indices(size))) for sel, size in zip(selection, shape)) + shape[2:]
+            new_dataset = outfile.create_dataset(path, shape=new_shape, dtype=dataset.dtype,
+                                                 **get_dataset_options(new_shape, dataset.dtype))
+            new_dataset.attrs.update(dataset.attrs)
+            if not len(shape):
+                new_dataset[()] = dataset[()]
+                continue
+            row_bytes = max(1, int(np.prod(new_shape[1:], dtype=np.int64)) * dataset.dtype.itemsize)
+            block_rows = max(1, chunk_bytes // row_bytes)
+            start = row_slice.start or 0
+            for i in range(0, new_shape[0], block_rows):
+                block = slice(start + i, start + min(i + block_rows, new_shape[0]))
+                new_dataset[i:i + block_rows] = dataset[(block,) + selection[1:]]
 
 
 def update_array(filename: str, path: str, i: int, j: int, val):
@@ -120,6 +243,7 @@ def update_array(filename: str, path: str, i: int, j: int, val):
             file[path][int(i)] = val
         else:
             file[path][int(i), int(j)] = val
+    mdt.file_cache.invalidate(filename)
 
 
 def validate_update(filename: str, path: str, i: int, j: int, val: Any):
@@ -140,17 +264,18 @@ def get_dataset(filename: str, path: str, convert_strings=False):
     with h5py.File(filename, 'r') as file:
         # get shape and try to flatten if 1 row or 1 column
         if max(file[path].shape) + 1 >= sum(file[path].shape):
-            val = np.asarray(file[path]).flatten()
+            val = read_dataset(file[path]).ravel()
         else:
-            val = np.asarray(file[path])
+            val = read_dataset(file[path])
         if convert_strings:
             return np.asarray([row.decode('ascii') if isinstance(row, bytes) else row for row in val])
         return val
 
 
 def delete(filename: str, path: str, obj, axis=None):
-    with h5py.File(filename, 'r+') as file:
+    with replace_file(filename) as file:
         arr = np.array(file[path])
         arr = np.delete(arr, obj, axis)
         del file[path]
-        file[path] = arr
+        file.create_dataset(path, data=arr, **get_dataset_options(arr.shape, arr.dtype))
+    mdt.file_cache.invalidate(filename)
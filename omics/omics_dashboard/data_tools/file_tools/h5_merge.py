@@ -1,49 +1,133 @@
+import hashlib
+import multiprocessing
 import os
+import posixpath
 import shutil
 import tempfile
 import numpy as np
 import h5py
-from scipy.interpolate import interp1d
-from typing import List, Set, Tuple, Callable
+from functools import partial
+from typing import List, Set, Tuple, Callable, Dict, Any, Mapping
+
+from data_tools.file_tools.layout_tools import get_dataset_options
+from data_tools.file_tools.metadata_tools import scan_tree
+
+# Upper bound on the size of each block read from an input file by the streaming merge
+DEFAULT_CHUNK_BYTES = 64 * 1024 ** 2
 
 
 def get_paths(group: h5py.Group, path: str) -> Set[str]:
     """Recursively find all the paths of Datasets which are children of this group"""
     """The first call should have an empty string for path"""
-    out = set()
-    for key in group.keys():
-        if isinstance(group[key], h5py.Group):
-            out |= get_paths(group[key], f'{path}/{key}')
-        if isinstance(group[key], h5py.Dataset):
-            out.add(f'{path}/{key}')
-    return out
+    _, dataset_paths = scan_tree(group)
+    return {f'{path}/{posixpath.relpath(dataset_path, group.name)}' for dataset_path in dataset_paths}
 
 
-def paths_agree(file1: h5py.File, file2: h5py.File, path: str, dim: int) -> bool:
-    """Check if the paths in two files have the same size in the specified dimension"""
+def shapes_agree(shape1: Tuple[int, ...], shape2: Tuple[int, ...], dim: int) -> bool:
+    """Check if two dataset shapes have the same size in the specified dimension"""
     try:
-        return (path in file1) and (path in file2) and file1[path].shape[dim] == file2[path].shape[dim]
+        return shape1[dim] == shape2[dim]
     except IndexError:
         # 1D arrays do weird things
-        return len(file1[path].shape) == len(file2[path].shape) == dim == 1
+        return len(shape1) == len(shape2) == dim == 1
+
+
+def paths_agree(file1: h5py.File, file2: h5py.File, path: str, dim: int) -> bool:
+    """Check if the paths in two files have the same size in the specified dimension"""
+    return (path in file1) and (path in file2) and shapes_agree(file1[path].shape, file2[path].shape, dim)
 
 
 def get_range(files: List[h5py.File], path: str) -> (int, int):
     """Get the smallest and largest values of the datasets with the specified path in the files"""
-    extrema = [(np.amin(file[path][:]), np.amax(file[path][:])) for file in files]
+    extrema = [(np.amin(values), np.amax(values)) for values in (file[path][()] for file in files)]
     return max([val[0] for val in extrema]), min([val[1] for val in extrema])
 
 
+def grid_key(grid: np.array) -> str:
+    """Get a hash of the values of an alignment grid, so that identical grids can be found without comparing them"""
+    return hashlib.sha1(np.ascontiguousarray(np.ravel(grid), dtype=np.float64).tobytes()).hexdigest()
+
+
+def group_by_grid(grids: List[np.array]) -> Dict[str, List[int]]:
+    """Get the indices of the grids which are identical to each other, keyed by grid_key"""
+    groups = {}
+    for i, grid in enumerate(grids):
+        groups.setdefault(grid_key(grid), []).append(i)
+    return groups
+
+
+def make_alignment_grid(extrema: List[Tuple[float, float]], sizes: List[int], common_grid: np.array = None) -> np.array:
+    """
+    Get the grid that all records are interpolated onto
+    :param extrema: The (min, max) of each grid
+    :param sizes: The number of points in each grid
+    :param common_grid: The grid shared by every record, if all of them have the same grid
+    :return: common_grid sorted ascending if provided, otherwise evenly spaced ascending points over the range covered
+    by all the grids
+    """
+    if common_grid is not None:
+        return np.sort(np.ravel(common_grid))
+    return np.linspace(max([val[0] for val in extrema]), min([val[1] for val in extrema]), min(sizes))
+
+
+def batch_interpolate(x: np.array, values: np.array, new_x: np.array) -> np.array:
+    """
+    Linearly interpolate every row of values from the grid x to the grid new_x at once.
+    Equivalent to interp1d(x, values, assume_sorted=False)(new_x), but x is only sorted and searched once for all rows.
+    If new_x is x sorted, values are only reordered.
+    :param x: The 1D grid of values along its last axis
+    :param values: An array whose last axis corresponds to x
+    :param new_x: The 1D grid to interpolate to. Must lie within the range of x.
+    :return: An array with the same leading dimensions as values and last dimension the size of new_x
+    """
+    x = np.ravel(x)
+    diffs = np.diff(x)
+    if np.all(diffs <= 0):
+        # descending grids (like ppm) only need a view to be sorted
+        x, values = x[::-1], values[..., ::-1]
+    elif not np.all(diffs >= 0):
+        order = np.argsort(x, kind='mergesort')
+        x, values = x[order], values[..., order]
+    if np.array_equal(x, new_x):
+        return values
+    if np.amin(new_x) < x[0] or np.amax(new_x) > x[-1]:
+        raise ValueError('A value in new_x is outside of the interpolation range.')
+    hi = np.clip(np.searchsorted(x, new_x, side='right'), 1, x.size - 1)
+    lo = hi - 1
+    spacing = x[hi] - x[lo]
+    weights = np.divide(new_x - x[lo], spacing, out=np.zeros(new_x.shape, dtype=np.float64), where=spacing != 0)
+    return values[..., lo] * (1 - weights) + values[..., hi] * weights
+
+
 def interpolate(files: List[h5py.File], align_path: str, target_path: str, concat_fn: Callable) -> Tuple[
     np.array, np.array]:
-    align_min, align_max = get_range(files, align_path)
-    array_length = min([file[align_path].size for file in files])
-    new_align = np.linspace(align_min, align_max, array_length)
-    aligned = concat_fn(
-        [interp1d(np.ravel(file[align_path]), np.asarray(file[target_path]), assume_sorted=False)(new_align) for file in
-         files])
+    """
+    Interpolate the datasets at target_path in all the files onto a common grid and concatenate them.
+    Files with identical grids are interpolated together with one call to batch_interpolate, and files whose grid is
+    already the common grid are not interpolated at all.
+    """
+    grids = [np.ravel(file[align_path]) for file in files]
+    groups = group_by_grid(grids)
+    new_align = make_alignment_grid([(np.amin(grid), np.amax(grid)) for grid in grids],
+                                    [grid.size for grid in grids],
+                                    grids[0] if len(groups) == 1 else None)
+    aligned = [None] * len(files)
+    for inds in groups.values():
+        grid = grids[inds[0]]
+        values = [np.asarray(files[i][target_path]) for i in inds]
+        if np.array_equal(grid, new_align):
+            results = values
+        else:
+            # interpolate the rows of every file in this group at once
+            rows = [int(np.prod(value.shape[:-1])) for value in values]
+            interpolated = batch_interpolate(grid, np.concatenate([value.reshape(-1, grid.size) for value in values]),
+                                             new_align)
+            results = [result.reshape(value.shape[:-1] + (new_align.size,)) for result, value in
+                       zip(np.split(interpolated, np.cumsum(rows)[:-1]), values)]
+        for i, result in zip(inds, results):
+            aligned[i] = result
     # make new_align a m x 1 or 1 x n instead of 1D
-    return new_align, aligned
+    return new_align, concat_fn(aligned)
 
 
 def make_2d(arr, dim_ind):
@@ -56,9 +140,81 @@ def make_2d(arr, dim_ind):
     return arr
 
 
+def write_merged_attributes(outfile: h5py.File, file_attrs: List[Mapping[str, Any]], in_filenames: List[str],
+                            merge_paths: Set[str], reserved_paths: List[str], orientation: str = 'vert',
+                            sort_by: str = 'base_sample_id', merge_attributes: bool = False) -> None:
+    """
+    Write the attributes of the merged files to the output file, either as label datasets or as file attributes
+    :param outfile: The (open) output file
+    :param file_attrs: The attributes of each input file, in the same order as in_filenames
+    :param in_filenames: The filenames of the input files
+    :param merge_paths: The paths which were concatenated
+    :param reserved_paths: Paths that are assumed identical between collections
+    :param orientation: Whether files were concatenated vertically ("vert") or horizontally ("horiz")
+    :param sort_by: the name of the field in the final collection to sort columns/rows by
+    :param merge_attributes: Whether to create new datasets by concatenating common attributes
+    """
+    # if we concat vertically, labels are 1 column
+    # if we concat horizontally, labels are 1 row
+    label_shape = (len(in_filenames), 1) if orientation == 'vert' else (1, len(in_filenames))
+    label_axis = 0 if orientation == 'vert' else 1
+
+    merge_attrs = set(
+        item for entry in file_attrs for item in entry.keys() if all(item in attrs for attrs in file_attrs)
+    )
+
+    # have to handle some attrs differently
+    ignored_attrs = {'name', 'description', 'createdBy', 'owner', 'allPermissions', 'groupPermissions'}
+    merge_attrs = {attr for attr in merge_attrs if attr not in ignored_attrs} if merge_attributes else {}
+
+    for attr_key in merge_attrs:
+        values = np.array([[attrs[attr_key].encode('ascii')
+                            if isinstance(attrs[attr_key], str) else attrs[attr_key] for attrs in file_attrs]])
+        if len(values):
+            if isinstance(file_attrs[0][attr_key], str):
+                # noinspection PyUnresolvedReferences
+                dtype = h5py.special_dtype(vlen=bytes)
+                outfile.create_dataset(attr_key, data=np.reshape(values, label_shape), dtype=dtype,
+                                       **get_dataset_options(label_shape, dtype, label_axis))
+            else:
+                outfile.create_dataset(attr_key, data=np.reshape(values, label_shape),
+                                       **get_dataset_options(label_shape, values.dtype, label_axis))
+
+    if merge_attributes:
+        base_sample_ids = np.array(
+            [[int(os.path.basename(os.path.splitext(infilename)[0])) for infilename in in_filenames]])
+        # unicode datasets are not supported by all software using hdf5
+        base_sample_names = np.array([[attrs['name'].encode('ascii')
+                                       if isinstance(attrs['name'], str) else attrs['name'] for attrs in
+                                       file_attrs]])
+        # noinspection PyUnresolvedReferences
+        outfile.create_dataset('base_sample_id', data=np.reshape(base_sample_ids, label_shape),
+                               **get_dataset_options(label_shape, base_sample_ids.dtype, label_axis))
+        # noinspection PyUnresolvedReferences
+        dtype = h5py.special_dtype(vlen=bytes)
+        outfile.create_dataset('base_sample_name', data=np.reshape(base_sample_names, label_shape),
+                               dtype=dtype,
+                               **get_dataset_options(label_shape, dtype, label_axis))
+
+        # Sort everything by the specified sort_by path
+        ind = np.argsort(outfile[sort_by])[0, :]
+        for key in merge_attrs.intersection(merge_paths):
+            if key not in reserved_paths:
+                try:
+                    outfile[key][:] = np.asarray(outfile[key])[:, ind]
+                except KeyError as e:
+                    print(f'Failed on key: {key}: key not found.\n{e}')
+                except TypeError as e:
+                    print(f'failed on key: {key}: incompatible dimensions.\n{e}')
+    else:
+        for key, value in file_attrs[0].items():
+            outfile.attrs[key] = value
+
+
 # noinspection PyUnresolvedReferences
 def h5_merge(in_filenames: List[str], out_filename: str, orientation: str = 'vert', reserved_paths: List[str] = None,
-             sort_by: str = 'base_sample_id', align_at: str = None, merge_attributes: bool = False) -> None:
+             sort_by: str = 'base_sample_id', align_at: str = None, merge_attributes: bool = False,
+             streaming: bool = False, chunk_bytes: int = DEFAULT_CHUNK_BYTES, processes: int = 1) -> None:
     """
     Merge a list of hdf5 files into a single file
     :param in_filenames: A list of filenames to merge
@@ -68,7 +224,17 @@ def h5_merge(in_filenames: List[str], out_filename: str, orientation: str = 'ver
     :param sort_by: the name of the field in the final collection to sort columns/rows by
     :param align_at: the name of the label field to sort records by
     :param merge_attributes: Whether to create new datasets by concatenating common attributes
+    :param streaming: Whether to use streaming_h5_merge, which never holds all of the input files in memory
+    :param chunk_bytes: The approximate size of the blocks copied at a time when streaming is True
+    :param processes: The number of processes used when streaming is True. If not 1, parallel_h5_merge is used, with
+    None meaning one process per CPU.
     """
+    if streaming and processes != 1:
+        return parallel_h5_merge(in_filenames, out_filename, orientation, reserved_paths, sort_by, align_at,
+                                 merge_attributes, chunk_bytes, processes)
+    if streaming:
+        return streaming_h5_merge(in_filenames, out_filename, orientation, reserved_paths, sort_by, align_at,
+                                  merge_attributes, chunk_bytes)
     if reserved_paths is None:
         reserved_paths = []
     files = [h5py.File(filename, "r", driver="core") for filename in in_filenames]
@@ -76,20 +242,12 @@ def h5_merge(in_filenames: List[str], out_filename: str, orientation: str = 'ver
     # collect all common paths between the files
     concat_fn = np.vstack if orientation == 'vert' else np.hstack
     dim_ind = 1 if orientation == 'vert' else 0
-
-    # if we concat vertically, labels are 1 column
-    # if we concat horizontally, labels are 1 row
-    label_shape = (len(in_filenames), 1) if orientation == 'vert' else (1, len(in_filenames))
-    label_maxshape = (None, 1) if orientation == 'vert' else (1, None)
+    concat_ind = 1 - dim_ind
 
     paths = set()
     for file in files:
         paths |= get_paths(file, "")
 
-    merge_attrs = set(
-        item for entry in files for item in entry.attrs.keys() if all(item in entry.attrs for entry in files)
-    )
-
     alignment_paths = set(
         path for path in paths
         if all(
@@ -116,63 +274,377 @@ def h5_merge(in_filenames: List[str], out_filename: str, orientation: str = 'ver
                 align_shape[dim_ind] = align.size
                 outfile.create_dataset(path,
                                        data=aligned,
-                                       maxshape=(None, None))
+                                       **get_dataset_options(aligned.shape, aligned.dtype, concat_ind))
                 if align_at not in outfile:
                     outfile.create_dataset(align_at,
                                            data=np.reshape(align, align_shape),
-                                           maxshape=(None, None))
+                                           **get_dataset_options(align_shape, align.dtype, concat_ind))
         # plain concatenation
         for path in merge_paths:
             if path in reserved_paths and path is not align_at:
                 outfile.create_dataset(path,
                                        data=files[0][path],
-                                       maxshape=(None, None))
+                                       **get_dataset_options(files[0][path].shape, files[0][path].dtype, concat_ind))
             else:
+                data = concat_fn([make_2d(file[path], dim_ind) for file in files])
                 outfile.create_dataset(path,
-                                       data=concat_fn([make_2d(file[path], dim_ind) for file in files]),
-                                       maxshape=(None, None), dtype=files[0][path].dtype)
-        # have to handle some attrs differently
-        ignored_attrs = {'name', 'description', 'createdBy', 'owner', 'allPermissions', 'groupPermissions'}
-        merge_attrs = {attr for attr in merge_attrs if attr not in ignored_attrs} if merge_attributes else {}
-
-        for attr_key in merge_attrs:
-            values = np.array([[file.attrs[attr_key].encode('ascii')
-                                if isinstance(file.attrs[attr_key], str) else file.attrs[attr_key] for file in files]])
-            if len(values):
-                if isinstance(files[0].attrs[attr_key], str):
-                    # noinspection PyUnresolvedReferences
-                    outfile.create_dataset(attr_key, data=np.reshape(values, label_shape), maxshape=label_maxshape,
-                                           dtype=h5py.special_dtype(vlen=bytes))
-                else:
-                    outfile.create_dataset(attr_key, data=np.reshape(values, label_shape), maxshape=label_maxshape)
-
-        if merge_attributes:
-            base_sample_ids = np.array(
-                [[int(os.path.basename(os.path.splitext(infilename)[0])) for infilename in in_filenames]])
-            # unicode datasets are not supported by all software using hdf5
-            base_sample_names = np.array([[file.attrs['name'].encode('ascii')
-                                           if isinstance(file.attrs['name'], str) else file.attrs['name'] for file in
-                                           files]])
-            outfile.create_dataset('base_sample_id', data=np.reshape(base_sample_ids, label_shape),
-                                   maxshape=label_maxshape)
-            outfile.create_dataset('base_sample_name', data=np.reshape(base_sample_names, label_shape),
-                                   maxshape=label_maxshape, dtype=h5py.special_dtype(vlen=bytes))
-
-            # Sort everything by the specified sort_by path
-            ind = np.argsort(outfile[sort_by])[0, :]
-            for key in merge_attrs.intersection(merge_paths):
-                if key not in reserved_paths:
-                    try:
-                        outfile[key][:] = np.asarray(outfile[key])[:, ind]
-                    except KeyError as e:
-                        print(f'Failed on key: {key}: key not found.\n{e}')
-                    except TypeError as e:
-                        print(f'failed on key: {key}: incompatible dimensions.\n{e}')
-        else:
-            for key, value in files[0].attrs.items():
-                outfile.attrs[key] = value
+                                       data=data,
+                                       dtype=files[0][path].dtype,
+                                       **get_dataset_options(data.shape, files[0][path].dtype, concat_ind))
+        write_merged_attributes(outfile, [file.attrs for file in files], in_filenames, merge_paths, reserved_paths,
+                                orientation, sort_by, merge_attributes)
 
     for file in files:
         file.close()
 
     shutil.move(temp_filename, out_filename)
+
+
+def scan_file(filename: str, align_at: str = None) -> Dict[str, Any]:
+    """
+    Collect the metadata needed to plan a merge without reading any of the large datasets of a file
+    :param filename: The file to scan
+    :param align_at: The path of the dataset used for alignment, whose range, size and grid_key are recorded
+    :return: The shapes and dtypes of all datasets in the file, its attributes, and the range of align_at
+    """
+    with h5py.File(filename, 'r') as file:
+        paths = get_paths(file, '')
+        info = {
+            'filename': filename,
+            'shapes': {path: file[path].shape for path in paths},
+            'dtypes': {path: file[path].dtype for path in paths},
+            'attrs': {key: value for key, value in file.attrs.items()}
+        }
+        if align_at is not None:
+            align = np.asarray(file[align_at])
+            info['align_range'] = (np.amin(align), np.amax(align))
+            info['align_size'] = align.size
+            info['align_key'] = grid_key(align)
+    return info
+
+
+def copy_blocks(source: h5py.Dataset, dest: h5py.Dataset, offset: int, dim_ind: int,
+                chunk_bytes: int = DEFAULT_CHUNK_BYTES, transform: Callable = None) -> None:
+    """
+    Copy a dataset into a slab of a larger dataset, reading at most about chunk_bytes of the source at a time
+    :param source: The dataset to copy from
+    :param dest: The dataset to copy into
+    :param offset: The index in dest along the concatenation axis where the slab starts
+    :param dim_ind: The dimension which is preserved by the concatenation (1 for "vert" and 0 for "horiz")
+    :param chunk_bytes: The approximate number of bytes to read from source at a time
+    :param transform: A function applied to each block before it is written (e.g. an interpolation along axis -1)
+    """
+    if len(source.shape) < 2:
+        blocks = [(0, make_2d(np.asarray(source), dim_ind))]
+    else:
+        row_bytes = max(1, int(np.prod(source.shape[1:])) * source.dtype.itemsize)
+        step = max(1, chunk_bytes // row_bytes)
+        blocks = ((start, source[start:start + step]) for start in range(0, source.shape[0], step))
+    for start, block in blocks:
+        if transform is not None:
+            block = transform(block)
+        if dim_ind == 1:
+            dest[offset + start:offset + start + block.shape[0], :] = block
+        else:
+            dest[start:start + block.shape[0], offset:offset + block.shape[1]] = block
+
+
+def plan_merge(infos: List[Dict[str, Any]], orientation: str = 'vert', reserved_paths: List[str] = None,
+               align_at: str = None) -> Dict[str, Any]:
+    """
+    Decide which datasets of the scanned files are aligned, concatenated or copied, and the shape each file's slab will
+    have in the output
+    :param infos: The results of scan_file for each input file
+    :param orientation: Whether to concatenate vertically ("vert") or horizontally ("horiz")
+    :param reserved_paths: Paths that are assumed identical between collections
+    :param align_at: the name of the label field to sort records by
+    :return: A dictionary describing the merge, used by create_merged_datasets and write_slabs
+    """
+    if reserved_paths is None:
+        reserved_paths = []
+    dim_ind = 1 if orientation == 'vert' else 0
+
+    paths = set()
+    for info in infos:
+        paths |= set(info['shapes'].keys())
+
+    alignment_paths = set(
+        path for path in paths
+        if all(
+            path in info['shapes'] and dim_ind < len(info['shapes'][path])
+            and info['shapes'][path][dim_ind] == info['shapes'][align_at][dim_ind] for info in infos)
+    ) if align_at is not None else set()
+    alignment_paths.discard(align_at)
+
+    merge_paths = set(
+        path for path in paths
+        if path not in alignment_paths
+        and all(path in info['shapes'] and shapes_agree(info['shapes'][path], infos[0]['shapes'][path], dim_ind)
+                for info in infos)
+    )
+    merge_paths.discard(align_at)
+    concat_paths = {path for path in merge_paths if not (path in reserved_paths and path is not align_at)}
+
+    new_align = None
+    if align_at is not None:
+        common_grid = None
+        if len({info['align_key'] for info in infos}) == 1:
+            with h5py.File(infos[0]['filename'], 'r') as file:
+                common_grid = np.asarray(file[align_at])
+        new_align = make_alignment_grid([info['align_range'] for info in infos],
+                                        [info['align_size'] for info in infos], common_grid)
+
+    def shape_2d(shape):
+        # the shape of make_2d(arr, dim_ind) for an array with this shape
+        if len(shape) < 2:
+            shape = [shape[0], shape[0]]
+            shape[dim_ind] = 1
+        return tuple(shape)
+
+    slab_shapes = {path: [shape_2d(tuple(info['shapes'][path][:-1]) + (new_align.size,)) for info in infos]
+                   for path in alignment_paths}
+    slab_shapes.update({path: [shape_2d(info['shapes'][path]) for info in infos] for path in concat_paths})
+    dtypes = {path: np.result_type(infos[0]['dtypes'][path], np.float64) for path in alignment_paths}
+    dtypes.update({path: infos[0]['dtypes'][path] for path in concat_paths})
+
+    return {
+        'dim_ind': dim_ind,
+        'align_at': align_at,
+        'alignment_paths': alignment_paths,
+        'merge_paths': merge_paths,
+        'concat_paths': concat_paths,
+        'new_align': new_align,
+        'new_align_key': grid_key(new_align) if new_align is not None else None,
+        'slab_shapes': slab_shapes,
+        'dtypes': dtypes
+    }
+
+
+def get_merged_shape(plan: Dict[str, Any], path: str, start: int = 0, stop: int = None) -> Tuple[int, int]:
+    """
+    Get the shape of an aligned or concatenated dataset of a merge
+    :param plan: The result of plan_merge
+    :param path: The path of the dataset
+    :param start: The index of the first input file which is included
+    :param stop: One past the index of the last input file which is included
+    """
+    concat_ind = 1 - plan['dim_ind']
+    shapes = plan['slab_shapes'][path][start:stop]
+    shape = list(shapes[0])
+    shape[concat_ind] = sum([slab_shape[concat_ind] for slab_shape in shapes])
+    return tuple(shape)
+
+
+def create_merged_datasets(outfile: h5py.File, plan: Dict[str, Any], start: int = 0, stop: int = None) -> None:
+    """
+    Create the aligned and concatenated datasets of a merge with their final shapes
+    :param outfile: The (open) output file
+    :param plan: The result of plan_merge
+    :param start: The index of the first input file which will be written to outfile
+    :param stop: One past the index of the last input file which will be written to outfile
+    """
+    concat_ind = 1 - plan['dim_ind']
+    for path in plan['alignment_paths'] | plan['concat_paths']:
+        shape = get_merged_shape(plan, path, start, stop)
+        outfile.create_dataset(path, shape=shape, dtype=plan['dtypes'][path],
+                               **get_dataset_options(shape, plan['dtypes'][path], concat_ind))
+    if plan['alignment_paths']:
+        align_shape = [1, 1]
+        align_shape[plan['dim_ind']] = plan['new_align'].size
+        outfile.create_dataset(plan['align_at'], data=np.reshape(plan['new_align'], align_shape),
+                               **get_dataset_options(align_shape, plan['new_align'].dtype, concat_ind))
+
+
+def write_slabs(outfile: h5py.File, plan: Dict[str, Any], infos: List[Dict[str, Any]], start: int = 0,
+                chunk_bytes: int = DEFAULT_CHUNK_BYTES, progress: Callable[[int], None] = None) -> None:
+    """
+    Copy input files one at a time into consecutive slabs of the datasets made by create_merged_datasets
+    :param outfile: The (open) output file, or a dictionary of arrays with the same paths and shapes
+    :param plan: The result of plan_merge
+    :param infos: The results of scan_file for the files to copy
+    :param start: The index of the first of these files in the list of all input files
+    :param chunk_bytes: The approximate number of bytes to read from an input file at a time
+    :param progress: A function called with the number of files copied after each file
+    """
+    dim_ind = plan['dim_ind']
+    concat_ind = 1 - dim_ind
+    new_align = plan['new_align']
+    offsets = {path: 0 for path in plan['alignment_paths'] | plan['concat_paths']}
+    for i, info in enumerate(infos, start):
+        with h5py.File(info['filename'], 'r') as file:
+            if plan['alignment_paths']:
+                align = np.ravel(file[plan['align_at']])
+
+                if info['align_key'] == plan['new_align_key'] and np.array_equal(align, new_align):
+                    transform = None
+                else:
+                    transform = partial(batch_interpolate, align, new_x=new_align)
+                for path in plan['alignment_paths']:
+                    copy_blocks(file[path], outfile[path], offsets[path], dim_ind, chunk_bytes, transform)
+                    offsets[path] += plan['slab_shapes'][path][i][concat_ind]
+            for path in plan['concat_paths']:
+                copy_blocks(file[path], outfile[path], offsets[path], dim_ind, chunk_bytes)
+                offsets[path] += plan['slab_shapes'][path][i][concat_ind]
+        if progress is not None:
+            progress(i - start + 1)
+
+
+def streaming_h5_merge(in_filenames: List[str], out_filename: str, orientation: str = 'vert',
+                       reserved_paths: List[str] = None, sort_by: str = 'base_sample_id', align_at: str = None,
+                       merge_attributes: bool = False, chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> None:
+    """
+    Merge a list of hdf5 files into a single file without loading all of them into memory.
+    The shapes of all datasets are collected first, so the output datasets can be created with their final size. Then
+    each input file is opened one at a time and copied into its slab of the output in blocks of about chunk_bytes.
+    The result is the same as that of h5_merge.
+    :param in_filenames: A list of filenames to merge
+    :param out_filename: Location of output file
+    :param orientation: Whether to concatenate vertically ("vert") or horizontally ("horiz")
+    :param reserved_paths: Paths that are assumed identical between collections
+    :param sort_by: the name of the field in the final collection to sort columns/rows by
+    :param align_at: the name of the label field to sort records by
+    :param merge_attributes: Whether to create new datasets by concatenating common attributes
+    :param chunk_bytes: The approximate number of bytes to read from an input file at a time
+    """
+    infos = [scan_file(filename, align_at) for filename in in_filenames]
+    write_merged_file(infos, out_filename, plan_merge(infos, orientation, reserved_paths, align_at), orientation,
+                      reserved_paths, sort_by, merge_attributes, chunk_bytes)
+
+
+def read_merged(in_filenames: List[str], orientation: str = 'vert', reserved_paths: List[str] = None,
+                align_at: str = None, chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+                progress: Callable[[int], None] = None) -> Dict[str, np.array]:
+    """
+    Merge a list of hdf5 files into arrays instead of a file. Each input file is read once, in blocks of about
+    chunk_bytes, into arrays allocated with their final shapes. The arrays are the datasets h5_merge would write, except
+    that attributes are not merged.
+    :param in_filenames: A list of filenames to merge
+    :param orientation: Whether to concatenate vertically ("vert") or horizontally ("horiz")
+    :param reserved_paths: Paths that are assumed identical between collections
+    :param align_at: the name of the label field to sort records by
+    :param chunk_bytes: The approximate number of bytes to read from an input file at a time
+    :param progress: A function called with the number of files read after each file
+    :return: The merged arrays, keyed by path
+    """
+    infos = [scan_file(filename, align_at) for filename in in_filenames]
+    plan = plan_merge(infos, orientation, reserved_paths, align_at)
+    merged = {path: np.empty(get_merged_shape(plan, path), dtype=plan['dtypes'][path])
+              for path in plan['alignment_paths'] | plan['concat_paths']}
+    write_slabs(merged, plan, infos, 0, chunk_bytes, progress)
+    with h5py.File(infos[0]['filename'], 'r') as file:
+        for path in plan['merge_paths'] - plan['concat_paths']:
+            merged[path] = np.asarray(file[path])
+    if plan['alignment_paths']:
+        align_shape = [1, 1]
+        align_shape[plan['dim_ind']] = plan['new_align'].size
+        merged[plan['align_at']] = np.reshape(plan['new_align'], align_shape)
+    return merged
+
+
+def write_merged_file(infos: List[Dict[str, Any]], out_filename: str, plan: Dict[str, Any], orientation: str = 'vert',
+                      reserved_paths: List[str] = None, sort_by: str = 'base_sample_id',
+                      merge_attributes: bool = False, chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+                      shard_filenames: List[str] = None, shard_bounds: List[Tuple[int, int]] = None) -> None:
+    """
+    Write the output of a streaming or parallel merge
+    :param infos: The results of scan_file for each input file
+    :param out_filename: Location of output file
+    :param plan: The result of plan_merge
+    :param orientation: Whether to concatenate vertically ("vert") or horizontally ("horiz")
+    :param reserved_paths: Paths that are assumed identical between collections
+    :param sort_by: the name of the field in the final collection to sort columns/rows by
+    :param merge_attributes: Whether to create new datasets by concatenating common attributes
+    :param chunk_bytes: The approximate number of bytes to read from an input file at a time
+    :param shard_filenames: Files written by merge_shard to copy in place of the input files
+    :param shard_bounds: The (start, stop) indices of the input files in each shard file
+    """
+    if reserved_paths is None:
+        reserved_paths = []
+    temp_fd, temp_filename = tempfile.mkstemp('.h5', dir=os.path.dirname(os.path.abspath(out_filename)))
+    os.close(temp_fd)
+    try:
+        with h5py.File(temp_filename, 'w') as outfile:
+            create_merged_datasets(outfile, plan)
+            with h5py.File(infos[0]['filename'], 'r') as file:
+                for path in plan['merge_paths'] - plan['concat_paths']:
+                    outfile.create_dataset(path, data=file[path],
+                                           **get_dataset_options(file[path].shape, file[path].dtype,
+                                                                 1 - plan['dim_ind']))
+            if shard_filenames is None:
+                write_slabs(outfile, plan, infos, 0, chunk_bytes)
+            else:
+                # shards hold consecutive slabs of the output
+                concat_ind = 1 - plan['dim_ind']
+                offsets = {path: 0 for path in plan['alignment_paths'] | plan['concat_paths']}
+                for shard_filename, (start, stop) in zip(shard_filenames, shard_bounds):
+                    with h5py.File(shard_filename, 'r') as shard:
+                        for path in offsets.keys():
+                            copy_blocks(shard[path], outfile[path], offsets[path], plan['dim_ind'], chunk_bytes)
+                            offsets[path] += shard[path].shape[concat_ind]
+            write_merged_attributes(outfile, [info['attrs'] for info in infos], [info['filename'] for info in infos],
+                                    plan['merge_paths'], reserved_paths, orientation, sort_by, merge_attributes)
+    except Exception as e:
+        os.remove(temp_filename)
+        raise e
+
+    shutil.move(temp_filename, out_filename)
+
+
+def merge_shard(infos: List[Dict[str, Any]], plan: Dict[str, Any], start: int, stop: int, shard_filename: str,
+                chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> str:
+    """
+    Read and align the input files in [start, stop) into a file holding their slab of the output of a parallel merge
+    :param infos: The results of scan_file for the files in this shard
+    :param plan: The result of plan_merge for all input files
+    :param start: The index of the first file of this shard in the list of all input files
+    :param stop: One past the index of the last file of this shard in the list of all input files
+    :param shard_filename: Where to write the slab
+    :param chunk_bytes: The approximate number of bytes to read from an input file at a time
+    :return: shard_filename
+    """
+    with h5py.File(shard_filename, 'w') as shard:
+        create_merged_datasets(shard, plan, start, stop)
+        write_slabs(shard, plan, infos, start, chunk_bytes)
+    return shard_filename
+
+
+def parallel_h5_merge(in_filenames: List[str], out_filename: str, orientation: str = 'vert',
+                      reserved_paths: List[str] = None, sort_by: str = 'base_sample_id', align_at: str = None,
+                      merge_attributes: bool = False, chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+                      processes: int = None) -> None:
+    """
+    Merge a list of hdf5 files into a single file using a pool of processes.
+    The input files are scanned in parallel, then split into one contiguous shard per process. Each process reads and
+    aligns its shard into a temporary file holding the shard's slab of the output, and the slabs are copied into the
+    output in order. HDF5 files cannot be written by multiple processes at once, which is why the slabs are not written
+    directly to the output. The result is the same as that of h5_merge.
+    :param in_filenames: A list of filenames to merge
+    :param out_filename: Location of output file
+    :param orientation: Whether to concatenate vertically ("vert") or horizontally ("horiz")
+    :param reserved_paths: Paths that are assumed identical between collections
+    :param sort_by: the name of the field in the final collection to sort columns/rows by
+    :param align_at: the name of the label field to sort records by
+    :param merge_attributes: Whether to create new datasets by concatenating common attributes
+    :param chunk_bytes: The approximate number of bytes to read from an input file at a time
+    :param processes: The number of processes to use. If None, the number of CPUs is used.
+    """
+    processes = min(processes or multiprocessing.cpu_count(), len(in_filenames))
+    if processes < 2:
+        return streaming_h5_merge(in_filenames, out_filename, orientation, reserved_paths, sort_by, align_at,
+                                  merge_attributes, chunk_bytes)
+    shard_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_filename)))
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            infos = pool.map(partial(scan_file, align_at=align_at), in_filenames,
+                             chunksize=max(1, len(in_filenames) // (4 * processes)))
+            plan = plan_merge(infos, orientation, reserved_paths, align_at)
+            shard_bounds = [(int(inds[0]), int(inds[-1]) + 1)
+                            for inds in np.array_split(np.arange(len(infos)), processes)]
+            shard_filenames = pool.starmap(merge_shard, [
+                (infos[start:stop], plan, start, stop, os.path.join(shard_dir, f'{start}.h5'), chunk_bytes)
+                for start, stop in shard_bounds
+            ])
+        write_merged_file(infos, out_filename, plan, orientation, reserved_paths, sort_by, merge_attributes,
+                          chunk_bytes, shard_filenames, shard_bounds)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import h5py
+import numpy as np
+
+from config.config import COLLECTION_COMPRESSION
+
+# Target size of one chunk of a dataset. Small enough to stay in the default 1 MiB chunk cache of h5py while a merge
+# fills a chunk one spectrum at a time.
+CHUNK_BYTES = 256 * 1024
+
+
+def get_chunk_shape(shape: Tuple[int, ...], dtype: np.dtype, axis: int = 0,
+                    chunk_bytes: int = CHUNK_BYTES) -> Tuple[int, ...]:
+    """
+    Get a chunk shape holding as many whole spectra as fit in chunk_bytes (at least one), so that reading one spectrum
+    reads one chunk
+    :param shape: The shape of the dataset, which must not have a dimension of length 0
+    :param dtype: The dtype of the dataset
+    :param axis: The axis which indexes spectra (0 when each row is a spectrum)
+    :param chunk_bytes:
+    :return:
+    """
+    spectrum_size = int(np.prod([size for i, size in enumerate(shape) if i != axis], dtype=np.int64))
+    spectrum_bytes = spectrum_size * np.dtype(dtype).itemsize
+    spectra = max(1, min(shape[axis], chunk_bytes // spectrum_bytes))
+    return tuple(spectra if i == axis else size for i, size in enumerate(shape))
+
+
+def parse_compression(compression: str) -> Dict[str, Any]:
+    """
+    Get the create_dataset options for a compression setting: '' (none), 'lzf', 'gzip' or 'gzip:<level>'.
+    :param compression:
+    :return:
+    """
+    if not compression:
+        return {}
+    name, _, level = compression.partition(':')
+    if name == 'lzf' and not level:
+        return {'compression': 'lzf', 'shuffle': True}
+    if name == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': int(level) if level else 4, 'shuffle': True}
+    raise ValueError(f'Improper compression {compression}. Use lzf, gzip or gzip:<level>.')
+
+
+def get_dataset_options(shape: Tuple[int, ...], dtype: np.dtype, axis: int = 0,
+                        compression: str = COLLECTION_COMPRESSION) -> Dict[str, Any]:
+    """
+    Get the keyword arguments of create_dataset for the storage layout of sample and collection files. Numeric datasets
+    are compressed with the configured compression, in resizable chunks of whole spectra. All other datasets, including
+    every dataset when compression is off, are contiguous, so that get_memmap can map them.
+    :param shape: The shape of the dataset
+    :param dtype: The dtype of the dataset
+    :param axis: The axis which indexes spectra (0 when each row is a spectrum)
+    :param compression: See parse_compression
+    :return:
+    """
+    options = parse_compression(compression)
+    if not options or not np.issubdtype(dtype, np.number) or not len(shape) or not all(shape):
+        return {}  # scalars and empty datasets cannot be chunked, and chunking alone does not speed up reads
+    return {'chunks': get_chunk_shape(shape, dtype, axis), 'maxshape': (None,) * len(shape), **options}
+
+
+def get_memmap(dataset: h5py.Dataset) -> Optional[np.memmap]:
+    """
+    Map a contiguous, uncompressed numeric dataset directly from its file, without reading it. The map is read-only and
+    stays valid after the file is closed. It shows values later written in place, but datasets are only deleted or
+    replaced in a copy of the file (see replace_file), so the map never shows another dataset's values.
+    :param dataset:
+    :return: A read-only np.memmap, or None if the layout of dataset does not allow one
+    """
+    if dataset.chunks is not None or dataset.dtype.kind not in 'biufc' or not dataset.size \
+            or dataset.file.driver != 'sec2' or dataset.id.get_create_plist().get_external_count():
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None  # storage not allocated yet
+    return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+
+
+def read_dataset(dataset: h5py.Dataset) -> np.ndarray:
+    """
+    Get the values of a dataset as a numpy array. Contiguous numeric datasets are mapped with get_memmap instead of
+    copied into memory, so the array may be a read-only view.
+    :param dataset:
+    :return:
+    """
+    memmap = get_memmap(dataset)
+    return np.asarray(dataset) if memmap is None else memmap
+
+
+@contextmanager
+def replace_file(filename: str) -> Iterator[h5py.File]:
+    """
+    Open a copy of a file for writing, which replaces the file when the block exits without an exception. Deleting a
+    dataset in place frees its storage for the next dataset written, so maps of the file from get_memmap keep the old
+    file instead.
+    :param filename:
+    :return:
+    """
+    temp_fd, temp_filename = tempfile.mkstemp('.h5', dir=os.path.dirname(os.path.abspath(filename)))
+    os.close(temp_fd)
+    try:
+        shutil.copyfile(filename, temp_filename)
+        with h5py.File(temp_filename, 'r+') as file:
+            yield file
+    except Exception as e:
+        os.remove(temp_filename)
+        raise e
+    shutil.copymode(filename, temp_filename)
+    os.replace(temp_filename, filename)
+
+
+def repack(filename: str, compression: str = COLLECTION_COMPRESSION, block_bytes: int = 64 * 1024 ** 2,
+           contiguous: bool = False) -> None:
+    """
+    Rewrite a sample or collection file with the layout of get_dataset_options. Datasets are copied in blocks of
+    about block_bytes to a temporary file beside filename, which then replaces filename. Groups and attributes are kept.
+    :param filename:
+    :param compression: See parse_compression
+    :param block_bytes:
+    :param contiguous: Whether to write uncompressed, unchunked datasets even when compression is set
+    :return:
+    """
+    temp_fd, temp_filename = tempfile.mkstemp('.h5', dir=os.path.dirname(os.path.abspath(filename)))
+    os.close(temp_fd)
+    try:
+        with h5py.File(filename, 'r') as infile, h5py.File(temp_filename, 'w') as outfile:
+            outfile.attrs.update(infile.attrs)
+
+            def copy(name, obj):
+                if isinstance(obj, h5py.Group):
+                    outfile.require_group(name).attrs.update(obj.attrs)
+                elif isinstance(obj, h5py.Dataset):
+                    options = {} if contiguous else get_dataset_options(obj.shape, obj.dtype, compression=compression)
+                    dataset = outfile.create_dataset(name, shape=obj.shape, dtype=obj.dtype, **options)
+                    dataset.attrs.update(obj.attrs)
+                    if not len(obj.shape):
+                        dataset[()] = obj[()]
+                        return
+                    row_bytes = max(1, int(np.prod(obj.shape[1:], dtype=np.int64)) * obj.dtype.itemsize)
+                    step = max(1, block_bytes // row_bytes)
+                    for start in range(0, obj.shape[0], step):
+                        dataset[start:start + step] = obj[start:start + step]
+
+            infile.visititems(copy)
+    except Exception as e:
+        os.remove(temp_filename)
+        raise e
+    shutil.copymode(filename, temp_filename)
+    os.replace(temp_filename, filename)
@@ -1,32 +1,131 @@
+import copy
+import functools
 import os
+import posixpath
+import threading
+from collections import OrderedDict
 from io import StringIO
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Union, Callable, Tuple, Iterator
 
 import h5py
 import numpy as np
 
-
+from data_tools.file_tools.layout_tools import get_dataset_options
+
+
+class FileCache:
+    """
+    A bounded LRU cache of values read from files. Values are keyed on the name, modification time and size of the file
+    they were read from, so a modified file is read again. Functions which write to files should still call invalidate,
+    because modification times can be too coarse to distinguish two writes.
+    """
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, fn: Callable, filename: str, *args) -> Any:
+        """
+        Get the result of fn(filename, *args), calling fn only if the result is not in the cache
+        :param fn:
+        :param filename:
+        :param args:
+        :return: A copy of the cached value, so that callers can modify it.
+        """
+        stat = os.stat(filename)
+        key = (fn.__name__, filename, stat.st_mtime_ns, stat.st_size, args)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(self.entries[key])
+            self.misses += 1
+        value = fn(filename, *args)
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return copy.deepcopy(value)
+
+    def invalidate(self, filename: str) -> None:
+        """Remove all values read from filename"""
+        with self.lock:
+            for key in [key for key in self.entries.keys() if key[1] == filename]:
+                del self.entries[key]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
+
+
+file_cache = FileCache()
+
+
+def file_cached(fn: Callable) -> Callable:
+    """Cache the results of a function whose first argument is a filename in file_cache"""
+    @functools.wraps(fn)
+    def wrapper(filename: str, *args):
+        return file_cache.get(fn, filename, *args)
+    return wrapper
+
+
+def scan_tree(group: Union[h5py.File, h5py.Group]) -> Tuple[List[str], List[str]]:
+    """
+    Walk the tree under group once, using the object info from the walk instead of opening each object to find its type
+    :param group:
+    :return: The paths of the groups (including group itself) and datasets under group, in the order visited
+    """
+    group_paths = [group.name]
+    dataset_paths = []
+
+    def visit(name, info):
+        path = posixpath.join(group.name, name.decode('utf-8'))
+        if info.type == h5py.h5o.TYPE_GROUP:
+            group_paths.append(path)
+        elif info.type == h5py.h5o.TYPE_DATASET:
+            dataset_paths.append(path)
+
+    h5py.h5o.visit(group.id, visit, info=True)
+    return group_paths, dataset_paths
+
+
+def process_attr_value(value):
+    value = getattr(value, "tolist", lambda x=value: x)()
+    return value.decode('utf-8', errors='ignore') if isinstance(value, bytes) else value
+
+
+@file_cached
 def get_file_attributes(filename: str) -> Dict[str, Any]:
     with h5py.File(filename, 'r') as infile:
         return {key: (value.decode('utf-8', errors='ignore') if isinstance(value, bytes) else value)
                 for key, value in infile.attrs.items()}
 
 
+@file_cached
 def get_all_group_attributes(filename: str) -> Dict[str, Any]:
     """All attributes of all groups of the file"""
     with h5py.File(filename, 'r') as infile:
-        attrs = [get_group_attrs(infile[key]) for key in infile.keys() if isinstance(infile[key], h5py.Group)]
-    all_attrs = {}
-    for attr in attrs:
-        all_attrs.update(attr)
-    return all_attrs
+        group_paths, _ = scan_tree(infile)
+        return {f'{path}/{key}': process_attr_value(value)
+                for path in group_paths[1:]
+                for key, value in infile[path].attrs.items()}
 
 
+@file_cached
 def get_file_attribute_dtypes(filename: str) -> Dict[str, str]:
     with h5py.File(filename, 'r') as infile:
         return {key: type(value).__name__ for key, value in infile.attrs.items()}
 
 
+@file_cached
 def get_collection_metadata(filename: str) -> Dict[str, Any]:
     """Get attributes of a hdf5 file, its last modified date, and the sizes of its largest datasets"""
     with h5py.File(filename, 'r') as infile:
@@ -39,6 +138,7 @@ def get_collection_metadata(filename: str) -> Dict[str, Any]:
     return attrs
 
 
+@file_cached
 def get_collection_info(filename: str) -> Dict[str, Any]:
     """Get metadata and paths of a hdf5 file"""
     with h5py.File(filename, 'r') as infile:
@@ -52,75 +152,102 @@ def get_collection_info(filename: str) -> Dict[str, Any]:
     return {key: (value.item() if hasattr(value, 'item') else value) for (key, value) in collection_info.items()}
 
 
+@file_cached
 def get_dataset_paths(filename: str) -> List[str]:
     """Get all the paths pointing to h5py.Datasets in this file"""
-    paths = []
     with h5py.File(filename, 'r') as infile:
-        iterate_dataset_paths(infile, paths)
-    return paths
+        return flatten_group_info(get_group_info(infile))
 
 
 #  Can raise exceptions!
 def get_csv(filename: str, path: str) -> str:
     """Get a string containing comma-separated values for a dataset"""
-    with h5py.File(filename, 'r') as infile:
+    return ''.join(iterate_csv(filename, path))
+
+
+#  Can raise exceptions!
+def iterate_csv(filename: str, path: str, block_size: int = 1024 ** 2) -> Iterator[str]:
+    """
+    Get the comma-separated values for a dataset in blocks of rows, reading only one block of the dataset at a time.
+    Errors opening the file or finding the dataset are raised by this function, not by the iterator.
+    :param filename:
+    :param path:
+    :param block_size: Approximate number of values in each block
+    :return:
+    """
+    infile = h5py.File(filename, 'r')
+    try:
         dataset = infile[str(path)]
-        s = StringIO()
-        if dataset is not None:
-            dataset = np.array(dataset)
-            if dataset.dtype.type is np.object_:
-                dataset = dataset.astype(str)
-                np.savetxt(s, dataset, delimiter=',', fmt='%s')
-            else:
-                np.savetxt(s, dataset, delimiter=',')
-        return s.getvalue()
+    except Exception:
+        infile.close()
+        raise
+
+    def generate():
+        with infile:
+            block_rows = max(1, block_size // max(1, int(np.prod(dataset.shape[1:], dtype=np.int64))))
+            for i in range(0, dataset.shape[0], block_rows):
+                block = dataset[i:i + block_rows]
+                s = StringIO()
+                if block.dtype.type is np.object_:
+                    np.savetxt(s, block.astype(str), delimiter=',', fmt='%s')
+                else:
+                    np.savetxt(s, block, delimiter=',')
+                yield s.getvalue()
+
+    return generate()
 
 
 def iterate_dataset_paths(group: h5py.Group, paths: List) -> None:
     """Recursively touch every path in this dataset"""
-    [iterate_dataset_paths(group[key], paths) for key in group.keys() if isinstance(group[key], h5py.Group)]
-    paths.extend([get_dataset_info(group[key]) for key in group.keys() if isinstance(group[key], h5py.Dataset)])
+    paths.extend(flatten_group_info(get_group_info(group)))
 
 
-def get_group_info(group: h5py.Group) -> Dict[str, Any]:
-    """Get the path, attributes, child groups and child datasets of a group"""
+def flatten_group_info(group_info: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Get the dataset infos of a get_group_info result, with those of child groups before those of the group"""
+    paths = []
+    for child_info in group_info['groups']:
+        paths.extend(flatten_group_info(child_info))
+    paths.extend(group_info['datasets'])
+    return paths
 
-    def process_value(value):
-        value = getattr(value, "tolist", lambda x=value: x)()
-        return value.decode('utf-8', errors='ignore') if isinstance(value, bytes) else value
 
-    return {
-        'path': group.name,
-        'attrs': {key: process_value(value) for key, value in group.attrs.items()},
-        'groups': [get_group_info(group[key]) for key in group.keys() if isinstance(group[key], h5py.Group)],
-        'datasets': [get_dataset_info(group[key]) for key in group.keys() if isinstance(group[key], h5py.Dataset)]
+def get_group_info(group: h5py.Group) -> Dict[str, Any]:
+    """Get the path, attributes, child groups and child datasets of a group"""
+    group_paths, dataset_paths = scan_tree(group)
+    group_infos = {
+        path: {
+            'path': path,
+            'attrs': {key: process_attr_value(value) for key, value in group.file[path].attrs.items()},
+            'groups': [],
+            'datasets': []
+        }
+        for path in group_paths
     }
+    for path in group_paths[1:]:
+        group_infos[posixpath.dirname(path)]['groups'].append(group_infos[path])
+    for path in dataset_paths:
+        group_infos[posixpath.dirname(path)]['datasets'].append(get_dataset_info(group.file[path]))
+    return group_infos[group.name]
 
 
 def get_group_attrs(group: h5py.Group) -> Dict[str, Any]:
-
-    def process_value(value):
-        value = getattr(value, "tolist", lambda x=value: x)()
-        return value.decode('utf-8', errors='ignore') if isinstance(value, bytes) else value
-
-    main_attrs = {f'{group.name}/{key}': process_value(value) for key, value in group.attrs.items()}
-    child_attrs = [get_group_attrs(group[key]) for key in group.keys() if isinstance(group[key], h5py.Group)]
-    all_attrs = main_attrs
-    for child_attr in child_attrs:
-        all_attrs.update(child_attr)
-    return all_attrs
+    group_paths, _ = scan_tree(group)
+    return {f'{path}/{key}': process_attr_value(value)
+            for path in group_paths
+            for key, value in group.file[path].attrs.items()}
 
 
 def get_dataset_info(dataset: h5py.Dataset) -> Dict[str, Any]:
     """Get the dimensions, data type and attributes of a dataset"""
     rows = 0
     cols = 0
-    if len(dataset.shape) == 1:
-        rows = dataset.shape[0]
+    shape = dataset.shape
+    if len(shape) == 1:
+        rows = shape[0]
         cols = 1
-    if len(dataset.shape) > 1:
-        rows = dataset.shape[0]
-        cols = dataset.shape[1]
+    if len(shape) > 1:
+        rows = shape[0]
+        cols = shape[1]
     return {
         'path': dataset.name,
         'attrs': {key: (value.decode('utf-8', errors='ignore') if isinstance(value, bytes) else value)
@@ -131,6 +258,7 @@ def get_dataset_info(dataset: h5py.Dataset) -> Dict[str, Any]:
     }
 
 
+@file_cached
 def get_all_dataset_info(filename: str):
     with h5py.File(filename, 'r') as file:
         return [get_dataset_info(dataset) for dataset in get_datasets(file)]
@@ -139,21 +267,25 @@ def get_all_dataset_info(filename: str):
 def update_metadata(filename: str, new_data: Dict[str, Any]) -> Dict[str, Any]:
     with h5py.File(filename, 'r+') as file:
         file.attrs.update(new_data)
+    file_cache.invalidate(filename)
     return get_collection_info(filename)
 
 
 def create_empty_file(filename: str, new_data: Dict[str, Any]) -> Dict[str, Any]:
     with h5py.File(filename, 'w') as file:
         file.attrs.update(new_data)
+    file_cache.invalidate(filename)
     return get_collection_info(filename)
 
 
+@file_cached
 def approximate_dims(filename: str) -> (int, int):
     """ Return a (m, n) pair where m is the longest row count and n is longest col count of all datasets"""
     with h5py.File(filename, 'r') as file:
+        shapes = [dataset.shape for dataset in get_datasets(file)]
         try:
-            m = max([dataset.shape[0] for dataset in get_datasets(file)])
-            n = max([dataset.shape[1] if len(dataset.shape) > 1 else 1 for dataset in get_datasets(file)])
+            m = max([shape[0] for shape in shapes])
+            n = max([shape[1] if len(shape) > 1 else 1 for shape in shapes])
             return m, n
         except ValueError:
             return 0, 0
@@ -161,23 +293,20 @@ def approximate_dims(filename: str) -> (int, int):
 
 def get_datasets(group: Union[h5py.File, h5py.Group]) -> List[h5py.Dataset]:
     """Get all the datasets in this file (recursively)"""
-    datasets = []
-    for key in group.keys():
-        if isinstance(group[key], h5py.Dataset):
-            datasets.append(group[key])
-        elif isinstance(group[key], h5py.Group):
-            datasets = datasets + get_datasets(group[key])
-    return datasets
+    _, dataset_paths = scan_tree(group)
+    return [group.file[path] for path in dataset_paths]
 
 
 def add_column(filename: str, name: str, data_type: str = 'string'):
     m, _ = approximate_dims(filename)
     with h5py.File(filename, 'r+') as file:
         if data_type == 'integer':
-            file.create_dataset(name, shape=(m, 1), dtype=np.int64)
+            dtype = np.int64
         elif data_type == 'float':
-            file.create_dataset(name, shape=(m, 1), dtype=np.float64)
+            dtype = np.float64
         elif data_type == 'string':
-            file.create_dataset(name, shape=(m, 1), dtype=h5py.special_dtype(vlen=bytes))
+            dtype = h5py.special_dtype(vlen=bytes)
         else:
             raise ValueError(f'Improper data_type {data_type}')
+        file.create_dataset(name, shape=(m, 1), dtype=dtype, **get_dataset_options((m, 1), dtype))
+    file_cache.invalidate(filename)
@@ -4,8 +4,8 @@ from dashboards import Dashboard
 from data_tools.wrappers.jobserver_control import Job, get_badge_class
 from data_tools.wrappers.users import is_write_permitted
 from data_tools.wrappers.workflows import WorkflowModule
-from data_tools.db_models import Base, OmicsRecordMixin, User, NumericFileRecordMixin, Collection, Sample, ExternalFile, \
-    Notification
+from data_tools.db_models import Base, OmicsRecordMixin, User, FileRecordMixin, NumericFileRecordMixin, Collection, Sample, \
+    ExternalFile, Notification
 from data_tools.template_models.page import PageData
 from helpers import get_item_link
 
@@ -98,6 +98,9 @@ class ListTableData(PageData):
     def __init__(self, current_user: User, records: List[Any], title: str, special_vals: List[bool] = None,
                  special_val_heading=None):
         super(ListTableData, self).__init__(current_user)
+        records = list(records)
+        FileRecordMixin.load_metadata_indices([record for record in records
+                                               if isinstance(record, NumericFileRecordMixin)])
         self.title = title
         self.special_val_heading = special_val_heading if special_val_heading is not None else ''
         if special_vals is None:
@@ -150,6 +153,8 @@ class FileListTableData(PageData):
     def __init__(self, current_user: User, records: List[Union[Sample, Collection]], title: str,
                  special_vals: List[bool] = None, special_val_heading=None):
         super(FileListTableData, self).__init__(current_user)
+        records = list(records)
+        FileRecordMixin.load_metadata_indices(records)
         self.title = title
         self.special_val_heading = special_val_heading if special_val_heading is not None else ''
         if special_vals is None:
@@ -9,6 +9,10 @@ class NotFoundException(Exception):
     pass
 
 
+class BadRequestException(Exception):
+    pass
+
+
 class LoginError(Exception):
     def __init__(self, message, redirect_url=None):
         super(LoginError, self).__init__(message)
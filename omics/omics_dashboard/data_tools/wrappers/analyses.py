@@ -1,18 +1,22 @@
 from typing import List, Dict, Any
 
-from data_tools.wrappers.users import is_read_permitted, is_write_permitted, get_all_read_permitted_records
+from data_tools.wrappers.users import is_read_permitted, is_write_permitted, get_all_read_permitted_records, \
+    get_read_permitted_records
 from data_tools.db_models import Analysis, Collection, User, db
 from data_tools.util import AuthException
 
 
-def get_analyses(user: User, filter_by: Dict[str, Any] = None) -> List[Analysis]:
+def get_analyses(user: User, filter_by: Dict[str, Any] = None, after_id: int = None,
+                 limit: int = None) -> List[Analysis]:
     """
     Get all the analyses the user is allowed to view
     :param user:
     :param filter_by:
+    :param after_id:
+    :param limit:
     :return:
     """
-    return get_all_read_permitted_records(user, Analysis, filter_by)
+    return get_all_read_permitted_records(user, Analysis, filter_by, after_id, limit)
 
 
 def get_analysis(user: User, analysis_id: int) -> Analysis:
@@ -137,5 +141,5 @@ def get_attached_analyses(user: User, collection: Collection) -> List[Analysis]:
     :return:
     """
     if is_read_permitted(user, collection):
-        return get_all_read_permitted_records(user, collection.analyses)
+        return get_read_permitted_records(user, collection.analyses)
     raise AuthException(f'User {user.email} not permitted to access collection {collection.id}')
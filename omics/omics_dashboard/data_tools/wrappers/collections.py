@@ -11,7 +11,7 @@ from data_tools.wrappers.users import is_read_permitted, is_write_permitted, get
 from data_tools.db_models import Collection, User, Sample, db
 from data_tools.file_tools.h5_merge import h5_merge
 from data_tools.util import AuthException, NotFoundException, validate_file
-from config.config import DATADIR
+from config.config import DATADIR, MERGE_PROCESSES, TMPDIR
 
 
 def get_all_collections(filter_by: Dict[str, Any] = None) -> List[Collection]:
@@ -24,14 +24,17 @@ def get_all_collections(filter_by: Dict[str, Any] = None) -> List[Collection]:
     return Collection.query.all()
 
 
-def get_collections(user: User, filter_by: Dict[str, Any] = None) -> List[Collection]:
+def get_collections(user: User, filter_by: Dict[str, Any] = None, after_id: int = None,
+                    limit: int = None) -> List[Collection]:
     """
     Get the attributes and dataset information of all collections a user is allowed to read.
     :param user:
     :param filter_by:
+    :param after_id:
+    :param limit:
     :return:
     """
-    return get_all_read_permitted_records(user, Collection, filter_by)
+    return get_all_read_permitted_records(user, Collection, filter_by, after_id, limit)
 
 
 def get_collection_file_info(collection: Collection):
@@ -134,6 +137,8 @@ def update_collection(user: User, collection: Collection, new_data: Dict[str, An
         if 'file_info' in new_data:
             mdt.update_metadata(collection.filename,
                                 {key: value for key, value in new_data['file_info'].items()})
+        if filename is not None or 'file_info' in new_data:
+            collection.refresh_metadata_index()
         collection.last_editor = user
         db.session.commit()
         return collection
@@ -153,6 +158,7 @@ def update_collection_array(user: User, collection: Collection, path: str, i: in
     """
     if is_write_permitted(user, collection):
         ct.update_array(collection.filename, path, i, j, val)
+        collection.refresh_metadata_index()
         return collection
     raise AuthException(f'User {user.email} is not permitted to modify collection {collection.id}.')
 
@@ -197,10 +203,10 @@ def download_collection(user: User, collection: Collection) -> Dict[str, str]:
     raise AuthException(f'User {user.email} is not permitted to access collection {collection.id}')
 
 
-def download_collection_dataset(user: User, collection: Collection, path: str) -> Dict[str,  str]:
+def download_collection_dataset(user: User, collection: Collection, path: str) -> Dict[str, Any]:
     """
     If the user is allowed to read a collection, get the contents required to send a file containing a dataset
-    as CSV
+    as CSV. The CSV is an iterator of blocks of text.
     :param user:
     :param collection:
     :param path:
@@ -208,7 +214,7 @@ def download_collection_dataset(user: User, collection: Collection, path: str) -
     """
     csv_filename = f'{os.path.basename(os.path.normpath(path))}.csv'
     if is_read_permitted(user, collection):
-        return {'csv': mdt.get_csv(collection.filename, path), 'cd': f'attachment; filename={csv_filename}'}
+        return {'csv': mdt.iterate_csv(collection.filename, path), 'cd': f'attachment; filename={csv_filename}'}
     raise AuthException(f'User {user.email} is not permitted to access collection {collection.id}')
 
 
@@ -216,7 +222,7 @@ def download_collection_dataframe(user: User, collection: Collection, single_col
                                   data_format: str = 'csv', json_orient: str = 'records') -> Dict[str, any]:
     """
     If the user is allowed to read a collection, get the contents required to send a file containing the collection
-    as a pandas dataframe as CSV
+    as a pandas dataframe as CSV. CSV is returned as an iterator of blocks of text.
     :param user:
     :param collection:
     :param single_column: whether to only include single-column attributes in dataframe
@@ -225,8 +231,33 @@ def download_collection_dataframe(user: User, collection: Collection, single_col
     :return:
     """
     if is_read_permitted(user, collection):
-        return {data_format: ct.get_serialized_dataframe(collection.filename, single_column, data_format, json_orient),
-                'cd': f'attachment; filename={collection.id}.{data_format}'}
+        if data_format == 'json':
+            data = ct.get_serialized_dataframe(collection.filename, single_column, data_format, json_orient)
+        else:
+            data = ct.iterate_serialized_dataframe(collection.filename, single_column)
+        return {data_format: data, 'cd': f'attachment; filename={collection.id}.{data_format}'}
+    raise AuthException(f'User {user.email} is not permitted to access collection {collection.id}')
+
+
+def download_collection_slice(user: User, collection: Collection, rows: str = None, cols: str = None) -> Dict[str, str]:
+    """
+    If the user is allowed to read a collection, write an HDF5 file containing a range of the rows and columns of the
+    collection to a temporary file. The caller is responsible for deleting the file.
+    :param user:
+    :param collection:
+    :param rows: A range of rows of the form 'start:stop'
+    :param cols: A range of columns of the form 'start:stop'
+    :return:
+    """
+    if is_read_permitted(user, collection):
+        fd, filename = tempfile.mkstemp(suffix='.h5', dir=TMPDIR)
+        os.close(fd)
+        try:
+            ct.write_collection_slice(collection.filename, filename, rows, cols)
+        except Exception:
+            os.remove(filename)
+            raise
+        return {'filename': filename, 'cd': f'attachment; filename={collection.id}.h5'}
     raise AuthException(f'User {user.email} is not permitted to access collection {collection.id}')
 
 
@@ -323,7 +354,8 @@ def merge_collections(user: User, collections: List[Collection], new_data: Dict[
     db.session.commit()
     new_collection.filename = f'{DATADIR}/collections/{new_collection.id}.h5'
     db.session.commit()
-    h5_merge(infilenames, new_collection.filename, orientation='vert', reserved_paths=['/x'], align_at='/x')
+    h5_merge(infilenames, new_collection.filename, orientation='vert', reserved_paths=['/x'], align_at='/x',
+             streaming=True, processes=MERGE_PROCESSES)
     return update_collection(user, new_collection, new_data)
 
 
@@ -18,14 +18,17 @@ def get_all_external_files(filter_by: Dict[str, Any] = None) -> List[ExternalFil
     return ExternalFile.query.all()
 
 
-def get_external_files(user: User, filter_by: Dict[str, Any] = None) -> List[ExternalFile]:
+def get_external_files(user: User, filter_by: Dict[str, Any] = None, after_id: int = None,
+                       limit: int = None) -> List[ExternalFile]:
     """
     Get all the external files a user is permitted to read
     :param user: A user (usually the currently authenticated user)
     :param filter_by:
+    :param after_id:
+    :param limit:
     :return: All the external files the user is permitted to read
     """
-    return get_all_read_permitted_records(user, ExternalFile, filter_by)
+    return get_all_read_permitted_records(user, ExternalFile, filter_by, after_id, limit)
 
 
 def get_external_file(user: User, external_file_id: int) -> ExternalFile:
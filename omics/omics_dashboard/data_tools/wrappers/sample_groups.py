@@ -6,14 +6,17 @@ from data_tools.db_models import User, Sample, SampleGroup, db
 from data_tools.util import AuthException, NotFoundException
 
 
-def get_sample_groups(user: User, filter_by: Dict[str, Any] = None) -> List[SampleGroup]:
+def get_sample_groups(user: User, filter_by: Dict[str, Any] = None, after_id: int = None,
+                      limit: int = None) -> List[SampleGroup]:
     """
     Get all sample groups visible to a user.
     :param user:
     :param filter_by:
+    :param after_id:
+    :param limit:
     :return:
     """
-    return get_all_read_permitted_records(user, SampleGroup, filter_by)
+    return get_all_read_permitted_records(user, SampleGroup, filter_by, after_id, limit)
 
 
 def get_sample_group(user: User, group_id: int) -> SampleGroup:
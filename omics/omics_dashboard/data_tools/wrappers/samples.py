@@ -21,13 +21,17 @@ def get_all_samples(filter_by: Dict[str, Any] = None) -> List[Sample]:
     return Sample.query.all()
 
 
-def get_samples(user: User, filter_by: Dict[str, Any] = None) -> List[Sample]:
+def get_samples(user: User, filter_by: Dict[str, Any] = None, after_id: int = None,
+                limit: int = None) -> List[Sample]:
     """
     Get the attributes and dataset paths of all the samples to which the user with user_id has read access
     :param user:
+    :param filter_by:
+    :param after_id:
+    :param limit:
     :return:
     """
-    return get_all_read_permitted_records(user, Sample, filter_by)
+    return get_all_read_permitted_records(user, Sample, filter_by, after_id, limit)
 
 
 def get_sample_metadata(user: User, sample: Sample) -> Dict[str, Any]:
@@ -107,6 +111,8 @@ def update_sample(user: User, sample: Sample, new_data: Dict[str, Any], filename
             os.remove(filename)
         sample.last_editor = user
         sample.filename = f'/data/samples/{sample.id}.h5'
+        if filename is not None or 'file_info' in new_data:
+            sample.refresh_metadata_index()
         db.session.commit()
         return sample
     raise AuthException(f'User {user.email} is not permitted to modify sample {sample.id}')
@@ -128,9 +134,9 @@ def delete_sample(user: User, sample: Sample) -> Dict[str, Any]:
     raise AuthException(f'User {user.email} is not permitted to modify collection {sample.id}')
 
 
-def download_sample_dataset(user: User, sample: Sample, path: str) -> Dict[str, str]:
+def download_sample_dataset(user: User, sample: Sample, path: str) -> Dict[str, Any]:
     """
-    Download a CSV file containing a dataset found in this sample
+    Download a CSV file containing a dataset found in this sample. The CSV is an iterator of blocks of text.
     :param user:
     :param sample:
     :param path:
@@ -138,7 +144,7 @@ def download_sample_dataset(user: User, sample: Sample, path: str) -> Dict[str,
     """
     csv_filename = f'{os.path.basename(os.path.normpath(path))}.csv'
     if is_read_permitted(user, sample):
-        return {'csv': mdt.get_csv(sample.filename, path), 'cd': f'attachment; filename={csv_filename}'}
+        return {'csv': mdt.iterate_csv(sample.filename, path), 'cd': f'attachment; filename={csv_filename}'}
     raise AuthException(f'User {user.email} is not permitted to access collection {sample.id}')
 
 
@@ -2,7 +2,7 @@ from typing import List, Dict, Any
 
 from data_tools.wrappers.users import is_user_group_admin, get_read_permitted_records, \
     get_all_read_permitted_records
-from data_tools.db_models import User, UserGroup, db
+from data_tools.db_models import User, UserGroup, db, is_user_group_member
 from data_tools.util import AuthException, NotFoundException
 
 
@@ -16,12 +16,16 @@ def get_all_user_groups(filter_by: Dict[str, Any] = None) -> List[UserGroup]:
     return UserGroup.query.all()
 
 
-def get_user_groups(user: User, filter_by: Dict[str, Any] = None) -> List[UserGroup]:
+def get_user_groups(user: User, filter_by: Dict[str, Any] = None, after_id: int = None,
+                    limit: int = None) -> List[UserGroup]:
     """
     Get a list of all user groups readable by user.
+    :param filter_by:
+    :param after_id:
+    :param limit:
     :return:
     """
-    return get_all_read_permitted_records(user, UserGroup, filter_by)
+    return get_all_read_permitted_records(user, UserGroup, filter_by, after_id, limit)
 
 
 def get_user_group(user: User, user_group_id: int) -> UserGroup:
@@ -34,7 +38,7 @@ def get_user_group(user: User, user_group_id: int) -> UserGroup:
     user_group = UserGroup.query.filter_by(id=user_group_id).first()
     if user_group is None:
         raise NotFoundException(f'No user group with id {user_group_id}')
-    if user_group.all_can_read or user in user_group.members:
+    if user_group.all_can_read or is_user_group_member(user, user_group.id):
         return user_group
 
 
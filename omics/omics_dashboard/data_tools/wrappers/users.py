@@ -5,7 +5,7 @@ from typing import List, Dict, Any
 import jwt
 from xkcdpass import xkcd_password as xp
 
-from data_tools.db_models import User, UserGroup, UserInvitation, db, OmicsRecordMixin
+from data_tools.db_models import User, UserGroup, UserInvitation, db, is_user_group_member, user_group_admin
 from data_tools.util import AuthException, NotFoundException
 
 
@@ -17,12 +17,16 @@ def get_all_users() -> List[User]:
     return [user for user in User.query.all()]
 
 
-def get_users(user: User) -> List[User]:
+def get_users(user: User, filter_by: Dict[str, Any] = None, after_id: int = None, limit: int = None) -> List[User]:
     """
     Get a list of all users
+    :param user:
+    :param filter_by:
+    :param after_id:
+    :param limit:
     :return:
     """
-    return get_all_read_permitted_records(user, User)
+    return get_all_read_permitted_records(user, User, filter_by, after_id, limit)
 
 
 def get_user(user: User, target_user_id: int) -> User:
@@ -250,7 +254,7 @@ def user_in_user_group(user: User, group: UserGroup) -> bool:
     :param group:
     :return:
     """
-    return user in group.members
+    return is_user_group_member(user, group.id)
 
 
 def is_user_group_admin(user: User, group: UserGroup) -> bool:
@@ -260,7 +264,7 @@ def is_user_group_admin(user: User, group: UserGroup) -> bool:
     :param group:
     :return:
     """
-    return user.admin or (user in group.admins)
+    return user.admin or is_user_group_member(user, group.id, user_group_admin)
 
 
 def is_read_permitted(user: User, record: Any) -> bool:
@@ -274,14 +278,13 @@ def is_read_permitted(user: User, record: Any) -> bool:
     :param record:
     :return:
     """
-    #  TODO: All of this stuff should be done with DB queries rather than loading all elements in memory first
     if record is None:
         return False
     elif user.admin or record.all_can_read or record.owner_id == user.id:
         return True
-    elif not hasattr(record, 'user_group') or hasattr(record, 'user_group') and record.user_group is None:
+    elif not hasattr(record, 'user_group') or record.user_group_id is None:
         return False
-    return record.group_can_read and user in record.user_group.members
+    return record.group_can_read and is_user_group_member(user, record.user_group_id)
 
 
 def is_write_permitted(user: User, record: Any) -> bool:
@@ -295,51 +298,57 @@ def is_write_permitted(user: User, record: Any) -> bool:
         return False
     elif user.admin or record.all_can_write or record.owner_id == user.id:
         return True
-    elif not hasattr(record, 'user_group') or hasattr(record, 'user_group') and record.user_group is None:
+    elif not hasattr(record, 'user_group') or record.user_group_id is None:
         return False
-    return record.group_can_write and (user in record.user_group.members)
+    return record.group_can_write and is_user_group_member(user, record.user_group_id)
 
 
 def get_read_permitted_records(user: User, records: List[Any]) -> List[Any]:
     """
     Get all the records in the list records which the user is allowed to read
     Use get_all_read_permitted_records instead if you want to filter all records in existence,
-    This is best for smaller collections of records
-    TODO: Do this at the query level instead of on all()
+    This is best for smaller collections of records (like relationships) which are already loaded. The records must
+    all be of the same model. Permissions are checked with one query per 500 records.
     :param user:
     :param records:
     :return:
     """
-    return [record for record in records if record.read_permitted(user)]
+    records = list(records)
+    if user.admin or not len(records):
+        return records
+    model = type(records[0])
+    record_ids = [record.id for record in records]
+    permitted_ids = set()
+    for i in range(0, len(record_ids), 500):
+        permitted_ids.update(record_id for record_id, in db.session.query(model.id).filter(
+            model.id.in_(record_ids[i:i + 500]), model.read_permitted_clause(user)))
+    return [record for record in records if record.id in permitted_ids]
 
 
-def get_all_read_permitted_records(user: User, model: db.Model, filter_by: Dict[str, Any] = None):
+def get_all_read_permitted_records(user: User, model: db.Model, filter_by: Dict[str, Any] = None, after_id: int = None,
+                                   limit: int = None):
     """
     Get all of the records of the model model which the user is allowed to read.
     This should be used in place of get_read_permitted_records when you need to filter
     all records of a particular kind because it uses a db query that only loads the returned records
+    Pages of records can be fetched by passing the id of the last record of the previous page as after_id. Records are
+    ordered by id when after_id or limit is set.
     :param user:
     :param model:
     :param filter_by: A dictionary to filter on.
+    :param after_id: Only get records with ids greater than this.
+    :param limit: The maximum number of records to get.
     :return:
     """
     query = model.query.filter_by(**filter_by) if filter_by is not None else model.query
-    if issubclass(model, OmicsRecordMixin):
-        return query.filter((model.owner_id == user.id) | model.all_can_read |
-                            (model.group_can_read & model.user_group_id.in_(
-                                [user_group.id for user_group in user.user_groups])))
-    else:
-        # argh ORMs
-        # query database (all_can_read is a property of User and UserGroup classes, not a table)
-        entries = query.filter((model.owner_id == user.id) | model.all_can_read |
-                               (model.user_group_id.in_([user_group.id for user_group in user.user_groups])))
-        # filter results
-        return [
-            entry for entry in entries
-            if (entry.owner_id == user.id
-                or entry.all_can_read
-                or (entry.group_can_read and entry.user_group_id in [user_group.id for user_group in user.user_groups]))
-        ]
+    query = query.filter(model.read_permitted_clause(user))
+    if after_id is not None:
+        query = query.filter(model.id > after_id)
+    if after_id is not None or limit is not None:
+        query = query.order_by(model.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
 
 
 def get_user_name(user: User):
@@ -77,13 +77,17 @@ def get_workflow_template(name: str, description: str, workflow_id: int) -> Dict
     }
 
 
-def get_workflows(user: User, filter_by: Dict[str, Any] = None) -> List[Workflow]:
+def get_workflows(user: User, filter_by: Dict[str, Any] = None, after_id: int = None,
+                  limit: int = None) -> List[Workflow]:
     """
     Get a list of available saved workflows.
     :param user:
+    :param filter_by:
+    :param after_id:
+    :param limit:
     :return:
     """
-    return get_all_read_permitted_records(user, Workflow, filter_by)
+    return get_all_read_permitted_records(user, Workflow, filter_by, after_id, limit)
 
 
 def get_workflow(user: User, workflow_id: int) -> Workflow:
@@ -1,13 +1,15 @@
 import datetime
 import inspect
+import os
 import traceback
 
-from flask import url_for, request, render_template, redirect, jsonify
+import sqlalchemy as sa
+from flask import url_for, request, render_template, redirect, jsonify, Response
 from flask_login import current_user
 
 import data_tools as dt
-from data_tools.util import LoginError
-from config.config import DATADIR
+from data_tools.util import BadRequestException, LoginError
+from config.config import DATADIR, MAX_LIST_LIMIT
 
 log_file_name = f'{DATADIR}/logs/omics.log'
 
@@ -133,6 +135,9 @@ def handle_exception_browser(e):
 
 
 def handle_exception(e):
+    if isinstance(e, dt.util.BadRequestException):
+        log_exception(400, e)
+        return jsonify({'message': str(e)}), 400
     if isinstance(e, dt.util.NotFoundException):
         log_exception(404, e)
         return jsonify({'message': str(e)}), 404
@@ -209,6 +214,98 @@ def process_input_dict(input_dict, set_permissions=False):
     return new_dict
 
 
+def get_filter_columns(model):
+    """
+    Get the columns of a model that list requests can filter on. Only indexed, unique and primary key columns are
+    allowed so that filters do not cause table scans.
+    :param model:
+    :return: A dictionary of attribute names to columns
+    """
+    return {
+        attr.key: attr.columns[0] for attr in sa.inspect(model).column_attrs
+        if attr.columns[0].primary_key or attr.columns[0].index or attr.columns[0].unique
+    }
+
+
+def get_list_response(user, model, get_records, has_file_info=False):
+    """
+    Serialize the records for a list route, using the query string of the request:
+    after: the id of the last record of the previous page. Records are returned in order of id when after or limit is set
+    limit: the maximum number of records to return, from 1 to MAX_LIST_LIMIT
+    fields: a comma-separated list of fields to include in each record (id is always included)
+    file_info: 'false' to omit file_info, if the records have it
+    any other parameter is the name of a column from get_filter_columns and a value it must have ('true' or 'false' for
+    boolean columns)
+    When a page is full, the X-Next-After header contains the value of after for the next page. Improper parameters
+    raise BadRequestException.
+    :param user:
+    :param model:
+    :param get_records: A wrapper like dt.samples.get_samples which takes filter_by, after_id and limit
+    :param has_file_info: Whether to_dict of model takes include_file_info
+    :return:
+    """
+    reserved_keys = {'after', 'limit', 'fields', 'file_info'}
+    filter_columns = get_filter_columns(model)
+    filter_by = {}
+    for key, value in request.args.items():
+        if key in reserved_keys:
+            continue
+        if key not in filter_columns:
+            raise BadRequestException(
+                f'Cannot filter on {key}. Filterable fields are {", ".join(sorted(filter_columns))}.')
+        python_type = filter_columns[key].type.python_type
+        try:
+            if python_type is bool:
+                filter_by[key] = {'true': True, 'false': False}[value.lower()]
+            else:
+                filter_by[key] = python_type(value)
+        except (KeyError, TypeError, ValueError):
+            raise BadRequestException(f'Improper value {value} for {key}.')
+    try:
+        after_id = int(request.args['after']) if 'after' in request.args else None
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        raise BadRequestException('after and limit must be integers.')
+    if limit is not None and not 1 <= limit <= MAX_LIST_LIMIT:
+        raise BadRequestException(f'limit must be from 1 to {MAX_LIST_LIMIT}.')
+    fields = {field for field in request.args.get('fields', '').split(',') if field}
+    kwargs = {}
+    if has_file_info:
+        kwargs['include_file_info'] = request.args.get('file_info', 'true') == 'true' and (
+                not fields or 'file_info' in fields)
+    records = model.to_dicts(get_records(user, filter_by=filter_by or None, after_id=after_id, limit=limit), **kwargs)
+    if fields:
+        fields.add('id')
+        records = [{key: value for key, value in record.items() if key in fields} for record in records]
+    response = jsonify(records)
+    if limit is not None and len(records) == limit:
+        response.headers['X-Next-After'] = str(records[-1]['id'])
+    return response
+
+
+def stream_temporary_file(filename, mimetype, content_disposition, block_size=1024 ** 2):
+    """
+    Stream a temporary file to the client in blocks and delete it once it has been sent
+    :param filename:
+    :param mimetype:
+    :param content_disposition:
+    :param block_size:
+    :return:
+    """
+    def generate():
+        try:
+            with open(filename, 'rb') as file:
+                for block in iter(lambda: file.read(block_size), b''):
+                    yield block
+        finally:
+            os.remove(filename)
+
+    response = Response(generate(), mimetype=mimetype)
+    response.headers['Content-Disposition'] = content_disposition
+    response.headers['Content-Length'] = str(os.path.getsize(filename))
+    return response
+
+
 def make_valid_tag(s):
     if isinstance(s, str):
         for c in ' !"#$%&\'()*+,./:;<=>?@[\]^`{|}~':
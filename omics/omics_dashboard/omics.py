@@ -1,14 +1,18 @@
 import datetime
+import glob
 import os
 import traceback
 
+import click
+import sqlalchemy as sa
 from flask import Flask, jsonify, send_from_directory, session
 from flask_login import current_user, login_required
 from blueprints.browser import browser_blueprints
 from blueprints.api import api_blueprints
 from dashboards import dashboard_list
 from data_tools.db_models import db, User
-from config.config import DATADIR, UPLOADDIR, REDIS_URL
+from data_tools.file_tools.layout_tools import repack
+from config.config import DATADIR, UPLOADDIR, REDIS_URL, COLLECTION_COMPRESSION
 from helpers import log_exception, make_valid_tag, make_tag_from_name
 from login_manager import login_manager
 from config.socket_config import socketio
@@ -78,6 +82,13 @@ with app.app_context():
 
     # create DB tables if necessary
     db.create_all()
+    # create_all does not add new indexes to existing tables
+    inspector = sa.inspect(db.engine)
+    for table in db.metadata.tables.values():
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(db.engine)
     # if this is the first time running, create default user account
     if User.query.filter_by(admin=True).first() is None:
         new_user = User(email='admin@admin.admin', name='Default Admin (!)', admin=True, active=True)
@@ -99,5 +110,27 @@ with app.app_context():
             app.view_functions[view_func] = login_required(app.view_functions[view_func])
 
 
+@app.cli.command('repack')
+@click.option('--compression', default=COLLECTION_COMPRESSION,
+              help='Compression of numeric datasets: lzf, gzip or gzip:<level>. Defaults to COLLECTION_COMPRESSION.')
+@click.option('--contiguous', is_flag=True,
+              help='Write uncompressed, unchunked datasets, which can be read through memory maps.')
+@click.argument('directories', nargs=-1)
+def repack_files(compression, contiguous, directories):
+    """
+    Rewrite the files in DIRECTORIES (by default the collections and samples in DATADIR) with the current layout.
+    """
+    if not directories:
+        directories = [f'{DATADIR}/collections', f'{DATADIR}/samples']
+    for directory in directories:
+        filenames = sorted(glob.glob(os.path.join(directory, '*.h5')))
+        for i, filename in enumerate(filenames):
+            click.echo(f'[{i + 1}/{len(filenames)}] {filename}')
+            try:
+                repack(filename, compression, contiguous=contiguous)
+            except Exception as e:
+                click.echo(f'Failed to repack {filename}: {e}', err=True)
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080)